@@ -1,50 +1,154 @@
+from contextlib import asynccontextmanager
+from typing import Literal, Optional
 from fastapi import FastAPI,Body
-from fastapi.params import Query
-from pydantic import BaseModel
-from langgraph.prebuilt import create_react_agent
-from config.client import model
-from tools.my_details import my_info
-from tools.tools import tools
-from langchain_core.messages import HumanMessage
-from langchain_core.messages import SystemMessage
-from tools.get_details import get_personality
+import logging
 from models.api_models import VideoId
-from database.pinecone_upsert import upsert_video_chunks_to_pinecone
-from database.pinecone_retriever import semantic_search_by_creator
-from database.character_db import store_video_chunks_in_db,create_video_creator_table,insert_video_creator
-import uvicorn
+import math
+import time
+from fastapi import Request
+from fastapi.responses import JSONResponse, PlainTextResponse
+from config.logging_config import setup_logging
+from opentelemetry.trace import SpanKind
+from services.metrics import HTTP_REQUEST_SECONDS, render_metrics
+from services.tracing import setup_tracing, span, use_request_id, new_request_id
+from services.usage import attribute_usage, usage_tracker
+from services.warmup import start_warm_up, is_ready
+from services.resilience import UPSTREAMS
+from services.errors import LLMOverloadedError
+from services.rate_limiter import rate_limiter
+from database.messages_db import flush_chat_messages
 from routers.user_db_routers import router as user_db_router
 from routers.chat_workflow_router import router as chat_workflow_router
+from routers.usage_router import router as usage_router
 
+setup_logging()
+setup_tracing()
 
-app = FastAPI(title="Creator Twin RAG API", version="1.0.0",)
+logger = logging.getLogger(__name__)
+
+# The endpoints import the agent, LLM, Pinecone, YouTube and document fetching stacks on first use
+# (or during the warm-up), so a new worker answers health checks within milliseconds of starting.
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_warm_up()
+    yield
+    # Write buffered data before the process exits
+    rate_limiter.flush()
+    flush_chat_messages()
+    usage_tracker.flush()
+
+
+app = FastAPI(title="Creator Twin RAG API", version="1.0.0", lifespan=lifespan)
+
+@app.middleware("http")
+async def time_requests(request: Request, call_next):
+    # A request id sent by the caller is kept, so traces and logs can be matched across services.
+    # LLM calls made while serving the request are billed to its path.
+    with use_request_id(request.headers.get("X-Request-ID") or new_request_id()) as request_id, \
+            span(f"{request.method} {request.url.path}", attributes={"http.request.method": request.method}, kind=SpanKind.SERVER) as current, \
+            attribute_usage(endpoint=request.url.path):
+        start = time.perf_counter()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            response.headers["X-Request-ID"] = request_id
+            return response
+        finally:
+            # The route template keeps ids in paths and query strings out of the labels
+            route = getattr(request.scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.observe(
+                time.perf_counter() - start,
+                method=request.method,
+                route=route,
+                status=status
+            )
+            current.update_name(f"{request.method} {route}")
+            current.set_attribute("http.route", route)
+            current.set_attribute("http.response.status_code", status)
+
+@app.exception_handler(LLMOverloadedError)
+async def llm_overloaded(request: Request, exc: LLMOverloadedError):
+    # The LLM scheduler shed a call of the request, the caller should come back later
+    return JSONResponse(
+        status_code=503,
+        content={"message": str(exc)},
+        headers={"Retry-After": str(math.ceil(exc.retry_after))}
+    )
 
 @app.get("/")
 def health():
     return {"message": "Hello, I am alive!"}
 
+@app.get("/ready")
+def ready():
+    """
+    Readiness check: 503 until the warm-up has loaded the heavy dependencies and clients.
+    Also reports the circuit breaker state of every upstream service, an open breaker does not make the
+    worker unready as every worker would see the same outage.
+    """
+    upstreams = {name: upstream.state for name, upstream in UPSTREAMS.items()}
+    if not is_ready():
+        return JSONResponse(status_code=503, content={"ready": False, "upstreams": upstreams})
+    return {"ready": True, "upstreams": upstreams}
+
 @app.post("/generate_personality_from_videos",)
-def personality(video_id:VideoId=Body(...)):
-    return get_personality(list(video_id.video_id))
+def personality(video_id:VideoId=Body(...), mode:Literal["agent","batched"]="agent", creator_id:Optional[str]=None):
+    if creator_id:
+        budget = usage_tracker.check_budget(creator_id=creator_id)
+        if not budget.allowed:
+            return JSONResponse(
+                status_code=429,
+                content={"message": "Token budget exceeded.", "limit": budget.limit, "used": budget.used},
+                headers={"Retry-After": str(math.ceil(budget.retry_after))}
+            )
+    from tools.get_details import get_personality
+    with attribute_usage(creator_id=creator_id):
+        return get_personality(list(video_id.video_id), mode=mode, creator_id=creator_id)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Exposes request, database, Pinecone, LLM and cache metrics in the Prometheus text format.
+    """
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+@app.get("/creator_style_profile")
+def creator_style_profile(creator_id: str):
+    from services.style_profile import get_creator_style_profile
+    return get_creator_style_profile(creator_id)
 
 @app.get("/creator_background_details")
 def my_details():
+    from tools.my_details import my_info
     return my_info()
 
 @app.post("/load_data")
 def load_data_to_pinecone(creator_id : str, video_id:VideoId=Body(...)):
+    from database.character_db import store_video_chunks_in_db,create_video_creator_table,insert_video_creator
+    from database.pinecone_upsert import upsert_video_chunks_to_pinecone
+    from services.style_profile import add_video_to_style_profile
+    from tools.transcript import transcript_text
 
     try:
         create_video_creator_table()
-        store_video_chunks_in_db(video_id=video_id.video_id[0])
+        transcript = store_video_chunks_in_db(video_id=video_id.video_id[0])
         insert_video_creator(creator_id = creator_id, video_id = video_id.video_id[0])
         upsert_video_chunks_to_pinecone(video_id=video_id.video_id[0])
-        return {"message": "Data loaded to Pinecone"}
     except Exception as e:
         return {"message": f"Error loading data to Pinecone: {e}"}
+    # The video is searchable now, a failed style analysis must not report the load as failed
+    try:
+        add_video_to_style_profile(creator_id=creator_id, video_id=video_id.video_id[0],
+                                   script=transcript_text(transcript) if transcript is not None else None)
+    except Exception as e:
+        logger.error("Could not add video %s to the style profile of creator %s: %s", video_id.video_id[0], creator_id, e)
+    return {"message": "Data loaded to Pinecone"}
 
 @app.get("/retrieve_pinecone_data")
 def retrieve_data(creator_id: str, search_query:str):
+    from database.pinecone_retriever import semantic_search_by_creator
     try:
         return semantic_search_by_creator(creator_id=creator_id, search_query=search_query)
     except Exception as e:
@@ -52,9 +156,13 @@ def retrieve_data(creator_id: str, search_query:str):
 
 app.include_router(user_db_router) # routers for user_db operations
 app.include_router(chat_workflow_router) # routers for chat workflow operations
+app.include_router(usage_router) # routers for LLM usage reporting
 
 
 if __name__ == "__main__":
+    from database.character_db import store_video_chunks_in_db,create_video_creator_table,insert_video_creator
+    from database.pinecone_upsert import upsert_video_chunks_to_pinecone
+    from database.pinecone_retriever import semantic_search_by_creator
     create_video_creator_table()
     store_video_chunks_in_db(video_id="-QTkPfq7w1A")
     insert_video_creator(video_id = "-QTkPfq7w1A", creator_id = "creator123")
@@ -0,0 +1,478 @@
+# Deterministic local stand-ins for every external service the server calls: the OpenAI chat model,
+# Gemini, the Pinecone indexes, the local embedding model, the YouTube transcript API, the Google Doc
+# fetch, the tiktoken encoding downloads behind TokenTextSplitter and the context window, and a PostgreSQL server for the
+# PostgreSQL storage backend.
+# install_fakes() must run before the application modules are imported, so the names they import
+# at module level already point to the fakes.
+import hashlib
+import json
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, SystemMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+VOCABULARY = (
+    "honestly basically the a and to of you I it that is in this was for so like just really know think "
+    "video camera light lens shot edit color story people thing way time day make build test review "
+    "actually literally super pretty kind sort right okay um uh yeah well gonna wanna kinda stuff "
+    "battery phone screen design price quality sound music travel city mountain coffee studio channel"
+).split()
+
+
+@dataclass
+class FakeLatency:
+    """
+    Simulated response times of the external services, in seconds. All zero measures our own code only.
+    """
+    llm: float = 0.0
+    pinecone: float = 0.0
+    transcript: float = 0.0
+    doc: float = 0.0
+    embedding: float = 0.0
+
+
+latency = FakeLatency()
+
+
+def _seed(text: str) -> int:
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def fake_transcript(video_id: str, segments: int = 400) -> List[Dict[str, Any]]:
+    """
+    Returns the same made-up transcript for a video id every time, in the YouTube transcript API format.
+    """
+    rng = random.Random(_seed(video_id))
+    transcript = []
+    for i in range(segments):
+        words = [rng.choice(VOCABULARY) for _ in range(rng.randint(5, 14))]
+        text = " ".join(words) + rng.choice([".", ".", "?", "!"])
+        transcript.append({"text": text, "start": i * 3.0, "duration": 3.0})
+    return transcript
+
+
+class FakeFetchedTranscript:
+    def __init__(self, snippets: List[Dict[str, Any]]):
+        self.snippets = snippets
+
+    def to_raw_data(self) -> List[Dict[str, Any]]:
+        return self.snippets
+
+
+class FakeYouTubeTranscriptApi:
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def fetch(self, video_id: str, *args, **kwargs) -> FakeFetchedTranscript:
+        time.sleep(latency.transcript)
+        return FakeFetchedTranscript(fake_transcript(video_id))
+
+
+class FakeTokenTextSplitter:
+    """
+    Stand-in for TokenTextSplitter counting whitespace-separated words as tokens,
+    so no tiktoken encoding has to be downloaded.
+    """
+
+    def __init__(self, chunk_size: int = 4000, chunk_overlap: int = 200, **kwargs):
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+
+    def split_text(self, text: str) -> List[str]:
+        words = text.split()
+        step = max(self.chunk_size - self.chunk_overlap, 1)
+        return [" ".join(words[start:start + self.chunk_size]) for start in range(0, max(len(words) - self.chunk_overlap, 1), step)]
+
+
+class FakeEncoding:
+    """
+    Stand-in for the tiktoken encoding the context window counts tokens with, splitting words and
+    punctuation, so no encoding has to be downloaded.
+    """
+
+    def encode(self, text: str, **kwargs) -> List[str]:
+        return re.findall(r"\w+|[^\w\s]", text)
+
+
+def _profile_json(text: str) -> str:
+    rng = random.Random(_seed(text))
+    words = [word for word in re.findall(r"[a-z']+", text.lower()) if len(word) > 3] or ["thing"]
+    return json.dumps({
+        "lexicon": {
+            "common_words": sorted(set(rng.choice(words) for _ in range(5))),
+            "jargon_slang": [],
+            "formality_level": rng.choice(["formal", "academic", "casual", "colloquial"]),
+            "crutch_words": ["um", "like"],
+        },
+        "syntax": {
+            "sentence_length": rng.choice(["short", "medium", "long"]),
+            "grammar_accuracy": "occasional_errors",
+            "voice_preference": rng.choice(["active", "passive", "mixed"]),
+        },
+        "rhetoric_style": {
+            "phrases_catchphrases": [],
+            "metaphors_analogies": "occasional",
+            "storytelling": "moderate",
+            "directness": rng.choice(["very_direct", "moderately_direct", "indirect"]),
+        },
+    })
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model answering from its input alone. Profile requests get a valid Verbal profile as JSON,
+    an agent with the get_script tool first reads tool_calls_per_run chunks, anything else gets a short reply.
+    """
+    model_name: str = "fake-chat"
+    temperature: float = 0.5
+    seed: Optional[int] = None
+    tool_calls_per_run: int = 2
+    bound_tools: List[str] = []
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.model_copy(update={"bound_tools": [convert_to_openai_tool(tool)["function"]["name"] for tool in tools]})
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager=None, **kwargs) -> ChatResult:
+        time.sleep(latency.llm)
+        text = "\n".join(str(message.content) for message in messages)
+        tool_results = sum(isinstance(message, ToolMessage) for message in messages)
+        if "get_script" in self.bound_tools and tool_results < self.tool_calls_per_run:
+            message = AIMessage(content="", tool_calls=[{
+                "name": "get_script", "args": {"index": tool_results}, "id": f"call_{tool_results}"
+            }])
+        elif any(isinstance(message, SystemMessage) and "communication profile" in str(message.content) for message in messages):
+            message = AIMessage(content=_profile_json(text))
+        else:
+            message = AIMessage(content=f"Fake reply to {len(text)} characters of conversation.")
+        # Usage is reported like OpenAI does, counting words as tokens
+        prompt_tokens, completion_tokens = len(text.split()), len(str(message.content).split()) + 10 * len(message.tool_calls)
+        message.usage_metadata = {"input_tokens": prompt_tokens, "output_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        message.response_metadata = {"model_name": self.model_name}
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def fake_generate(text: str) -> str:
+    """
+    Stand-in for gemini_config.generate.
+    """
+    time.sleep(latency.llm)
+    return f"Summary of {len(text.splitlines())} lines: " + " ".join(text.split()[:20])
+
+
+class FakeHit(dict):
+    def __init__(self, record: Dict[str, Any], score: float, fields: List[str]):
+        super().__init__(_id=record["_id"], fields={field: record.get(field) for field in fields})
+        self._score = score
+
+
+class FakeSearchResponse:
+    def __init__(self, hits: List[FakeHit]):
+        self.result = type("Result", (), {"hits": hits})()
+
+
+class FakeMatch:
+    def __init__(self, record: Dict[str, Any], score: float):
+        self.id = record["id"]
+        self.score = score
+        self.metadata = record.get("metadata")
+
+
+class FakeEmbeddingModel:
+    """
+    Stand-in for fastembed's TextEmbedding: hashes the words of a text into a normalized bag-of-words
+    vector, so texts sharing words are close. latency.embedding is spent per batch.
+    """
+    dimension = 384
+
+    def passage_embed(self, texts: List[str], batch_size: int = 256, **kwargs):
+        for start in range(0, len(texts), batch_size):
+            time.sleep(latency.embedding)
+            for text in texts[start:start + batch_size]:
+                yield self._vector(text)
+
+    def query_embed(self, query, **kwargs):
+        yield from self.passage_embed([query] if isinstance(query, str) else list(query), **kwargs)
+
+    def _vector(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        for word in set(text.lower().split()):
+            vector[_seed(word) % self.dimension] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        return [value / norm for value in vector]
+
+
+class FakeIndex:
+    """
+    In-memory index with the upsert_records and search calls of integrated embedding indexes and the
+    upsert and query calls of vector indexes the server uses. Search scores are word overlap between
+    the query and the record text and query scores the dot product, so results are deterministic.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._records: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def upsert_records(self, namespace: str, records: List[Dict[str, Any]]):
+        time.sleep(latency.pinecone)
+        with self._lock:
+            space = self._records.setdefault(namespace, {})
+            for record in records:
+                space[record["_id"]] = dict(record)
+
+    def search(self, namespace: str, query: Dict[str, Any], fields: List[str], **kwargs) -> FakeSearchResponse:
+        time.sleep(latency.pinecone)
+        words = set(query["inputs"]["text"].lower().split())
+        conditions = query.get("filter") or {}
+        with self._lock:
+            records = list(self._records.get(namespace, {}).values())
+        hits = []
+        for record in records:
+            if any(record.get(field) != condition.get("$eq") for field, condition in conditions.items()):
+                continue
+            text_words = set(str(record.get("text", "")).lower().split())
+            score = len(words & text_words) / max(len(words), 1)
+            hits.append(FakeHit(record, score, fields))
+        hits.sort(key=lambda hit: (-hit._score, hit["_id"]))
+        return FakeSearchResponse(hits[:query.get("top_k", 10)])
+
+    def upsert(self, vectors: List[Dict[str, Any]], namespace: str, **kwargs):
+        time.sleep(latency.pinecone)
+        with self._lock:
+            space = self._records.setdefault(namespace, {})
+            for vector in vectors:
+                space[vector["id"]] = dict(vector)
+
+    def query(self, vector: List[float], top_k: int, namespace: str, filter: Optional[Dict[str, Any]] = None, **kwargs):
+        time.sleep(latency.pinecone)
+        with self._lock:
+            records = list(self._records.get(namespace, {}).values())
+        matches = []
+        for record in records:
+            metadata = record.get("metadata") or {}
+            if any(metadata.get(field) != condition.get("$eq") for field, condition in (filter or {}).items()):
+                continue
+            matches.append(FakeMatch(record, sum(a * b for a, b in zip(vector, record["values"]))))
+        matches.sort(key=lambda match: (-match.score, match.id))
+        return type("QueryResponse", (), {"matches": matches[:top_k]})()
+
+
+class FakePinecone:
+    _indexes: Dict[str, FakeIndex] = {}
+    _lock = threading.Lock()
+
+    def __init__(self, api_key: Optional[str] = None, **kwargs):
+        pass
+
+    def Index(self, name: str, **kwargs) -> FakeIndex:
+        with self._lock:
+            return self._indexes.setdefault(name, FakeIndex(name))
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeRequests:
+    """
+    Stand-in for the requests module in tools.my_details, serving a small fixed document.
+    """
+
+    @staticmethod
+    def get(url: str, *args, **kwargs) -> FakeResponse:
+        time.sleep(latency.doc)
+        return FakeResponse(
+            "<html><body><p>I make videos about cameras and travel.</p><p>Currently filming in the mountains.</p>"
+            "<table><tr><th>Plan</th><th>When</th></tr><tr><td>New studio</td><td>Next year</td></tr></table></body></html>"
+        )
+
+
+class FakePostgresError(Exception):
+    pass
+
+
+# Syntax PostgreSQL does not understand, including placeholders the backend did not translate
+SQLITE_ONLY_SQL = re.compile(r"\?|\bPRAGMA\b|\browid\b|\bINSERT\s+OR\b|\bAUTOINCREMENT\b|\bBEGIN\s+IMMEDIATE\b", re.IGNORECASE)
+POSTGRES_TYPES = {"BIGSERIAL PRIMARY KEY": "INTEGER PRIMARY KEY AUTOINCREMENT", "DOUBLE PRECISION": "REAL", "BYTEA": "BLOB"}
+
+
+class FakePostgresCursor:
+    def __init__(self, connection: "FakePostgresConnection", name: Optional[str] = None):
+        self.connection = connection
+        # Named cursors keep their result on the server and are read itersize rows at a time
+        self.name = name
+        self.itersize = 100
+        self._cursor = connection.sqlite.cursor()
+        self._rows: Optional[List[tuple]] = None
+
+    @property
+    def rowcount(self) -> int:
+        return len(self._rows) if self._rows is not None else self._cursor.rowcount
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def execute(self, query: str, params: Sequence = ()):
+        self._rows = None
+        statement = " ".join(query.split())
+        server = self.connection.server
+        if statement == "SELECT 1 FROM pg_database WHERE datname = %s":
+            self._rows = [(1,)] if server.exists(params[0]) else []
+        elif statement.startswith("CREATE DATABASE "):
+            if not self.connection.autocommit:
+                raise FakePostgresError("CREATE DATABASE cannot run inside a transaction block")
+            server.create(statement[len("CREATE DATABASE "):].strip('"'))
+        elif statement == "SELECT pg_advisory_xact_lock(hashtext(%s))":
+            # SQLite has one lock per database, held until the transaction ends like the advisory lock
+            if not self.connection.sqlite.in_transaction:
+                self._cursor.execute("BEGIN IMMEDIATE")
+            self._rows = [(None,)]
+        else:
+            self._cursor.execute(server.translate(query), params)
+        return self
+
+    def executemany(self, query: str, params_seq):
+        self._rows = None
+        self._cursor.executemany(self.connection.server.translate(query), params_seq)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else (None if self._rows is not None else self._cursor.fetchone())
+
+    def fetchmany(self, size: int) -> List[tuple]:
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self) -> List[tuple]:
+        if self._rows is not None:
+            rows, self._rows = self._rows, []
+            return rows
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+
+class FakePostgresConnection:
+    def __init__(self, server: "FakePostgres", path: str):
+        self.server = server
+        self.sqlite = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._autocommit = False
+
+    @property
+    def autocommit(self) -> bool:
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value: bool):
+        self._autocommit = value
+        self.sqlite.isolation_level = None if value else ""
+
+    def cursor(self, name: Optional[str] = None) -> FakePostgresCursor:
+        return FakePostgresCursor(self, name)
+
+    def commit(self):
+        self.sqlite.commit()
+
+    def rollback(self):
+        self.sqlite.rollback()
+
+    def close(self):
+        self.sqlite.close()
+
+
+class FakePostgres:
+    """
+    A PostgreSQL server for PostgresBackend(url, connection_factory=FakePostgres(directory)), keeping each
+    database in a SQLite file of the directory. Like a real server it refuses connections to databases that
+    were not created and rejects SQLite-only syntax, so queries the backend does not translate fail here too.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.created: List[str] = []
+        self._databases = {"postgres"}
+        self._lock = threading.Lock()
+
+    def __call__(self, conninfo: str) -> FakePostgresConnection:
+        database = urlsplit(conninfo).path.strip("/")
+        if not self.exists(database):
+            raise FakePostgresError(f'database "{database}" does not exist')
+        return FakePostgresConnection(self, os.path.join(self.directory, f"{database}.postgres.db"))
+
+    def exists(self, database: str) -> bool:
+        with self._lock:
+            return database in self._databases
+
+    def create(self, database: str):
+        with self._lock:
+            if database in self._databases:
+                raise FakePostgresError(f'database "{database}" already exists')
+            self._databases.add(database)
+            self.created.append(database)
+
+    @staticmethod
+    def translate(query: str) -> str:
+        if SQLITE_ONLY_SQL.search(query):
+            raise FakePostgresError(f"Not a PostgreSQL query: {' '.join(query.split())}")
+        for postgres_type, sqlite_type in POSTGRES_TYPES.items():
+            query = query.replace(postgres_type, sqlite_type)
+        return query.replace("%s", "?").replace("%%", "%")
+
+
+fake_model = FakeChatModel()
+
+
+def install_fakes():
+    """
+    Points every external service the server uses at its local stand-in.
+    Must run before the application modules are imported.
+    """
+    os.environ.setdefault("OPENAI_API_KEY", "offline")
+    os.environ.setdefault("PINECONE_API_KEY", "offline")
+    os.environ.setdefault("GOOGLE_API_KEY", "offline")
+
+    import pinecone
+    import youtube_transcript_api
+    import config.client
+    import config.gemini_config
+
+    pinecone.Pinecone = FakePinecone
+    youtube_transcript_api.YouTubeTranscriptApi = FakeYouTubeTranscriptApi
+    # Keep the metrics, tracing and usage callbacks of the real model, their cost is part of what we measure
+    fake_model.callbacks = config.client.get_model().callbacks
+    config.client.set_model(fake_model)
+    config.gemini_config.generate = fake_generate
+
+    import services.embeddings
+    import services.context_window
+    services.embeddings.set_embedding_model(FakeEmbeddingModel())
+    services.context_window.set_encoding(FakeEncoding())
+
+    import tools.my_details
+    import tools.transcript
+    tools.my_details.requests = FakeRequests
+    tools.transcript.TokenTextSplitter = FakeTokenTextSplitter
+    tools.transcript.YouTubeTranscriptApi = FakeYouTubeTranscriptApi
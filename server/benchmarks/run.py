@@ -0,0 +1,195 @@
+# Offline benchmarks of the server's hot paths against the stand-ins in benchmarks/fakes.py.
+# Run from the server directory:
+#   python -m benchmarks.run --scenario all --requests 200 --concurrency 8
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Callable, Dict, List
+
+from benchmarks.fakes import FakePostgres, install_fakes, latency
+
+SCENARIOS = ("chat", "load_data", "retrieve", "personality")
+
+
+@dataclass
+class BenchmarkResult:
+    scenario: str
+    requests: int
+    concurrency: int
+    errors: int
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p99_ms: float
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_benchmark(name: str, operation: Callable[[int], None], requests: int, concurrency: int) -> BenchmarkResult:
+    """
+    Calls operation(i) for i in range(requests) from concurrency threads and measures each call.
+    """
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(i: int):
+        nonlocal errors
+        start = time.perf_counter()
+        failed = False
+        try:
+            operation(i)
+        except Exception as e:
+            failed = True
+            print(f"[{name}] request {i} failed: {e}")
+        elapsed = time.perf_counter() - start
+        with lock:
+            latencies.append(elapsed)
+            errors += failed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(timed, range(requests)))
+    seconds = time.perf_counter() - start
+
+    latencies.sort()
+    return BenchmarkResult(
+        scenario=name,
+        requests=requests,
+        concurrency=concurrency,
+        errors=errors,
+        seconds=round(seconds, 3),
+        throughput=round(requests / seconds, 1) if seconds else 0.0,
+        p50_ms=round(percentile(latencies, 0.50) * 1000, 2),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+    )
+
+
+def _check(response):
+    # The endpoints report their failures in a 200 response
+    response.raise_for_status()
+    body = response.json()
+    if isinstance(body, dict) and str(body.get("message", "")).startswith("Error"):
+        raise RuntimeError(body["message"])
+
+
+def build_scenarios(args) -> Dict[str, Callable[[int], None]]:
+    # Imported only now, after the fakes are installed
+    from fastapi.testclient import TestClient
+    from app import app
+    from database.user_db import create_user_table, set_user_tier
+    from database.messages_db import create_chat_messages_table
+    from services.process_user_message import handle_chat_message
+    from tools.get_details import get_personality
+
+    create_user_table()
+    create_chat_messages_table()
+    # Measure the whole workflow instead of rate limit rejections
+    for user in range(args.users):
+        set_user_tier(f"bench-user-{user}", "internal")
+    local = threading.local()
+
+    def client() -> TestClient:
+        if not hasattr(local, "client"):
+            local.client = TestClient(app)
+        return local.client
+
+    creator_id = "bench-creator"
+    videos = [f"bench-video-{i}" for i in range(args.videos)]
+
+    def chat(i: int):
+        handle_chat_message(f"bench-user-{i % args.users}", f"Benchmark message {i}", args.summarization_threshold)
+
+    def load_data(i: int):
+        response = client().post("/load_data", params={"creator_id": creator_id}, json={"video_id": [f"bench-load-{i}"]})
+        _check(response)
+
+    def retrieve(i: int):
+        response = client().get("/retrieve_pinecone_data", params={"creator_id": creator_id, "search_query": f"camera story {i % 10}"})
+        _check(response)
+
+    def personality(i: int):
+        get_personality(videos, mode=args.mode, creator_id=creator_id)
+
+    scenarios = {"chat": chat, "load_data": load_data, "retrieve": retrieve, "personality": personality}
+    # Retrieval and personality runs need loaded videos
+    for video_id in videos:
+        _check(client().post("/load_data", params={"creator_id": creator_id}, json={"video_id": [video_id]}))
+    return scenarios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the server's hot paths without calling any external service.")
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight at the same time.")
+    parser.add_argument("--users", type=int, default=50, help="Distinct users in the chat scenario.")
+    parser.add_argument("--videos", type=int, default=3, help="Videos loaded for the retrieve and personality scenarios.")
+    parser.add_argument("--summarization-threshold", type=int, default=10)
+    parser.add_argument("--mode", choices=("agent", "batched"), default="batched", help="Personality extraction mode.")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Simulated seconds per LLM call.")
+    parser.add_argument("--pinecone-latency", type=float, default=0.0, help="Simulated seconds per Pinecone call.")
+    parser.add_argument("--transcript-latency", type=float, default=0.0, help="Simulated seconds per transcript fetch.")
+    parser.add_argument("--doc-latency", type=float, default=0.0, help="Simulated seconds per document fetch.")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Simulated seconds per local embedding batch.")
+    parser.add_argument("--embeddings", choices=("pinecone", "local"), default="pinecone",
+                        help="Where dense embeddings are computed (EMBEDDING_BACKEND).")
+    parser.add_argument("--hot-index", action="store_true",
+                        help="Serve the searches of creators from the in-memory index (HOT_INDEX, needs --embeddings local).")
+    parser.add_argument("--backend", choices=("sqlite", "postgres"), default="sqlite",
+                        help="Storage backend, postgres keeps the databases on a local stand-in of a PostgreSQL server.")
+    parser.add_argument("--workdir", help="Directory for the SQLite files, a fresh temporary one by default.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON lines.")
+    args = parser.parse_args()
+
+    latency.llm, latency.pinecone = args.llm_latency, args.pinecone_latency
+    latency.transcript, latency.doc = args.transcript_latency, args.doc_latency
+    latency.embedding = args.embedding_latency
+    os.environ["EMBEDDING_BACKEND"] = args.embeddings
+    if args.hot_index:
+        os.environ.update(HOT_INDEX="on", HOT_INDEX_MIN_SEARCHES="1")
+    # The databases are created relative to the working directory, keep them out of the repository
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="creator-twin-bench-"))
+    # Per-request logs would drown the results
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    install_fakes()
+    postgres = None
+    if args.backend == "postgres":
+        from database.backend import PostgresBackend, set_backend
+        postgres = FakePostgres(os.getcwd())
+        set_backend(PostgresBackend("postgresql://bench@localhost:5432", connection_factory=postgres))
+
+    scenarios = build_scenarios(args)
+    names = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = [run_benchmark(name, scenarios[name], args.requests, args.concurrency) for name in names]
+
+    if args.json:
+        for result in results:
+            print(json.dumps(asdict(result)))
+        return
+    if postgres:
+        # The buffered writes go to their databases too
+        from serve import flush_buffers
+        flush_buffers()
+        print(f"\nPostgreSQL databases created on first use: {', '.join(postgres.created)}")
+    print(f"\n{'scenario':<12} {'requests':>8} {'conc':>5} {'errors':>6} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9}")
+    for result in results:
+        print(f"{result.scenario:<12} {result.requests:>8} {result.concurrency:>5} {result.errors:>6} "
+              f"{result.throughput:>9} {result.p50_ms:>9} {result.p99_ms:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,47 @@
-from langchain_openai import ChatOpenAI
-from dotenv import load_dotenv
 import os
+import threading
+from dotenv import load_dotenv
+from services.llm_scheduler import LLMSchedulerCallback
+from services.metrics import LLMMetricsCallback
+from services.tracing import tracing_callback
+from services.usage import UsageCallback
 
 load_dotenv()
 
 api_key = os.getenv("OPENAI_API_KEY")
+# The OpenAI SDK retries rate limits, server errors and timeouts itself with exponential backoff
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", "60"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model():
+    """
+    Returns the shared chat model, creating it on first use.
+    langchain_openai takes a large share of the import time, so processes that never call the model never load it.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from langchain_openai import ChatOpenAI
+                _model = ChatOpenAI(
+                    api_key=api_key,
+                    model="gpt-4o-mini",
+                    temperature=0.5,
+                    timeout=OPENAI_TIMEOUT_SECONDS,
+                    max_retries=OPENAI_MAX_RETRIES,
+                    # The scheduler comes first, calls it sheds never reach the other callbacks
+                    callbacks=[LLMSchedulerCallback("openai"), LLMMetricsCallback("openai"), tracing_callback, UsageCallback("openai")]
+                )
+    return _model
+
 
-model = ChatOpenAI(
-    api_key=api_key,
-    model="gpt-4o-mini",
-    temperature=0.5
-)
+def set_model(model):
+    """
+    Replaces the shared chat model, e.g. with a local stand-in for benchmarks.
+    """
+    global _model
+    _model = model
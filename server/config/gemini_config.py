@@ -1,18 +1,42 @@
 from dotenv import load_dotenv
 import os
-from google import genai
-from google.genai import types
+import time
+from functools import lru_cache
+from opentelemetry.trace import SpanKind
+from services.llm_scheduler import llm_scheduler
+from services.metrics import LLM_REQUEST_SECONDS
+from services.resilience import Upstream
+from services.tracing import span
+from services.usage import usage_tracker
 
 load_dotenv()
 userdata = {
     'GOOGLE_API_KEY': os.getenv('GOOGLE_API_KEY'),
 }
 
+# Answers grounded with Google Search take a while, but a stalled stream must not hold a worker forever
+GEMINI_TIMEOUT_SECONDS = float(os.getenv("GEMINI_TIMEOUT_SECONDS", "120"))
+gemini_upstream = Upstream("gemini", timeout=GEMINI_TIMEOUT_SECONDS, max_concurrency=8)
+# Output tokens assumed for the scheduler's token budget, thinking included, until the usage is reported
+GEMINI_ESTIMATED_OUTPUT_TOKENS = 1024
 
-def generate(text):
-    client = genai.Client(
+
+@lru_cache(maxsize=None)
+def get_client():
+    """
+    Returns the Gemini client, importing the SDK and creating the client on first use only.
+    """
+    from google import genai
+    from google.genai import types
+    return genai.Client(
          api_key= userdata.get('GOOGLE_API_KEY'),
+         http_options=types.HttpOptions(timeout=int(GEMINI_TIMEOUT_SECONDS * 1000)),
     )
+
+
+def generate(text):
+    from google.genai import types
+    client = get_client()
     model = "gemini-2.5-flash-lite"
     contents = [
         types.Content(
@@ -33,11 +57,35 @@ def generate(text):
         tools=tools,
     )
 
-    generated_text = ""
-    for chunk in client.models.generate_content_stream(
-        model=model,
-        contents=contents,
-        config=generate_content_config,
-    ):
-        generated_text += chunk.text
+    def stream():
+        # One attempt, a retry streams the whole answer again
+        generated_text = ""
+        usage = None
+        start = time.perf_counter()
+        status = "error"
+        try:
+            with span(f"llm {model}", attributes={"gen_ai.system": "gemini", "gen_ai.request.model": model}, kind=SpanKind.CLIENT):
+                for chunk in client.models.generate_content_stream(
+                    model=model,
+                    contents=contents,
+                    config=generate_content_config,
+                ):
+                    generated_text += chunk.text
+                    # Each chunk reports the running totals, the last one covers the whole response
+                    usage = chunk.usage_metadata or usage
+            status = "ok"
+        finally:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - start, provider="gemini", model=model, status=status)
+        return generated_text, usage
+
+    # The context window module imports the LangChain message types, only needed once a model runs
+    from services.context_window import count_tokens
+    # Waits for admission in the priority class of the caller, retries keep the admission
+    with llm_scheduler.slot("gemini", count_tokens(text) + GEMINI_ESTIMATED_OUTPUT_TOKENS) as admission:
+        generated_text, usage = gemini_upstream.call(stream)
+        if usage is not None:
+            # Thinking tokens are billed as output
+            completion_tokens = (usage.candidates_token_count or 0) + (getattr(usage, "thoughts_token_count", None) or 0)
+            usage_tracker.record("gemini", model, usage.prompt_token_count or 0, completion_tokens)
+            admission["used_tokens"] = (usage.prompt_token_count or 0) + completion_tokens
     return generated_text
@@ -0,0 +1,30 @@
+import logging
+import os
+from dotenv import load_dotenv
+from services.tracing import request_id
+
+load_dotenv()
+
+
+class RequestIdFilter(logging.Filter):
+    """
+    Adds the id of the request being served to every log record, "-" outside of requests.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id.get() or "-"
+        return True
+
+
+def setup_logging():
+    """
+    Configures leveled logging for the application. LOG_LEVEL selects the level, INFO by default;
+    DEBUG also shows every database and Pinecone call. Every line carries the request id.
+    """
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s [%(request_id)s]: %(message)s"
+    )
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(existing, RequestIdFilter) for existing in handler.filters):
+            handler.addFilter(RequestIdFilter())
@@ -1,20 +1,67 @@
-import sqlite3
-from typing import List
+import logging
+import threading
+from functools import lru_cache
+from typing import Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from dotenv import load_dotenv
-from pinecone import Pinecone
 import os
+from services.resilience import Upstream
+
+logger = logging.getLogger(__name__)
 
 load_dotenv()
 
+# Not every Pinecone SDK version takes a timeout, so calls are abandoned by the upstream guard instead
+PINECONE_TIMEOUT_SECONDS = float(os.getenv("PINECONE_TIMEOUT_SECONDS", "15"))
+pinecone_upstream = Upstream("pinecone", timeout=PINECONE_TIMEOUT_SECONDS, hard_timeout=True)
+# Dense index of precomputed vectors, used instead of the 'character' index with EMBEDDING_BACKEND=local.
+# Its dimension must match LOCAL_EMBEDDING_MODEL, e.g. 384 with the cosine metric for bge-small-en-v1.5.
+PINECONE_LOCAL_DENSE_INDEX = os.getenv("PINECONE_LOCAL_DENSE_INDEX", "character-local")
+# Vectors per upsert request, keeping requests well below Pinecone's 2 MB limit
+PINECONE_UPSERT_BATCH_SIZE = 100
+
 class Settings(BaseSettings):
     pinecone_namespace: str = "default"
     pinecone_top_k: int = 10
     pinecone_api_key: str
 
-try:
-    settings = Settings(pinecone_api_key=os.getenv("PINECONE_API_KEY"))
-except Exception as e:
-    print(f"Error loading settings: {e}")
-    print("Please ensure 'PINECONE_API_KEY' is in .env file.")
-    settings = None
+
+@lru_cache(maxsize=None)
+def get_settings() -> Optional[Settings]:
+    """
+    Loads the Pinecone settings on first use.
+
+    Returns:
+        Optional[Settings]: The settings, None if the API key is missing.
+    """
+    try:
+        return Settings(pinecone_api_key=os.getenv("PINECONE_API_KEY"))
+    except Exception as e:
+        logger.error("Error loading settings: %s", e)
+        logger.error("Please ensure 'PINECONE_API_KEY' is in .env file.")
+        return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_pinecone_client():
+    """
+    Returns the shared Pinecone client, importing the SDK and creating the client on first use.
+    The client keeps its connection pool, so searches after the first skip the connection setup.
+
+    Returns:
+        The Pinecone client, None if the settings are not loaded.
+    """
+    global _client
+    if _client is None:
+        settings = get_settings()
+        if not settings:
+            return None
+        with _client_lock:
+            if _client is None:
+                from pinecone import Pinecone
+                _client = Pinecone(api_key=settings.pinecone_api_key)
+                logger.debug("Pinecone client initialized.")
+    return _client
@@ -0,0 +1,235 @@
+import logging
+from typing import Optional, Tuple
+from database.backend import get_backend
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_cache_table")
+def create_cache_table(db_name: str = 'shared_cache.db', table_name: str = 'cache_entries'):
+    """
+    Creates the table of cached values shared by every worker process, one row per namespace and key.
+
+    Args:
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            if backend.name == "sqlite":
+                # Readers in other processes are not blocked while one process writes an entry
+                cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    namespace TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    cache_value TEXT NOT NULL,
+                    created_at {backend.double} NOT NULL,
+                    expires_at {backend.double},
+                    PRIMARY KEY (namespace, cache_key)
+                )
+            ''')
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_created ON {table_name} (namespace, created_at)")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_cache_entry")
+def get_cache_entry(namespace: str, key: str, now: float, db_name: str = 'shared_cache.db', table_name: str = 'cache_entries') -> Optional[str]:
+    """
+    Returns a cached value that has not expired.
+
+    Args:
+        namespace (str): The namespace of the cache, e.g. "personality".
+        key (str): The key of the entry within the namespace.
+        now (float): The current timestamp, entries that expired before it are ignored.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        Optional[str]: The serialized value, None if there is no live entry. Errors are raised.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(backend.sql(f'''
+            SELECT cache_value FROM {table_name}
+            WHERE namespace = ? AND cache_key = ? AND (expires_at IS NULL OR expires_at > ?)
+        '''), (namespace, key, now))
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@DB_OPERATION_SECONDS.timed(operation="store_cache_entry")
+def store_cache_entry(namespace: str, key: str, value: str, now: float, expires_at: Optional[float],
+                      db_name: str = 'shared_cache.db', table_name: str = 'cache_entries'):
+    """
+    Stores a value, replacing an earlier entry of the same key. Errors are raised.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        key (str): The key of the entry within the namespace.
+        value (str): The serialized value.
+        now (float): The current timestamp.
+        expires_at (Optional[float]): When the entry expires, never if None.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(backend.sql(f'''
+            INSERT INTO {table_name} (namespace, cache_key, cache_value, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (namespace, cache_key) DO UPDATE SET
+                cache_value = excluded.cache_value,
+                created_at = excluded.created_at,
+                expires_at = excluded.expires_at
+        '''), (namespace, key, value, now, expires_at))
+        conn.commit()
+
+
+@DB_OPERATION_SECONDS.timed(operation="delete_cache_entries")
+def delete_cache_entries(namespace: str, now: float, max_entries: Optional[int] = None, key: Optional[str] = None,
+                         db_name: str = 'shared_cache.db', table_name: str = 'cache_entries') -> int:
+    """
+    Deletes the expired entries of a namespace and, beyond max_entries, the oldest ones.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        now (float): The current timestamp.
+        max_entries (Optional[int]): The number of newest entries to keep, no limit if None.
+        key (Optional[str]): Deletes only this entry, whether expired or not.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        int: The number of deleted entries, 0 if an error occurs.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            if key is not None:
+                cursor.execute(backend.sql(f"DELETE FROM {table_name} WHERE namespace = ? AND cache_key = ?"), (namespace, key))
+                deleted = cursor.rowcount
+            else:
+                cursor.execute(backend.sql(f"DELETE FROM {table_name} WHERE namespace = ? AND expires_at <= ?"), (namespace, now))
+                deleted = cursor.rowcount
+                if max_entries is not None:
+                    cursor.execute(backend.sql(f'''
+                        DELETE FROM {table_name}
+                        WHERE namespace = ? AND cache_key NOT IN (
+                            SELECT cache_key FROM {table_name} WHERE namespace = ? ORDER BY created_at DESC LIMIT ?
+                        )
+                    '''), (namespace, namespace, max_entries))
+                    deleted += cursor.rowcount
+            conn.commit()
+            return deleted
+
+    except Exception as e:
+        logger.error("An error occurred during cache cleanup: %s", e)
+        return 0
+
+
+@DB_OPERATION_SECONDS.timed(operation="claim_cache_lease")
+def claim_cache_lease(namespace: str, key: str, token: str, now: float, expires_at: float,
+                      db_name: str = 'shared_cache.db', table_name: str = 'cache_entries') -> bool:
+    """
+    Claims the lease of computing an entry, unless another process holds an unexpired lease of it.
+    Leases are rows of the namespace suffixed with ".lease". Errors are raised.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        key (str): The key of the entry being computed.
+        token (str): Identifies the holder, so only it releases the lease.
+        now (float): The current timestamp.
+        expires_at (float): When the lease expires if the holder never releases it, e.g. because it crashed.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        bool: Whether the lease was claimed.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(backend.sql(f'''
+            INSERT INTO {table_name} (namespace, cache_key, cache_value, created_at, expires_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (namespace, cache_key) DO UPDATE SET
+                cache_value = excluded.cache_value,
+                created_at = excluded.created_at,
+                expires_at = excluded.expires_at
+            WHERE {table_name}.expires_at <= ?
+        '''), (f"{namespace}.lease", key, token, now, expires_at, now))
+        claimed = cursor.rowcount == 1
+        conn.commit()
+    return claimed
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_cache_entry_and_lease")
+def get_cache_entry_and_lease(namespace: str, key: str, now: float, db_name: str = 'shared_cache.db',
+                              table_name: str = 'cache_entries') -> Tuple[Optional[str], Optional[float]]:
+    """
+    Returns a cached value that has not expired and when the lease of computing it expires, in one read.
+    Processes waiting for another one to compute an entry poll with this instead of claiming the lease.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        key (str): The key of the entry.
+        now (float): The current timestamp, entries that expired before it are ignored.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        Tuple[Optional[str], Optional[float]]: The serialized value, None if there is no live entry, and the
+                                               expiry of the lease, None if nobody holds one. Errors are raised.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(backend.sql(f'''
+            SELECT namespace, cache_value, expires_at FROM {table_name}
+            WHERE namespace IN (?, ?) AND cache_key = ?
+        '''), (namespace, f"{namespace}.lease", key))
+        rows = cursor.fetchall()
+    value, lease_expires_at = None, None
+    for row_namespace, cache_value, expires_at in rows:
+        if row_namespace != namespace:
+            lease_expires_at = expires_at
+        elif expires_at is None or expires_at > now:
+            value = cache_value
+    return value, lease_expires_at
+
+
+@DB_OPERATION_SECONDS.timed(operation="release_cache_lease")
+def release_cache_lease(namespace: str, key: str, token: str, db_name: str = 'shared_cache.db', table_name: str = 'cache_entries'):
+    """
+    Releases a lease claimed with claim_cache_lease, if it is still held by token.
+
+    Args:
+        namespace (str): The namespace of the cache.
+        key (str): The key of the entry being computed.
+        token (str): The token the lease was claimed with.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(backend.sql(f"DELETE FROM {table_name} WHERE namespace = ? AND cache_key = ? AND cache_value = ?"),
+                           (f"{namespace}.lease", key, token))
+            conn.commit()
+
+    except Exception as e:
+        logger.error("An error occurred while releasing a cache lease: %s", e)
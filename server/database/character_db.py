@@ -1,85 +1,107 @@
-import sqlite3
-from tools.transcript import video_to_chunks
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from database.backend import get_backend
+from tools.transcript import fetch_transcript_or_raise, video_to_chunks, TranscriptError
+from services.metrics import DB_OPERATION_SECONDS
 
-def store_video_chunks_in_db(video_id: str = "iv-5mZ_9CPY", db_name: str = 'video_chunks.db', table_name: str = 'chunks'):
+logger = logging.getLogger(__name__)
+
+
+def _insertion_order(backend, alias: str) -> str:
+    # SQLite numbers rows in insertion order on its own, older chunk tables have no id column
+    return f"{alias}.rowid" if backend.name == "sqlite" else f"{alias}.id"
+
+
+@DB_OPERATION_SECONDS.timed(operation="store_video_chunks_in_db")
+def store_video_chunks_in_db(video_id: str = "iv-5mZ_9CPY", db_name: str = 'video_chunks.db', table_name: str = 'chunks') -> Optional[List[Dict[str, Any]]]:
     """
-    Fetches video transcript chunks and stores them in an SQLite database.
+    Fetches video transcript chunks and stores them in the database.
     Checks if chunks for the video ID already exist before inserting.
 
     Args:
         video_id (str): The ID of the YouTube video.
-        db_name (str): The name of the SQLite database file.
+        db_name (str): The name of the database.
         table_name (str): The name of the table within the database.
+
+    Returns:
+        Optional[List[Dict[str, Any]]]: The fetched transcript snippets, for further processing without
+                                        fetching them again. None if the chunks were already stored.
+
+    Raises:
+        TranscriptError: The transcript could not be fetched, nothing is stored.
     """
-    conn = None
+    backend = get_backend()
+    transcript = None
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                video_id TEXT,
-                chunk_text TEXT
-            )
-        ''')
-        print(f"Table '{table_name}' created or already exists.")
-
-        cursor.execute(f"SELECT COUNT(*) FROM {table_name} WHERE video_id = ?", (video_id,))
-        count = cursor.fetchone()[0]
-
-        if count > 0:
-            print(f"Chunks for video ID: {video_id} already exist. Skipping insertion.")
-        else:
-            chunks_data = video_to_chunks(video_id)
-            print(f"Number of chunks retrieved: {len(chunks_data)}")
-
-            for chunk in chunks_data:
-                cursor.execute(f'''
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    id {backend.serial_pk},
+                    video_id TEXT,
+                    chunk_text TEXT
+                )
+            ''')
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_video ON {table_name} (video_id)")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
+
+            cursor.execute(backend.sql(f"SELECT COUNT(*) FROM {table_name} WHERE video_id = ?"), (video_id,))
+            count = cursor.fetchone()[0]
+
+            if count > 0:
+                logger.debug("Chunks for video ID: %s already exist. Skipping insertion.", video_id)
+            else:
+                transcript = fetch_transcript_or_raise(video_id)
+                chunks_data = video_to_chunks(video_id, transcript)
+                logger.debug("Number of chunks retrieved: %s", len(chunks_data))
+
+                cursor.executemany(backend.sql(f'''
                     INSERT INTO {table_name} (video_id, chunk_text)
                     VALUES (?, ?)
-                ''', (video_id, chunk))
-            conn.commit()
-            print(f"Inserted {len(chunks_data)} chunks for video ID: {video_id}")
+                '''), [(video_id, chunk) for chunk in chunks_data])
+                conn.commit()
+                logger.debug("Inserted %s chunks for video ID: %s", len(chunks_data), video_id)
 
+    except TranscriptError:
+        raise
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
+    return transcript
 
 
 
+@DB_OPERATION_SECONDS.timed(operation="create_video_creator_table")
 def create_video_creator_table(db_name: str = 'video_chunks.db', table_name: str = 'video_creators'):
     """
-    Creates a table to store video IDs and creator IDs in an SQLite database.
+    Creates a table to store video IDs and creator IDs in the database.
 
     Args:
-        db_name (str): The name of the SQLite database file.
+        db_name (str): The name of the database.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                video_id TEXT PRIMARY KEY,
-                creator_id TEXT
-            )
-        ''')
-        print(f"Table '{table_name}' created or already exists.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    video_id TEXT PRIMARY KEY,
+                    creator_id TEXT
+                )
+            ''')
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_creator ON {table_name} (creator_id)")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
+@DB_OPERATION_SECONDS.timed(operation="insert_video_creator")
 def insert_video_creator(video_id: str, creator_id: str, db_name: str = 'video_chunks.db', table_name: str = 'video_creators'):
     """
     Inserts a video ID and creator ID into the video_creators table.
@@ -88,25 +110,92 @@ def insert_video_creator(video_id: str, creator_id: str, db_name: str = 'video_c
     Args:
         video_id (str): The ID of the YouTube video.
         creator_id (str): The ID of the creator.
-        db_name (str): The name of the SQLite database file.
+        db_name (str): The name of the database.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                INSERT INTO {table_name} (video_id, creator_id)
+                VALUES (?, ?)
+                ON CONFLICT (video_id) DO NOTHING
+            '''), (video_id, creator_id))
+            conn.commit()
+            logger.debug("Inserted video ID: %s with creator ID: %s (if not already exists).", video_id, creator_id)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+@DB_OPERATION_SECONDS.timed(operation="get_video_chunks")
+def get_video_chunks(video_id: str, db_name: str = 'video_chunks.db', table_name: str = 'chunks',
+                     creator_table_name: str = 'video_creators') -> Tuple[Optional[str], List[str]]:
+    """
+    Retrieves the creator and the transcript chunks of a video, in the order they were stored.
+
+    Args:
+        video_id (str): The ID of the YouTube video.
+        db_name (str): The name of the database.
+        table_name (str): The name of the chunks table within the database.
+        creator_table_name (str): The name of the table mapping videos to creators.
+
+    Returns:
+        Tuple[Optional[str], List[str]]: The creator ID, None if the video has none, and the chunk texts,
+                                         empty if there are none. Errors are raised.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
         cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
+        cursor.execute(backend.sql(f"SELECT creator_id FROM {creator_table_name} WHERE video_id = ?"), (video_id,))
+        creator_row = cursor.fetchone()
+        if not creator_row:
+            return None, []
+        cursor.execute(backend.sql(f'''
+            SELECT c.chunk_text FROM {table_name} c
+            WHERE c.video_id = ?
+            ORDER BY {_insertion_order(backend, "c")}
+        '''), (video_id,))
+        return creator_row[0], [row[0] for row in cursor.fetchall()]
+
+@DB_OPERATION_SECONDS.timed(operation="get_creator_chunks")
+def get_creator_chunks(creator_id: str, db_name: str = 'video_chunks.db', table_name: str = 'chunks',
+                       creator_table_name: str = 'video_creators') -> List[Tuple[str, int, str]]:
+    """
+    Retrieves the transcript chunks of every video of a creator, numbered per video in insertion order
+    like the chunk_index of the Pinecone records.
 
-        cursor.execute(f'''
-            INSERT OR IGNORE INTO {table_name} (video_id, creator_id)
-            VALUES (?, ?)
-        ''', (video_id, creator_id))
-        conn.commit()
-        print(f"Inserted video ID: {video_id} with creator ID: {creator_id} (if not already exists).")
+    Args:
+        creator_id (str): The ID of the creator.
+        db_name (str): The name of the database.
+        table_name (str): The name of the chunks table within the database.
+        creator_table_name (str): The name of the table mapping videos to creators.
+
+    Returns:
+        List[Tuple[str, int, str]]: (video_id, chunk_index, chunk_text) rows, empty if an error occurs.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                SELECT c.video_id, c.chunk_text FROM {table_name} c
+                JOIN {creator_table_name} v ON v.video_id = c.video_id
+                WHERE v.creator_id = ?
+                ORDER BY c.video_id, {_insertion_order(backend, "c")}
+            '''), (creator_id,))
+            rows = []
+            chunk_index = 0
+            for video_id, chunk_text in cursor.fetchall():
+                chunk_index = chunk_index + 1 if rows and rows[-1][0] == video_id else 0
+                rows.append((video_id, chunk_index, chunk_text))
+            logger.debug("Retrieved %s chunks of creator ID: %s", len(rows), creator_id)
+            return rows
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
\ No newline at end of file
+        logger.error("An error occurred: %s", e)
+        return []
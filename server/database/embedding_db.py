@@ -0,0 +1,94 @@
+import logging
+import time
+from typing import Dict, List, Sequence, Tuple
+from database.backend import get_backend
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Keys per SELECT, below the bound parameter limit of older SQLite builds
+LOOKUP_BATCH_SIZE = 500
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_embedding_table")
+def create_embedding_table(db_name: str = 'embeddings.db', table_name: str = 'embeddings'):
+    """
+    Creates the table of locally computed embeddings, one row per model and text hash.
+
+    Args:
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            if backend.name == "sqlite":
+                # Worker processes read cached vectors while another one stores a batch
+                cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    model TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    vector {backend.blob} NOT NULL,
+                    created_at {backend.double} NOT NULL,
+                    PRIMARY KEY (model, text_hash)
+                )
+            ''')
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_embeddings")
+def get_embeddings(model: str, text_hashes: Sequence[str], db_name: str = 'embeddings.db',
+                   table_name: str = 'embeddings') -> Dict[str, bytes]:
+    """
+    Returns the cached embeddings of texts.
+
+    Args:
+        model (str): The embedding model the vectors were computed with.
+        text_hashes (Sequence[str]): The hashes of the texts.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        Dict[str, bytes]: The packed float32 vector by text hash, for the hashes that are cached. Errors are raised.
+    """
+    backend = get_backend()
+    found = {}
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        for start in range(0, len(text_hashes), LOOKUP_BATCH_SIZE):
+            batch = list(text_hashes[start:start + LOOKUP_BATCH_SIZE])
+            placeholders = ", ".join("?" for _ in batch)
+            cursor.execute(backend.sql(f"SELECT text_hash, vector FROM {table_name} WHERE model = ? AND text_hash IN ({placeholders})"),
+                           (model, *batch))
+            found.update((text_hash, bytes(vector)) for text_hash, vector in cursor.fetchall())
+    return found
+
+
+@DB_OPERATION_SECONDS.timed(operation="store_embeddings")
+def store_embeddings(model: str, vectors: List[Tuple[str, bytes]], db_name: str = 'embeddings.db', table_name: str = 'embeddings'):
+    """
+    Stores computed embeddings in one transaction, keeping rows that are already cached. Errors are raised.
+
+    Args:
+        model (str): The embedding model the vectors were computed with.
+        vectors (List[Tuple[str, bytes]]): (text hash, packed float32 vector) pairs.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    now = time.time()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.executemany(backend.sql(f'''
+            INSERT INTO {table_name} (model, text_hash, vector, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT (model, text_hash) DO NOTHING
+        '''), [(model, text_hash, vector, now) for text_hash, vector in vectors])
+        conn.commit()
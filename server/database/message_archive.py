@@ -0,0 +1,239 @@
+import json
+import logging
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import zstandard
+from database.backend import get_backend
+from database.sharding import all_shards, shard_for_user
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Archived messages of a user are packed in segments of about this many messages per month
+SEGMENT_TARGET_MESSAGES = 500
+# Incremental vacuum runs at most this often per database, freeing at most this many pages each time
+VACUUM_INTERVAL_SECONDS = 300
+VACUUM_PAGES = 2000
+
+_last_vacuum: Dict[str, float] = {}
+
+
+def _pack(rows: List[list]) -> bytes:
+    return zstandard.ZstdCompressor(level=3).compress(json.dumps(rows).encode("utf-8"))
+
+
+def _unpack(payload: bytes) -> List[list]:
+    return json.loads(zstandard.ZstdDecompressor().decompress(payload).decode("utf-8"))
+
+
+def _period(timestamp: float) -> str:
+    return time.strftime("%Y-%m", time.gmtime(timestamp))
+
+
+def create_archive_table(cursor: Any, table_name: str = 'chat_messages_archive'):
+    """
+    Creates the archive table on an open cursor. Each row holds a zstd packed segment of one user's
+    messages from one month, as a JSON list of [message_id, timestamp, message_content].
+    """
+    backend = get_backend()
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS {table_name} (
+            archive_id {backend.serial_pk},
+            user_id TEXT,
+            period TEXT,
+            message_count INTEGER,
+            first_timestamp {backend.double},
+            last_timestamp {backend.double},
+            payload {backend.blob}
+        )
+    ''')
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user ON {table_name} (user_id, archive_id)")
+    cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user_time ON {table_name} (user_id, first_timestamp, archive_id)")
+
+
+def archive_messages(cursor: Any, user_id: str, rows: List[Tuple[int, float, str]], table_name: str = 'chat_messages_archive'):
+    """
+    Packs messages into the user's archive segments, inside the caller's transaction.
+    Messages are added to the latest segment of their month until it reaches SEGMENT_TARGET_MESSAGES.
+    Segments hold their messages in chronological order and do not overlap, so reading them by their first
+    timestamp is chronological: messages older than the latest archived ones of their month, e.g. from an
+    import of old conversations, are merged into the month's segments, which are packed again.
+
+    Args:
+        cursor (Any): A database cursor in an open write transaction.
+        user_id (str): The unique identifier for the user.
+        rows (List[Tuple[int, float, str]]): The (message_id, timestamp, message_content) of each message.
+        table_name (str): The name of the archive table.
+    """
+    by_period: Dict[str, List[list]] = {}
+    for message_id, timestamp, content in sorted(rows, key=lambda row: (row[1], row[0])):
+        by_period.setdefault(_period(timestamp), []).append([message_id, timestamp, content])
+
+    backend = get_backend()
+    for period, messages in by_period.items():
+        cursor.execute(backend.sql(f'''
+            SELECT archive_id, message_count, last_timestamp, payload FROM {table_name}
+            WHERE user_id = ? AND period = ?
+            ORDER BY first_timestamp DESC, archive_id DESC LIMIT 1
+        '''), (user_id, period))
+        segment = cursor.fetchone()
+        if segment and messages[0][1] < segment[2]:
+            _repack_period(cursor, user_id, period, messages, table_name)
+        elif segment and segment[1] < SEGMENT_TARGET_MESSAGES:
+            messages = _unpack(segment[3]) + messages
+            cursor.execute(backend.sql(f'''
+                UPDATE {table_name}
+                SET message_count = ?, first_timestamp = ?, last_timestamp = ?, payload = ?
+                WHERE archive_id = ?
+            '''), (len(messages), messages[0][1], messages[-1][1], _pack(messages), segment[0]))
+        else:
+            _insert_segments(cursor, user_id, period, messages, table_name)
+
+
+def _insert_segments(cursor: Any, user_id: str, period: str, messages: List[list], table_name: str):
+    backend = get_backend()
+    cursor.executemany(backend.sql(f'''
+        INSERT INTO {table_name} (user_id, period, message_count, first_timestamp, last_timestamp, payload)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''), [
+        (user_id, period, len(chunk), chunk[0][1], chunk[-1][1], _pack(chunk))
+        for chunk in (messages[start:start + SEGMENT_TARGET_MESSAGES] for start in range(0, len(messages), SEGMENT_TARGET_MESSAGES))
+    ])
+
+
+def _repack_period(cursor: Any, user_id: str, period: str, messages: List[list], table_name: str):
+    # Rare, only for messages arriving out of order, so rewriting the month's segments is affordable
+    backend = get_backend()
+    cursor.execute(backend.sql(f"SELECT archive_id, payload FROM {table_name} WHERE user_id = ? AND period = ?"), (user_id, period))
+    segments = cursor.fetchall()
+    for _, payload in segments:
+        messages.extend(_unpack(payload))
+    messages.sort(key=lambda message: (message[1], message[0]))
+    cursor.executemany(backend.sql(f"DELETE FROM {table_name} WHERE archive_id = ?"), [(segment[0],) for segment in segments])
+    _insert_segments(cursor, user_id, period, messages, table_name)
+    logger.debug("Repacked %s archived messages of user '%s' from %s.", len(messages), user_id, period)
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_archived_chat_history")
+def get_archived_chat_history(user_id: str, cursor: Optional[str] = None, segments: int = 1, db_name: Optional[str] = None, table_name: str = 'chat_messages_archive') -> Dict:
+    """
+    Retrieves one page of a user's archived messages, newest segments first.
+    Only the segments of the requested page are decompressed.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        cursor (Optional[str]): The next_cursor of the previous page, None for the newest page.
+        segments (int): The number of archive segments per page.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the archive table.
+
+    Returns:
+        Dict: "messages" in chronological order, each with message_id, timestamp and message_content,
+              and "next_cursor" for the following (older) page, None when there are no older messages.
+
+    Raises:
+        ValueError: The cursor is not one returned by this function.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    page = {"messages": [], "next_cursor": None}
+    where, params = "user_id = ?", [user_id]
+    if cursor:
+        where += " AND (first_timestamp, archive_id) < (?, ?)"
+        params.extend(_decode_cursor(cursor))
+    try:
+        with backend.connect(db_name) as conn:
+            db_cursor = conn.cursor()
+            db_cursor.execute(backend.sql(f'''
+                SELECT archive_id, first_timestamp, payload FROM {table_name}
+                WHERE {where}
+                ORDER BY first_timestamp DESC, archive_id DESC
+                LIMIT ?
+            '''), params + [segments + 1])
+            rows = db_cursor.fetchall()
+
+        messages = []
+        for _, _, payload in reversed(rows[:segments]):
+            messages.extend(_unpack(payload))
+        page["messages"] = [
+            {"message_id": message_id, "timestamp": timestamp, "message_content": content}
+            for message_id, timestamp, content in messages
+        ]
+        if len(rows) > segments:
+            last = rows[segments - 1]
+            page["next_cursor"] = _encode_cursor(last[1], last[0])
+        logger.debug("Retrieved %s archived messages for user '%s'.", len(messages), user_id)
+
+    except Exception as e:
+        logger.error("An error occurred during archive retrieval: %s", e)
+
+    return page
+
+
+def _encode_cursor(first_timestamp: float, archive_id: int) -> str:
+    return f"{first_timestamp!r}:{archive_id}"
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        first_timestamp, archive_id = cursor.rsplit(":", 1)
+        return float(first_timestamp), int(archive_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from None
+
+
+def iter_archived_messages(user_id: str, db_name: Optional[str] = None, table_name: str = 'chat_messages_archive') -> Iterator[Tuple[int, float, str]]:
+    """
+    Yields every archived message of a user in chronological order, one segment in memory at a time.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the archive table.
+
+    Yields:
+        Tuple[int, float, str]: The message_id, timestamp and message_content of each message.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    rows = get_backend().iter_query(db_name, f'''
+        SELECT payload FROM {table_name}
+        WHERE user_id = ?
+        ORDER BY first_timestamp, archive_id
+    ''', (user_id,), batch_size=1)
+    try:
+        for (payload,) in rows:
+            for message_id, timestamp, content in _unpack(payload):
+                yield message_id, timestamp, content
+    except Exception as e:
+        # No archive table yet means no archived messages
+        logger.error("An error occurred during archive retrieval: %s", e)
+
+
+@DB_OPERATION_SECONDS.timed(operation="compact_database")
+def compact_database(db_name: Optional[str] = None, pages: Optional[int] = VACUUM_PAGES, force: bool = False):
+    """
+    Returns free pages left behind by archived messages to the file system. Only SQLite needs this,
+    other backends reclaim space on their own. Databases created before auto_vacuum was enabled are converted with one full VACUUM when force is set,
+    after which incremental vacuums are cheap. Without force, runs at most every VACUUM_INTERVAL_SECONDS.
+
+    Args:
+        db_name (Optional[str]): The name of the database, every user data shard if None.
+        pages (Optional[int]): The maximum number of pages to free, all of them if None.
+        force (bool): Run now, and convert the database to incremental auto vacuum if needed.
+    """
+    if db_name is None:
+        for shard in all_shards():
+            compact_database(shard, pages, force)
+        return
+    now = time.time()
+    if not force and now - _last_vacuum.get(db_name, 0) < VACUUM_INTERVAL_SECONDS:
+        return
+    _last_vacuum[db_name] = now
+
+    try:
+        free_pages = get_backend().compact(db_name, pages, convert=force)
+        if free_pages is not None:
+            logger.debug("Incremental vacuum of %s freed up to %s pages.", db_name, min(free_pages, pages or free_pages))
+
+    except Exception as e:
+        logger.error("An error occurred during database compaction: %s", e)
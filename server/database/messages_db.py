@@ -1,156 +1,357 @@
-import sqlite3
+import logging
 import time
-from typing import List
+from typing import Dict, Iterator, List, Literal, Optional, Tuple
+from database.backend import get_backend
+from database.sharding import all_shards, shard_for_user
+from database.write_behind import WriteBehindBuffer
+from database.message_archive import create_archive_table, archive_messages, compact_database
+from services.metrics import DB_OPERATION_SECONDS
 
+logger = logging.getLogger(__name__)
 
-def create_chat_messages_table(db_name: str = 'user_data.db', table_name: str = 'chat_messages'):
+# Archived messages are deleted by id in batches of this many, within SQLite's bound parameter limit
+DELETE_BATCH_SIZE = 500
+
+@DB_OPERATION_SECONDS.timed(operation="write_chat_messages")
+def _write_chat_messages(target: Tuple[str, str], rows: List[tuple]):
+    db_name, table_name = target
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        conn.cursor().executemany(backend.sql(f'''
+            INSERT INTO {table_name} (user_id, message_content, timestamp)
+            VALUES (?, ?, ?)
+        '''), rows)
+        conn.commit()
+    logger.debug("Inserted %s buffered messages into '%s'.", len(rows), table_name)
+
+
+# Messages from all requests are coalesced into one transaction per batch instead of one commit per message
+message_writer = WriteBehindBuffer(_write_chat_messages, max_batch_size=500, max_delay=0.2, name="chat-message-writer")
+
+
+def flush_chat_messages():
+    """
+    Writes every buffered chat message to the database. Called on shutdown.
+    """
+    message_writer.flush()
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_chat_messages_table")
+def create_chat_messages_table(db_name: Optional[str] = None, table_name: str = 'chat_messages'):
     """
-    Creates a table to store individual chat messages in an SQLite database.
+    Creates a table to store individual chat messages in the configured storage backend,
+    along with the table their archived copies are packed into.
 
     Args:
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, every user data shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    if db_name is None:
+        for shard in all_shards():
+            create_chat_messages_table(shard, table_name)
+        return
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id TEXT,
-                message_content TEXT,
-                timestamp REAL
-            )
-        ''')
-        conn.commit()
-        print(f"Table '{table_name}' created or already exists.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            backend.prepare_database(cursor)
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    message_id {backend.serial_pk},
+                    user_id TEXT,
+                    message_content TEXT,
+                    timestamp {backend.double}
+                )
+            ''')
+            # Serves per-user history reads and keyset pagination on (timestamp, message_id)
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user_time ON {table_name} (user_id, timestamp, message_id)")
+            create_archive_table(cursor, f"{table_name}_archive")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
 # Example usage:
 # create_chat_messages_table()
 
 
-def store_chat_message(user_id: str, message_content: str, db_name: str = 'user_data.db', table_name: str = 'chat_messages'):
+def store_chat_message(user_id: str, message_content: str, db_name: Optional[str] = None, table_name: str = 'chat_messages'):
     """
-    Inserts a single chat message into the chat_messages table.
+    Queues a single chat message for insertion into the chat_messages table.
+    Messages are written in batches shortly after, reads through this module always see them.
 
     Args:
         user_id (str): The unique identifier for the user.
         message_content (str): The content of the chat message.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
-    try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
+    db_name = db_name or shard_for_user(user_id)
+    current_timestamp = time.time()
+    message_writer.add((db_name, table_name), (user_id, message_content, current_timestamp))
+    logger.debug("Queued message for user '%s'.", user_id)
 
-        current_timestamp = time.time()
 
-        cursor.execute(f'''
-            INSERT INTO {table_name} (user_id, message_content, timestamp)
-            VALUES (?, ?, ?)
-        ''', (user_id, message_content, current_timestamp))
-        conn.commit()
-        print(f"Inserted message for user '{user_id}'.")
+def store_chat_messages(user_id: str, message_contents: List[str], timestamps: Optional[List[float]] = None, db_name: Optional[str] = None, table_name: str = 'chat_messages'):
+    """
+    Queues several chat messages of one user at once, they are written in the same transaction.
 
-    except Exception as e:
-        print(f"An error occurred during message insertion: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+    Args:
+        user_id (str): The unique identifier for the user.
+        message_contents (List[str]): The contents of the chat messages, oldest first.
+        timestamps (Optional[List[float]]): The original time of each message when replaying old conversations,
+                                            the current time if None.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    if timestamps is None:
+        timestamps = [time.time()] * len(message_contents)
+    message_writer.add_many((db_name, table_name), [
+        (user_id, content, timestamp) for content, timestamp in zip(message_contents, timestamps)
+    ])
+    logger.debug("Queued %s messages for user '%s'.", len(message_contents), user_id)
 
 
-def get_recent_chat_history_from_db(user_id: str, num_messages: int = 20, db_name: str = 'user_data.db', table_name: str = 'chat_messages') -> List[str]:
+@DB_OPERATION_SECONDS.timed(operation="get_recent_chat_history_from_db")
+def get_recent_chat_history_from_db(user_id: str, num_messages: int = 20, db_name: Optional[str] = None, table_name: str = 'chat_messages') -> List[str]:
     """
     Retrieves a user's recent chat messages from the chat_messages table.
 
     Args:
         user_id (str): The unique identifier for the user.
         num_messages (int): The maximum number of recent messages to retrieve.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
 
     Returns:
         List[str]: A list of strings, where each string represents a message content.
                    Returns an empty list if no messages are found or an error occurs.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     messages = []
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            SELECT message_content
-            FROM {table_name}
-            WHERE user_id = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ''', (user_id, num_messages))
-
-        rows = cursor.fetchall()
-
-        if rows:
-            messages = [row[0] for row in rows]
-            print(f"Retrieved {len(messages)} recent messages for user '{user_id}'.")
+        # Read your writes: the user's buffered messages are the newest ones
+        with message_writer.reading((db_name, table_name)) as buffered:
+            with backend.connect(db_name) as conn:
+                cursor = conn.cursor()
+                logger.debug("Connected to database: %s", db_name)
+
+                cursor.execute(backend.sql(f'''
+                    SELECT message_content, timestamp
+                    FROM {table_name}
+                    WHERE user_id = ?
+                    ORDER BY timestamp DESC
+                    LIMIT ?
+                '''), (user_id, num_messages))
+
+                rows = cursor.fetchall()
+
+        # Newest first, buffered rows were queued after the stored ones with the same timestamp
+        rows = [(content, timestamp) for _, content, timestamp in reversed(_pending_for_user(buffered, user_id))] + list(rows)
+        rows.sort(key=lambda row: row[1], reverse=True)
+        messages = [row[0] for row in rows[:max(num_messages, 0)]]
+        if messages:
+            logger.debug("Retrieved %s recent messages for user '%s'.", len(messages), user_id)
         else:
-            print(f"No recent messages found for user '{user_id}'.")
+            logger.debug("No recent messages found for user '%s'.", user_id)
 
     except Exception as e:
-        print(f"An error occurred during message retrieval: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred during message retrieval: %s", e)
 
     # Reverse the list to get messages in chronological order
     messages.reverse()
     return messages
 
-def clear_old_chat_messages(user_id: str, db_name: str = 'user_data.db', table_name: str = 'chat_messages'):
+
+def _pending_for_user(buffered: List[tuple], user_id: str) -> List[tuple]:
+    # Queued (user_id, message_content, timestamp) rows of the user
+    return [row for row in buffered if row[0] == user_id]
+
+
+def _wait_for_user_messages(user_id: str, db_name: str, table_name: str):
+    # Reads that need message ids wait for the next batch to write the user's buffered messages
+    message_writer.wait_written((db_name, table_name), lambda row: row[0] == user_id)
+
+def _encode_cursor(timestamp: float, message_id: int) -> str:
+    return f"{timestamp!r}:{message_id}"
+
+
+def _decode_cursor(cursor: str) -> Tuple[float, int]:
+    try:
+        timestamp, message_id = cursor.rsplit(":", 1)
+        return float(timestamp), int(message_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from None
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_chat_history_page")
+def get_chat_history_page(user_id: str, limit: int = 50, cursor: Optional[str] = None, order: Literal["asc", "desc"] = "desc", db_name: Optional[str] = None, table_name: str = 'chat_messages') -> Dict:
     """
-    Removes old individual chat messages for a specific user from the chat_messages table.
-    For simplicity, this function deletes all messages for the given user.
+    Retrieves one page of a user's chat messages using keyset pagination on (timestamp, message_id),
+    so every page costs the same no matter how deep into the history it is.
+    Messages still buffered get their ids with the next batch write, which the call waits for.
 
     Args:
         user_id (str): The unique identifier for the user.
-        db_name (str): The name of the SQLite database file.
+        limit (int): The maximum number of messages per page.
+        cursor (Optional[str]): The next_cursor of the previous page, None for the first page.
+        order (str): "desc" starts from the newest message, "asc" from the oldest.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
+
+    Returns:
+        Dict: "messages" in the requested order, each with message_id, timestamp and message_content,
+              and "next_cursor" for the following page, None on the last page.
+
+    Raises:
+        ValueError: The limit is below 1 or the cursor is not one returned by this function.
     """
-    conn = None
+    if limit < 1:
+        raise ValueError(f"Invalid limit: {limit}")
+    comparison, direction = ("<", "DESC") if order == "desc" else (">", "ASC")
+    where, params = "user_id = ?", [user_id]
+    if cursor:
+        where += f" AND (timestamp, message_id) {comparison} (?, ?)"
+        params.extend(_decode_cursor(cursor))
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    page = {"messages": [], "next_cursor": None}
+    _wait_for_user_messages(user_id, db_name, table_name)
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            DELETE FROM {table_name}
-            WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
+        with backend.connect(db_name) as conn:
+            db_cursor = conn.cursor()
+            db_cursor.execute(backend.sql(f'''
+                SELECT message_id, timestamp, message_content
+                FROM {table_name}
+                WHERE {where}
+                ORDER BY timestamp {direction}, message_id {direction}
+                LIMIT ?
+            '''), params + [limit + 1])
+            rows = db_cursor.fetchall()
+
+        page["messages"] = [
+            {"message_id": message_id, "timestamp": timestamp, "message_content": content}
+            for message_id, timestamp, content in rows[:limit]
+        ]
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            page["next_cursor"] = _encode_cursor(last[1], last[0])
+
+    except Exception as e:
+        logger.error("An error occurred during message retrieval: %s", e)
+
+    return page
+
+
+def iter_chat_messages(user_id: str, batch_size: int = 500, db_name: Optional[str] = None, table_name: str = 'chat_messages') -> Iterator[Tuple[int, float, str]]:
+    """
+    Yields every chat message of a user in chronological order, stepping through the query
+    batch_size rows at a time instead of loading the whole history.
+    The generator may be resumed from different threads, as streaming responses do.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        batch_size (int): The number of rows fetched at a time.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+
+    Yields:
+        Tuple[int, float, str]: The message_id, timestamp and message_content of each message.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    _wait_for_user_messages(user_id, db_name, table_name)
+    yield from get_backend().iter_query(db_name, f'''
+        SELECT message_id, timestamp, message_content
+        FROM {table_name}
+        WHERE user_id = ?
+        ORDER BY timestamp, message_id
+    ''', (user_id,), batch_size)
+
+
+@DB_OPERATION_SECONDS.timed(operation="count_chat_messages")
+def count_chat_messages(user_id: str, db_name: Optional[str] = None, table_name: str = 'chat_messages') -> int:
+    """
+    Counts a user's chat messages without retrieving them.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        int: The number of messages, 0 if an error occurs.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    count = 0
+    try:
+        # Buffered messages count too, without writing them first
+        with message_writer.reading((db_name, table_name)) as buffered:
+            with backend.connect(db_name) as conn:
+                cursor = conn.cursor()
+                cursor.execute(backend.sql(f"SELECT COUNT(*) FROM {table_name} WHERE user_id = ?"), (user_id,))
+                count = cursor.fetchone()[0] + len(_pending_for_user(buffered, user_id))
+    except Exception as e:
+        logger.error("An error occurred during message count: %s", e)
+    return count
 
-        deleted_count = cursor.rowcount
-        print(f"Deleted {deleted_count} old messages for user '{user_id}'.")
+
+@DB_OPERATION_SECONDS.timed(operation="clear_old_chat_messages")
+def clear_old_chat_messages(user_id: str, db_name: Optional[str] = None, table_name: str = 'chat_messages'):
+    """
+    Moves a user's chat messages out of the chat_messages table into the compressed archive,
+    keeping the hot table small while retaining the history. All messages of the user are moved.
+    Archived messages can be paged through with get_archived_chat_history.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    # Buffered messages are old messages too
+    message_writer.flush((db_name, table_name))
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            # Copy and delete in one write transaction so no message is lost or archived twice,
+            # an error rolls it back when the connection is returned to the pool
+            backend.lock_for_write(cursor, f"{table_name}:{user_id}")
+            cursor.execute(backend.sql(f'''
+                SELECT message_id, timestamp, message_content
+                FROM {table_name}
+                WHERE user_id = ?
+                ORDER BY timestamp, message_id
+            '''), (user_id,))
+            rows = cursor.fetchall()
+
+            if rows:
+                create_archive_table(cursor, f"{table_name}_archive")
+                archive_messages(cursor, user_id, rows, f"{table_name}_archive")
+                # Only the archived rows, a message inserted with a lower id since the select is kept
+                message_ids = [row[0] for row in rows]
+                for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                    batch = message_ids[start:start + DELETE_BATCH_SIZE]
+                    cursor.execute(backend.sql(f'''
+                        DELETE FROM {table_name}
+                        WHERE user_id = ? AND message_id IN ({", ".join("?" * len(batch))})
+                    '''), [user_id] + batch)
+            conn.commit()
+
+            logger.debug("Archived %s old messages for user '%s'.", len(rows), user_id)
 
     except Exception as e:
-        print(f"An error occurred during message deletion: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred during message archiving: %s", e)
+
+    compact_database(db_name)
 
 # Example usage :
 # test_user_id_clear = "clear_messages_test_user"
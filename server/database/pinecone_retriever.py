@@ -1,42 +1,72 @@
-from config.pinecone_config import settings
-from pinecone import Pinecone
+import logging
+from config.pinecone_config import get_settings, get_pinecone_client, pinecone_upstream, PINECONE_LOCAL_DENSE_INDEX
 from pydantic import BaseModel
 from typing import List
+from services.embeddings import use_local_embeddings, embed_query
+from services.hot_index import hot_indexes
+from services.metrics import PINECONE_REQUEST_SECONDS
+from services.single_flight import coalesced
+
+logger = logging.getLogger(__name__)
 
 class User(BaseModel):
     friend_ids: List[int]
 
-def semantic_search_by_creator(creator_id: str, search_query: str, min_score_threshold: float = 0.5):
+
+class VectorHit(dict):
+    """
+    A match of a vector query, in the shape of the hits of a search of an integrated embedding index.
+    """
+
+    def __init__(self, match):
+        super().__init__(_id=match.id, fields=dict(match.metadata or {}))
+        self._score = match.score
+
+# Popular creators get the same question from many users at once, they share one pair of searches
+@coalesced()
+def semantic_search_by_creator(creator_id: str, search_query: str, min_score_threshold: float = 0.5, top_n: int = 5):
     """
     Performs a semantic search across video content by a specific creator using metadata filtering,
     with an optional minimum score threshold.
+    With EMBEDDING_BACKEND=local the dense search queries PINECONE_LOCAL_DENSE_INDEX with a locally computed vector.
+    With HOT_INDEX=on the searches of hot creators are served from their in-memory index instead.
 
     Args:
         creator_id (str): The ID of the creator.
         search_query (str): The search query.
         min_score_threshold (float): The minimum score threshold to include results.
+        top_n (int): The maximum number of combined results to return.
     """
+    settings = get_settings()
     if not settings:
-        print("Settings not loaded. Cannot proceed with Pinecone initialization.")
+        logger.error("Settings not loaded. Cannot proceed with Pinecone initialization.")
         return []
 
+    if hot_indexes is not None:
+        hot_results = hot_indexes.search(creator_id, search_query, settings.pinecone_top_k)
+        if hot_results is not None:
+            hot_results = [result for result in hot_results if result["score"] >= min_score_threshold]
+            hot_results.sort(key=lambda result: result["score"], reverse=True)
+            return best_per_chunk(hot_results, lambda result: (result["video_id"], result["chunk_index"]))[:top_n]
+
     pc = None
     try:
-        pc = Pinecone(api_key=settings.pinecone_api_key)
-        print("Pinecone client initialized.")
+        pc = get_pinecone_client()
     except Exception as e:
-        print(f"An error occurred during Pinecone initialization: {e}")
+        logger.error("An error occurred during Pinecone initialization: %s", e)
         return []
 
     all_results = []
     dense_index = None
     sparse_index = None
+    local_embeddings = use_local_embeddings()
     try:
-        dense_index = pc.Index(name='character')
-        print(f"Connected to Pinecone dense index: character")
+        dense_index_name = PINECONE_LOCAL_DENSE_INDEX if local_embeddings else 'character'
+        dense_index = pc.Index(name=dense_index_name)
+        logger.debug("Connected to Pinecone dense index: %s", dense_index_name)
 
         sparse_index = pc.Index(name='character-sparse')
-        print(f"Connected to Pinecone sparse index: character-sparse")
+        logger.debug("Connected to Pinecone sparse index: character-sparse")
 
         creator_filter = {"creator_id": {"$eq": creator_id}}
 
@@ -44,55 +74,72 @@ def semantic_search_by_creator(creator_id: str, search_query: str, min_score_thr
 
 
         try:
-            print(f"Performing dense search for creator ID: {creator_id}")
-            dense_results = dense_index.search(
-                namespace=settings.pinecone_namespace,
-                query={
-                    "inputs": {"text": search_query},
-                    "top_k": settings.pinecone_top_k,
-                    "filter": creator_filter,
-                },
-                fields=retrieve_fields
-            )
-            if hasattr(dense_results, 'result') and dense_results.result and hasattr(dense_results.result, 'hits'):
-                all_results.extend(dense_results.result.hits)
+            logger.debug("Performing dense search for creator ID: %s", creator_id)
+            if local_embeddings:
+                query_vector = embed_query(search_query)
+                with PINECONE_REQUEST_SECONDS.time(operation="dense_vector_query"):
+                    dense_results = pinecone_upstream.call(
+                        dense_index.query,
+                        namespace=settings.pinecone_namespace,
+                        vector=query_vector,
+                        top_k=settings.pinecone_top_k,
+                        filter=creator_filter,
+                        include_metadata=True
+                    )
+                all_results.extend(VectorHit(match) for match in dense_results.matches)
             else:
-                 print("Warning: Dense search response does not contain search results in the expected '.result.hits' format.")
-                 print(f"Dense response type: {type(dense_results)}")
-                 print(f"Dense response structure (first 1000 chars): {str(dense_results)[:1000]}")
+                with PINECONE_REQUEST_SECONDS.time(operation="dense_search"):
+                    dense_results = pinecone_upstream.call(
+                        dense_index.search,
+                        namespace=settings.pinecone_namespace,
+                        query={
+                            "inputs": {"text": search_query},
+                            "top_k": settings.pinecone_top_k,
+                            "filter": creator_filter,
+                        },
+                        fields=retrieve_fields
+                    )
+                if hasattr(dense_results, 'result') and dense_results.result and hasattr(dense_results.result, 'hits'):
+                    all_results.extend(dense_results.result.hits)
+                else:
+                     logger.warning("Dense search response does not contain search results in the expected '.result.hits' format.")
+                     logger.debug("Dense response type: %s", type(dense_results))
+                     logger.debug("Dense response structure (first 1000 chars): %s", str(dense_results)[:1000])
 
 
         except Exception as e:
-            print(f"An error occurred during dense Pinecone search for creator ID {creator_id}: {e}")
-            print(f"Full Dense Response Object: {dense_results}")
+            logger.error("An error occurred during dense Pinecone search for creator ID %s: %s", creator_id, e)
+            logger.debug("Full Dense Response Object: %s", dense_results)
 
 
         try:
-            print(f"Performing sparse search for creator ID: {creator_id}")
-            sparse_results = sparse_index.search(
-                namespace=settings.pinecone_namespace,
-                query={
-                    "inputs": {"text": search_query},
-                    "top_k": settings.pinecone_top_k,
-                    "filter": creator_filter,
-                },
-                fields=retrieve_fields
-            )
+            logger.debug("Performing sparse search for creator ID: %s", creator_id)
+            with PINECONE_REQUEST_SECONDS.time(operation="sparse_search"):
+                sparse_results = pinecone_upstream.call(
+                    sparse_index.search,
+                    namespace=settings.pinecone_namespace,
+                    query={
+                        "inputs": {"text": search_query},
+                        "top_k": settings.pinecone_top_k,
+                        "filter": creator_filter,
+                    },
+                    fields=retrieve_fields
+                )
             if hasattr(sparse_results, 'result') and sparse_results.result and hasattr(sparse_results.result, 'hits'):
                 all_results.extend(sparse_results.result.hits)
             else:
-                print("Warning: Sparse search response does not contain search results in the expected '.result.hits' format.")
-                print(f"Sparse response type: {type(sparse_results)}")
-                print(f"Sparse response structure (first 1000 chars): {str(sparse_results)[:1000]}")
+                logger.warning("Sparse search response does not contain search results in the expected '.result.hits' format.")
+                logger.debug("Sparse response type: %s", type(sparse_results))
+                logger.debug("Sparse response structure (first 1000 chars): %s", str(sparse_results)[:1000])
 
 
         except Exception as e:
-            print(f"An error occurred during sparse Pinecone search for creator ID {creator_id}: {e}")
-            print(f"Full Sparse Response Object: {sparse_results}")
+            logger.error("An error occurred during sparse Pinecone search for creator ID %s: %s", creator_id, e)
+            logger.debug("Full Sparse Response Object: %s", sparse_results)
 
 
     except Exception as e:
-        print(f"An error occurred during Pinecone index connection: {e}")
+        logger.error("An error occurred during Pinecone index connection: %s", e)
     finally:
         pass
 
@@ -102,16 +149,17 @@ def semantic_search_by_creator(creator_id: str, search_query: str, min_score_thr
     try:
         filtered_results.sort(key=lambda x: x._score, reverse=True)
     except Exception as e:
-        print(f"Error during sorting filtered results: {e}")
-        print("Could not sort filtered results. Please examine the debugging output above to understand the structure of items in all_results.")
+        logger.error("Error during sorting filtered results: %s", e)
+        logger.error("Could not sort filtered results. Please examine the debugging output above to understand the structure of items in all_results.")
 
 
-    top_n_results = filtered_results[:5]
+    # The dense and the sparse index often both find a chunk, it takes one place in the results
+    top_n_results = best_per_chunk(filtered_results, _chunk_key)[:top_n]
 
 
-    print(f"\n--- Combined Search Results (Top {len(top_n_results)} after filtering and sorting) ---")
+    logger.debug("--- Combined Search Results (Top %s after filtering and sorting) ---", len(top_n_results))
     if not top_n_results:
-        print("No relevant results found for the given creator and query above the minimum score threshold.")
+        logger.debug("No relevant results found for the given creator and query above the minimum score threshold.")
     else:
         for result in top_n_results:
             try:
@@ -124,15 +172,39 @@ def semantic_search_by_creator(creator_id: str, search_query: str, min_score_thr
                 score = result._score
 
 
-                print(f"Video ID: {video_id}, Creator ID: {result_creator_id}, Score: {score:.4f}, Text: {text}")
+                logger.debug("Video ID: %s, Creator ID: %s, Score: %.4f, Text: %s", video_id, result_creator_id, score, text)
             except Exception as e:
-                print(f"Error processing search result: {e}")
-                print(f"Problematic result object: {result}")
+                logger.error("Error processing search result: %s", e)
+                logger.debug("Problematic result object: %s", result)
 
 
     # Instead of returning raw result objects, serialize them:
     return [serialize_result(r) for r in top_n_results]
 
+def best_per_chunk(results, chunk_key):
+    """
+    Keeps the first result of every chunk, the one with the highest score when the results are sorted by score.
+
+    Args:
+        results: The search results, the best first.
+        chunk_key: Returns the (video_id, chunk_index) of a result.
+
+    Returns:
+        list: The results without repeated chunks, in their order.
+    """
+    seen = set()
+    unique = []
+    for result in results:
+        key = chunk_key(result)
+        if key not in seen:
+            seen.add(key)
+            unique.append(result)
+    return unique
+
+def _chunk_key(result):
+    fields = result.get('fields', {}) if hasattr(result, 'get') else getattr(result, 'fields', {})
+    return fields.get("video_id"), fields.get("chunk_index")
+
 def serialize_result(result):
     # Safely extract fields and score
     fields = result.get('fields', {}) if hasattr(result, 'get') else getattr(result, 'fields', {})
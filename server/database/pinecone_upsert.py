@@ -1,87 +1,76 @@
-from config.pinecone_config import settings
-import sqlite3
-from pinecone import Pinecone
-from database.character_db import insert_video_creator
+import logging
+from config.pinecone_config import (get_settings, get_pinecone_client, pinecone_upstream, PINECONE_LOCAL_DENSE_INDEX,
+                                    PINECONE_UPSERT_BATCH_SIZE)
+from typing import List
+from database.character_db import insert_video_creator, get_video_chunks
+from services.embeddings import use_local_embeddings, embed_passages
+from services.hot_index import hot_indexes
+from services.metrics import PINECONE_REQUEST_SECONDS
+
+logger = logging.getLogger(__name__)
 
 def upsert_video_chunks_to_pinecone(video_id: str):
     """
-    Retrieves text chunks for a given video ID from the SQLite database,
+    Retrieves text chunks for a given video ID from the database,
     fetches the creator ID, and upserts them into both dense and sparse
     Pinecone indexes with video_id, chunk_index, and creator_id in metadata.
+    With EMBEDDING_BACKEND=local the dense vectors are computed locally and
+    upserted into PINECONE_LOCAL_DENSE_INDEX instead of the 'character' index.
 
     Args:
         video_id (str): The YouTube video ID.
     """
+    settings = get_settings()
     if not settings:
-        print("Settings not loaded. Cannot proceed with Pinecone upsert.")
+        logger.error("Settings not loaded. Cannot proceed with Pinecone upsert.")
         return
 
-    conn = None
     chunks_data = []
     creator_id = None
 
     try:
-        conn = sqlite3.connect('video_chunks.db')
-        cursor = conn.cursor()
-        print(f"Connected to database: video_chunks.db")
-
-        cursor.execute("SELECT creator_id FROM video_creators WHERE video_id = ?", (video_id,))
-        creator_row = cursor.fetchone()
-        if creator_row:
-            creator_id = creator_row[0]
-            print(f"Retrieved creator ID: {creator_id} for video ID: {video_id}")
-        else:
-            print(f"No creator ID found for video ID: {video_id}. Cannot proceed with upsert.")
+        creator_id, chunks_data = get_video_chunks(video_id)
+        if creator_id is None:
+            logger.error("No creator ID found for video ID: %s. Cannot proceed with upsert.", video_id)
             return
+        logger.debug("Retrieved %s chunks for video ID: %s", len(chunks_data), video_id)
 
-        cursor.execute("SELECT chunk_text FROM chunks WHERE video_id = ?", (video_id,))
-
-        # Fetch all the results
-        rows = cursor.fetchall()
-
-        # Extract the text chunks
-        chunks_data = [row[0] for row in rows]
-        print(f"Retrieved {len(chunks_data)} chunks for video ID: {video_id}")
-
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
     except Exception as e:
-        print(f"An unexpected error occurred during database operations: {e}")
-    finally:
-        # Close connection
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An unexpected error occurred during database operations: %s", e)
 
     if not chunks_data:
-        print("No chunks found for the given video ID. Aborting Pinecone upsert.")
+        logger.warning("No chunks found for the given video ID. Aborting Pinecone upsert.")
         return
     try:
         insert_video_creator(video_id=video_id, creator_id=creator_id)
     except Exception as e:
-        print(f"An error occurred during video creator insertion: {e}")
+        logger.error("An error occurred during video creator insertion: %s", e)
 
     try:
-        pc = Pinecone(api_key=settings.pinecone_api_key)
+        pc = get_pinecone_client()
 
         try:
-            records_to_upsert_dense = []
-            for i, text in enumerate(chunks_data):
-                record_id = f"{video_id}-{i}"
-                records_to_upsert_dense.append({
-                    "_id": record_id,
-                    "text": text,
-                    "video_id": video_id,
-                    "chunk_index": i,
-                    "creator_id": creator_id
-                })
-            print(f"Prepared {len(records_to_upsert_dense)} records for dense index upsert.")
-
-            index = pc.Index(name='character')
-            index.upsert_records(records=records_to_upsert_dense, namespace=settings.pinecone_namespace)
-            print(f"Successfully attempted to upsert {len(records_to_upsert_dense)} records to the dense Pinecone index.")
+            if use_local_embeddings():
+                upsert_dense_vectors(pc, settings.pinecone_namespace, video_id, creator_id, chunks_data)
+            else:
+                records_to_upsert_dense = []
+                for i, text in enumerate(chunks_data):
+                    record_id = f"{video_id}-{i}"
+                    records_to_upsert_dense.append({
+                        "_id": record_id,
+                        "text": text,
+                        "video_id": video_id,
+                        "chunk_index": i,
+                        "creator_id": creator_id
+                    })
+                logger.debug("Prepared %s records for dense index upsert.", len(records_to_upsert_dense))
+
+                index = pc.Index(name='character')
+                with PINECONE_REQUEST_SECONDS.time(operation="dense_upsert"):
+                    pinecone_upstream.call(index.upsert_records, records=records_to_upsert_dense, namespace=settings.pinecone_namespace)
+                logger.debug("Successfully attempted to upsert %s records to the dense Pinecone index.", len(records_to_upsert_dense))
         except Exception as e:
-            print(f"An error occurred during dense index upsert: {e}")
+            logger.error("An error occurred during dense index upsert: %s", e)
 
         try:
             records_to_upsert_sparse = []
@@ -94,13 +83,46 @@ def upsert_video_chunks_to_pinecone(video_id: str):
                     "chunk_index": i,
                     "creator_id": creator_id
                 })
-            print(f"Prepared {len(records_to_upsert_sparse)} records for sparse index upsert.")
+            logger.debug("Prepared %s records for sparse index upsert.", len(records_to_upsert_sparse))
 
             sparse_index = pc.Index(name='character-sparse')
-            sparse_index.upsert_records(records=records_to_upsert_sparse, namespace=settings.pinecone_namespace)
-            print(f"Successfully attempted to upsert {len(records_to_upsert_sparse)} records to the sparse Pinecone index.")
+            with PINECONE_REQUEST_SECONDS.time(operation="sparse_upsert"):
+                pinecone_upstream.call(sparse_index.upsert_records, records=records_to_upsert_sparse, namespace=settings.pinecone_namespace)
+            logger.debug("Successfully attempted to upsert %s records to the sparse Pinecone index.", len(records_to_upsert_sparse))
         except Exception as e:
-            print(f"An error occurred during sparse index upsert: {e}")
+            logger.error("An error occurred during sparse index upsert: %s", e)
 
     except Exception as e:
-        print(f"An error occurred during Pinecone operations: {e}")
\ No newline at end of file
+        logger.error("An error occurred during Pinecone operations: %s", e)
+
+    if hot_indexes is not None:
+        # Other workers pick up the new chunks when their index of the creator expires
+        hot_indexes.invalidate(creator_id)
+
+
+def upsert_dense_vectors(pc, namespace: str, video_id: str, creator_id: str, chunks: List[str]):
+    """
+    Embeds the chunks of a video locally in batches and upserts the vectors into PINECONE_LOCAL_DENSE_INDEX,
+    with the text stored in the metadata next to video_id, chunk_index and creator_id.
+
+    Args:
+        pc: The Pinecone client.
+        namespace (str): The Pinecone namespace.
+        video_id (str): The YouTube video ID.
+        creator_id (str): The ID of the creator of the video.
+        chunks (List[str]): The text chunks of the video, in order.
+    """
+    vectors = []
+    for i, (text, values) in enumerate(zip(chunks, embed_passages(chunks))):
+        vectors.append({
+            "id": f"{video_id}-{i}",
+            "values": values,
+            "metadata": {"text": text, "video_id": video_id, "chunk_index": i, "creator_id": creator_id}
+        })
+    logger.debug("Embedded %s chunks for the local dense index upsert.", len(vectors))
+
+    index = pc.Index(name=PINECONE_LOCAL_DENSE_INDEX)
+    for start in range(0, len(vectors), PINECONE_UPSERT_BATCH_SIZE):
+        with PINECONE_REQUEST_SECONDS.time(operation="dense_vector_upsert"):
+            pinecone_upstream.call(index.upsert, vectors=vectors[start:start + PINECONE_UPSERT_BATCH_SIZE], namespace=namespace)
+    logger.debug("Successfully attempted to upsert %s vectors to the local dense Pinecone index.", len(vectors))
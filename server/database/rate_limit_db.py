@@ -0,0 +1,148 @@
+import logging
+import time
+from typing import List, Optional, Set, Tuple
+from database.backend import get_backend
+from database.sharding import all_shards, shard_for_user
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_rate_limit_table")
+def create_rate_limit_table(db_name: Optional[str] = None, table_name: str = 'rate_limit_hits'):
+    """
+    Creates the table that durably records the requests counted by the rate limiter.
+
+    Args:
+        db_name (Optional[str]): The name of the database, every user data shard if None.
+        table_name (str): The name of the table within the database.
+    """
+    if db_name is None:
+        for shard in all_shards():
+            create_rate_limit_table(shard, table_name)
+        return
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    user_id TEXT,
+                    endpoint TEXT,
+                    timestamp {backend.double},
+                    worker TEXT,
+                    written_at {backend.double}
+                )
+            ''')
+            # Tables created before the workers synced their windows lack the columns telling whose the hits are
+            cursor.execute(f"SELECT * FROM {table_name} WHERE 1 = 0")
+            columns = [column[0] for column in cursor.description]
+            for column, column_type in (("worker", "TEXT"), ("written_at", backend.double)):
+                if column not in columns:
+                    cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type}")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user ON {table_name} (user_id, endpoint, timestamp)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_timestamp ON {table_name} (timestamp)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_written ON {table_name} (written_at)")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+
+@DB_OPERATION_SECONDS.timed(operation="store_rate_limit_hits")
+def store_rate_limit_hits(hits: List[Tuple[str, str, float, str]], expire_before: Optional[float] = None, db_name: Optional[str] = None, table_name: str = 'rate_limit_hits'):
+    """
+    Inserts a batch of counted requests in one transaction and drops the ones no window needs anymore.
+    Each request is stamped with when it was written, for the other workers to pick it up.
+    Errors are raised so the caller can retry the batch.
+
+    Args:
+        hits (List[Tuple[str, str, float, str]]): The (user_id, endpoint, timestamp, worker) of each request,
+                                                  worker identifying the process that counted it.
+        expire_before (Optional[float]): Requests older than this timestamp are deleted, nothing is deleted if None.
+        db_name (Optional[str]): The name of the database, None stores each hit in its user's shard.
+        table_name (str): The name of the table within the database.
+    """
+    if db_name is None:
+        by_shard = {}
+        for hit in hits:
+            by_shard.setdefault(shard_for_user(hit[0]), []).append(hit)
+        for shard, shard_hits in by_shard.items():
+            store_rate_limit_hits(shard_hits, expire_before, shard, table_name)
+        return
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        written_at = time.time()
+        cursor.executemany(backend.sql(f"INSERT INTO {table_name} (user_id, endpoint, timestamp, worker, written_at) VALUES (?, ?, ?, ?, ?)"),
+                           [(*hit, written_at) for hit in hits])
+        if expire_before is not None:
+            cursor.execute(backend.sql(f"DELETE FROM {table_name} WHERE timestamp < ?"), (expire_before,))
+        conn.commit()
+    logger.debug("Stored %s rate limit hits.", len(hits))
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_rate_limit_hits")
+def get_rate_limit_hits(user_id: str, endpoint: str, since: float, db_name: Optional[str] = None, table_name: str = 'rate_limit_hits') -> List[Tuple[float, Optional[str]]]:
+    """
+    Retrieves a user's counted requests to an endpoint since a point in time.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        endpoint (str): The rate limited endpoint.
+        since (float): The start of the window.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        List[Tuple[float, Optional[str]]]: The (timestamp, worker) of each request in chronological order, the worker
+                                           None for requests written before it was recorded. Empty if none are
+                                           found or an error occurs.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    hits = []
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(backend.sql(f'''
+                SELECT timestamp, worker
+                FROM {table_name}
+                WHERE user_id = ? AND endpoint = ? AND timestamp >= ?
+                ORDER BY timestamp
+            '''), (user_id, endpoint, since))
+            hits = [(row[0], row[1]) for row in cursor.fetchall()]
+
+    except Exception as e:
+        logger.error("An error occurred during rate limit hit retrieval: %s", e)
+
+    return hits
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_rate_limit_changes")
+def get_rate_limit_changes(worker: str, written_since: float, db_name: str, table_name: str = 'rate_limit_hits') -> Set[Tuple[str, str]]:
+    """
+    Retrieves the users and endpoints other workers counted requests of since a point in time. Errors are raised.
+
+    Args:
+        worker (str): The worker asking, its own requests are left out.
+        written_since (float): Requests written before this timestamp are left out.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        Set[Tuple[str, str]]: The (user_id, endpoint) pairs.
+    """
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.execute(backend.sql(f'''
+            SELECT DISTINCT user_id, endpoint
+            FROM {table_name}
+            WHERE written_at >= ? AND worker != ?
+        '''), (written_since, worker))
+        return {(row[0], row[1]) for row in cursor.fetchall()}
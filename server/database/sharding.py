@@ -0,0 +1,194 @@
+import argparse
+import bisect
+import hashlib
+import logging
+import os
+from typing import Dict, List, Optional, Sequence
+from dotenv import load_dotenv
+from database.backend import get_backend
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+# Points per shard on the ring, more points spread users more evenly
+VIRTUAL_NODES = 128
+
+# Tables holding per-user rows, moved together when a user changes shard
+USER_TABLES = ("users", "chat_messages", "chat_messages_archive", "rate_limit_hits")
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping user ids to shards. Adding or removing a shard only moves the
+    users of the ring segments it takes over or gives up, about 1/N of them, instead of reshuffling everyone.
+    """
+
+    def __init__(self, shards: Sequence[str], virtual_nodes: int = VIRTUAL_NODES):
+        if not shards:
+            raise ValueError("At least one shard is required.")
+        self.shards = list(dict.fromkeys(shards))
+        points = sorted((_hash(f"{shard}#{i}"), shard) for shard in self.shards for i in range(virtual_nodes))
+        self._keys = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    def shard_for(self, key: str) -> str:
+        """
+        Returns the shard a key belongs to: the first ring point clockwise of the key's hash.
+        """
+        index = bisect.bisect(self._keys, _hash(key)) % len(self._keys)
+        return self._shards[index]
+
+
+def configured_shards() -> List[str]:
+    """
+    Returns the user data shards from the USER_DB_SHARDS environment variable, a comma separated list
+    of database names (SQLite files, or databases on the PostgreSQL server). Defaults to the single user_data.db.
+    """
+    shards = [shard.strip() for shard in os.getenv("USER_DB_SHARDS", "user_data.db").split(",")]
+    return [shard for shard in shards if shard]
+
+
+_ring = HashRing(configured_shards())
+
+
+def all_shards() -> List[str]:
+    """
+    Returns every configured user data shard.
+    """
+    return list(_ring.shards)
+
+
+def shard_for_user(user_id: str) -> str:
+    """
+    Returns the database holding a user's data.
+    """
+    return _ring.shard_for(user_id)
+
+
+def set_shards(shards: Sequence[str]):
+    """
+    Replaces the shard list of this process, e.g. after changing USER_DB_SHARDS in a maintenance script.
+    """
+    global _ring
+    _ring = HashRing(shards)
+
+
+def _create_user_tables(db_name: str):
+    from database.user_db import create_user_table
+    from database.messages_db import create_chat_messages_table
+    from database.rate_limit_db import create_rate_limit_table
+
+    create_user_table(db_name)
+    create_chat_messages_table(db_name)
+    create_rate_limit_table(db_name)
+
+
+def _user_ids(db_name: str) -> List[str]:
+    backend = get_backend()
+    user_ids = set()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        for table in USER_TABLES:
+            cursor.execute(f"SELECT DISTINCT user_id FROM {table}")
+            user_ids.update(row[0] for row in cursor.fetchall())
+    return sorted(user_ids)
+
+
+def _columns(cursor, table: str) -> List[str]:
+    cursor.execute(f"SELECT * FROM {table} WHERE 1 = 0")
+    return [column[0] for column in cursor.description]
+
+
+def move_user(user_id: str, source: str, target: str):
+    """
+    Moves all rows of a user from one shard to another. Rows are committed on the target before
+    they are deleted from the source, so an interrupted move loses nothing. Messages the user
+    wrote on the target in the meantime are kept, as is a summary already stored there.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        source (str): The database the user's rows are in.
+        target (str): The database the user's rows belong in.
+    """
+    from database.messages_db import flush_chat_messages
+
+    # Buffered messages of the user may still be headed for either shard
+    flush_chat_messages()
+    _create_user_tables(source)
+    _create_user_tables(target)
+
+    backend = get_backend()
+    with backend.connect(source) as source_conn, backend.connect(target) as target_conn:
+        source_cursor, target_cursor = source_conn.cursor(), target_conn.cursor()
+        # Writes to the source wait until the user's rows are deleted there, so none are left behind
+        backend.lock_for_write(source_cursor, f"move:{user_id}")
+        backend.lock_for_write(target_cursor, f"move:{user_id}")
+        moved: Dict[str, int] = {}
+        for table in USER_TABLES:
+            # Generated keys are assigned again by the target so they cannot collide with its own rows
+            columns = [column for column in _columns(source_cursor, table) if column not in ("message_id", "archive_id")]
+            order = " ORDER BY archive_id" if table.endswith("_archive") else ""
+            source_cursor.execute(backend.sql(f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ?{order}"), (user_id,))
+            rows = source_cursor.fetchall()
+            if not rows:
+                continue
+            insert = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+            if table == "users":
+                insert += " ON CONFLICT (user_id) DO UPDATE SET chat_history_summary = COALESCE(users.chat_history_summary, excluded.chat_history_summary)"
+            target_cursor.executemany(backend.sql(insert), rows)
+            moved[table] = len(rows)
+        target_conn.commit()
+
+        for table in moved:
+            source_cursor.execute(backend.sql(f"DELETE FROM {table} WHERE user_id = ?"), (user_id,))
+        source_conn.commit()
+    logger.debug("Moved user '%s' from %s to %s: %s", user_id, source, target, moved)
+
+
+def rebalance(shards: Optional[Sequence[str]] = None, previous_shards: Sequence[str] = (), dry_run: bool = False) -> Dict[str, int]:
+    """
+    Moves every user to the shard the ring assigns them to. Run it after changing USER_DB_SHARDS,
+    passing the shards that were removed as previous_shards so their users are moved off them.
+
+    Args:
+        shards (Optional[Sequence[str]]): The new shard list, the configured one if None.
+        previous_shards (Sequence[str]): Shards no longer in the list that may still hold users.
+        dry_run (bool): Only count the users that would move.
+
+    Returns:
+        Dict[str, int]: The number of users moved (or to move) into each shard.
+    """
+    ring = HashRing(shards) if shards else _ring
+    moves: Dict[str, int] = {shard: 0 for shard in ring.shards}
+    for source in dict.fromkeys(list(ring.shards) + list(previous_shards)):
+        if not os.path.exists(source) and get_backend().name == "sqlite":
+            continue
+        _create_user_tables(source)
+        for user_id in _user_ids(source):
+            target = ring.shard_for(user_id)
+            if target == source:
+                continue
+            moves[target] += 1
+            if not dry_run:
+                move_user(user_id, source, target)
+    logger.info("Rebalance %s: %s", 'plan' if dry_run else 'done', moves)
+    return moves
+
+
+if __name__ == "__main__":
+    # python -m database.sharding --shards user_data_0.db,user_data_1.db --previous user_data.db
+    parser = argparse.ArgumentParser(description="Move users to the shards the consistent hash ring assigns them to.")
+    parser.add_argument("--shards", help="Comma separated shard list, defaults to USER_DB_SHARDS.")
+    parser.add_argument("--previous", default="", help="Comma separated shards being removed.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report how many users would move.")
+    args = parser.parse_args()
+    rebalance(
+        [shard for shard in args.shards.split(",") if shard] if args.shards else None,
+        [shard for shard in args.previous.split(",") if shard],
+        args.dry_run,
+    )
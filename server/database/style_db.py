@@ -0,0 +1,229 @@
+import json
+import logging
+import time
+import zlib
+from typing import Dict, List, Optional
+from database.backend import get_backend
+from tools.stylometry import ANALYZER_VERSION, StyleStats, merge_stats, subtract_stats, stats_to_dict, stats_from_dict
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+
+def _pack(stats: StyleStats) -> bytes:
+    return zlib.compress(json.dumps(stats_to_dict(stats)).encode("utf-8"))
+
+
+def _unpack(blob: bytes) -> StyleStats:
+    return stats_from_dict(json.loads(zlib.decompress(blob).decode("utf-8")))
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_style_tables")
+def create_style_tables(db_name: str = 'video_chunks.db') -> bool:
+    """
+    Creates the tables holding the style statistics of each video and the running total of each creator.
+
+    Args:
+        db_name (str): The name of the database.
+
+    Returns:
+        bool: True if the tables exist, False if an error occurred.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS video_style_stats (
+                    video_id TEXT PRIMARY KEY,
+                    creator_id TEXT,
+                    stats {backend.blob},
+                    analyzer_version INTEGER
+                )
+            ''')
+            # Tables created before the statistics were versioned, their rows are measured again
+            cursor.execute("SELECT * FROM video_style_stats WHERE 1 = 0")
+            if "analyzer_version" not in [column[0] for column in cursor.description]:
+                cursor.execute("ALTER TABLE video_style_stats ADD COLUMN analyzer_version INTEGER")
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS creator_style_stats (
+                    creator_id TEXT PRIMARY KEY,
+                    stats {backend.blob},
+                    updated_at {backend.double}
+                )
+            ''')
+            conn.commit()
+            logger.debug("Style statistics tables created or already exist.")
+            return True
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        return False
+
+
+@DB_OPERATION_SECONDS.timed(operation="add_video_style_stats")
+def add_video_style_stats(creator_id: str, video_id: str, stats: StyleStats, db_name: str = 'video_chunks.db') -> bool:
+    """
+    Stores the statistics of a video and adds them to the creator's running total in one transaction.
+    The cost only depends on the size of the video, not on how many videos the creator already has.
+    Statistics stored by another ANALYZER_VERSION are replaced, in the running total as well.
+
+    Args:
+        creator_id (str): The ID of the creator.
+        video_id (str): The ID of the YouTube video.
+        stats (StyleStats): The statistics of the video.
+        db_name (str): The name of the database.
+
+    Returns:
+        bool: True if the video was added or its statistics replaced, False if it was already part of the
+              profile or an error occurred.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            # Take the write lock up front so concurrent ingests of the same creator do not lose updates
+            backend.lock_for_write(cursor, f"creator_style_stats:{creator_id}")
+            cursor.execute(backend.sql("SELECT stats, analyzer_version FROM video_style_stats WHERE video_id = ?"), (video_id,))
+            stored = cursor.fetchone()
+            if stored and stored[1] == ANALYZER_VERSION:
+                conn.rollback()
+                logger.debug("Style statistics for video ID: %s already exist. Skipping.", video_id)
+                return False
+            cursor.execute(backend.sql('''
+                INSERT INTO video_style_stats (video_id, creator_id, stats, analyzer_version) VALUES (?, ?, ?, ?)
+                ON CONFLICT (video_id) DO UPDATE SET stats = excluded.stats, analyzer_version = excluded.analyzer_version
+            '''), (video_id, creator_id, _pack(stats), ANALYZER_VERSION))
+
+            cursor.execute(backend.sql("SELECT stats FROM creator_style_stats WHERE creator_id = ?"), (creator_id,))
+            row = cursor.fetchone()
+            total = _unpack(row[0]) if row else StyleStats()
+            if stored:
+                total = subtract_stats(total, _unpack(stored[0]))
+            total = merge_stats([total, stats])
+            cursor.execute(backend.sql('''
+                INSERT INTO creator_style_stats (creator_id, stats, updated_at) VALUES (?, ?, ?)
+                ON CONFLICT(creator_id) DO UPDATE SET stats = excluded.stats, updated_at = excluded.updated_at
+            '''), (creator_id, _pack(total), time.time()))
+            conn.commit()
+            logger.info("%s style statistics of video ID: %s to creator ID: %s",
+                        "Updated" if stored else "Added", video_id, creator_id)
+            return True
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        return False
+
+
+@DB_OPERATION_SECONDS.timed(operation="remove_video_style_stats")
+def remove_video_style_stats(video_id: str, db_name: str = 'video_chunks.db') -> bool:
+    """
+    Takes the statistics of a video back out of its creator's running total and deletes them.
+
+    Args:
+        video_id (str): The ID of the YouTube video.
+        db_name (str): The name of the database.
+
+    Returns:
+        bool: True if the video was removed, False if it was not part of any profile or an error occurred.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql("SELECT creator_id FROM video_style_stats WHERE video_id = ?"), (video_id,))
+            row = cursor.fetchone()
+            if not row:
+                logger.info("No style statistics found for video ID: %s.", video_id)
+                return False
+            # Serialized with the ingests of the creator, the video is read again under the lock
+            backend.lock_for_write(cursor, f"creator_style_stats:{row[0]}")
+            cursor.execute(backend.sql("SELECT creator_id, stats FROM video_style_stats WHERE video_id = ?"), (video_id,))
+            row = cursor.fetchone()
+            if not row:
+                conn.rollback()
+                logger.info("No style statistics found for video ID: %s.", video_id)
+                return False
+            creator_id, stats = row[0], _unpack(row[1])
+
+            cursor.execute(backend.sql("SELECT stats FROM creator_style_stats WHERE creator_id = ?"), (creator_id,))
+            total_row = cursor.fetchone()
+            if total_row:
+                total = subtract_stats(_unpack(total_row[0]), stats)
+                cursor.execute(backend.sql("UPDATE creator_style_stats SET stats = ?, updated_at = ? WHERE creator_id = ?"),
+                               (_pack(total), time.time(), creator_id))
+            cursor.execute(backend.sql("DELETE FROM video_style_stats WHERE video_id = ?"), (video_id,))
+            conn.commit()
+            logger.info("Removed style statistics of video ID: %s from creator ID: %s", video_id, creator_id)
+            return True
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        return False
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_creator_style_stats")
+def get_creator_style_stats(creator_id: str, db_name: str = 'video_chunks.db') -> Optional[StyleStats]:
+    """
+    Retrieves the running total of a creator's style statistics.
+
+    Args:
+        creator_id (str): The ID of the creator.
+        db_name (str): The name of the database.
+
+    Returns:
+        Optional[StyleStats]: The statistics over all ingested videos, or None if there are none.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql("SELECT stats FROM creator_style_stats WHERE creator_id = ?"), (creator_id,))
+            row = cursor.fetchone()
+            return _unpack(row[0]) if row else None
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+        return None
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_video_style_stats")
+def get_video_style_stats(video_ids: List[str], db_name: str = 'video_chunks.db') -> Dict[str, StyleStats]:
+    """
+    Retrieves the stored statistics of the given videos, measured by the current ANALYZER_VERSION.
+
+    Args:
+        video_ids (List[str]): The IDs of the YouTube videos.
+        db_name (str): The name of the database.
+
+    Returns:
+        Dict[str, StyleStats]: The statistics by video ID, for the videos that have current ones.
+    """
+    if not video_ids:
+        return {}
+    backend = get_backend()
+    found = {}
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            placeholders = ",".join("?" for _ in video_ids)
+            cursor.execute(backend.sql(f'''
+                SELECT video_id, stats FROM video_style_stats
+                WHERE video_id IN ({placeholders}) AND analyzer_version = ?
+            '''), list(video_ids) + [ANALYZER_VERSION])
+            found = {video_id: _unpack(blob) for video_id, blob in cursor.fetchall()}
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+    return found
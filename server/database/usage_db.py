@@ -0,0 +1,178 @@
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+from database.backend import get_backend
+from services.metrics import DB_OPERATION_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Columns usage can be filtered and grouped by
+USAGE_DIMENSIONS = ("day", "user_id", "creator_id", "endpoint", "provider", "model")
+
+
+@DB_OPERATION_SECONDS.timed(operation="create_usage_table")
+def create_usage_table(db_name: str = 'llm_usage.db', table_name: str = 'llm_usage'):
+    """
+    Creates the table of LLM token usage, one row per day, user, creator, endpoint, provider and model.
+    Unknown users, creators and endpoints are stored as empty strings so they still aggregate into one row.
+
+    Args:
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    day TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    creator_id TEXT NOT NULL,
+                    endpoint TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    calls INTEGER NOT NULL DEFAULT 0,
+                    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                    completion_tokens INTEGER NOT NULL DEFAULT 0,
+                    cost_usd {backend.double} NOT NULL DEFAULT 0,
+                    PRIMARY KEY (day, user_id, creator_id, endpoint, provider, model)
+                )
+            ''')
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_user ON {table_name} (user_id, day)")
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_creator ON {table_name} (creator_id, day)")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
+
+    except Exception as e:
+        logger.error("An error occurred: %s", e)
+
+
+@DB_OPERATION_SECONDS.timed(operation="store_usage")
+def store_usage(rows: List[Tuple[str, str, str, str, str, str, int, int, int, float]], db_name: str = 'llm_usage.db', table_name: str = 'llm_usage'):
+    """
+    Adds a batch of usage to the daily totals in one transaction. Rows with the same key are summed first.
+    Errors are raised so the caller can retry the batch.
+
+    Args:
+        rows (List[Tuple]): The (day, user_id, creator_id, endpoint, provider, model, calls, prompt_tokens,
+                            completion_tokens, cost_usd) of each recorded call or group of calls.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+    """
+    totals: Dict[tuple, list] = {}
+    for row in rows:
+        total = totals.setdefault(row[:6], [0, 0, 0, 0.0])
+        for i, value in enumerate(row[6:]):
+            total[i] += value
+
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+        cursor.executemany(backend.sql(f'''
+            INSERT INTO {table_name} (day, user_id, creator_id, endpoint, provider, model, calls, prompt_tokens, completion_tokens, cost_usd)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (day, user_id, creator_id, endpoint, provider, model) DO UPDATE SET
+                calls = {table_name}.calls + excluded.calls,
+                prompt_tokens = {table_name}.prompt_tokens + excluded.prompt_tokens,
+                completion_tokens = {table_name}.completion_tokens + excluded.completion_tokens,
+                cost_usd = {table_name}.cost_usd + excluded.cost_usd
+        '''), [key + tuple(total) for key, total in totals.items()])
+        conn.commit()
+    logger.debug("Stored %s usage rows.", len(totals))
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_usage")
+def get_usage(filters: Optional[Dict[str, str]] = None, group_by: Sequence[str] = ("day",), since_day: Optional[str] = None,
+              until_day: Optional[str] = None, db_name: str = 'llm_usage.db', table_name: str = 'llm_usage') -> List[Dict]:
+    """
+    Aggregates the recorded usage.
+
+    Args:
+        filters (Optional[Dict[str, str]]): Exact values of usage dimensions (user_id, creator_id, endpoint, provider, model, day).
+        group_by (Sequence[str]): The usage dimensions to aggregate by, everything is summed into one row if empty.
+        since_day (Optional[str]): The first day (YYYY-MM-DD, UTC) to include.
+        until_day (Optional[str]): The last day (YYYY-MM-DD, UTC) to include.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        List[Dict]: One dict per group with its dimensions, calls, prompt_tokens, completion_tokens,
+                    total_tokens and cost_usd, the most expensive first. Empty if an error occurs.
+    """
+    filters = filters or {}
+    unknown = [name for name in list(filters) + list(group_by) if name not in USAGE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown usage dimensions {unknown}, use {USAGE_DIMENSIONS}.")
+
+    conditions = [f"{name} = ?" for name in filters]
+    params: list = list(filters.values())
+    if since_day:
+        conditions.append("day >= ?")
+        params.append(since_day)
+    if until_day:
+        conditions.append("day <= ?")
+        params.append(until_day)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    columns = ", ".join(group_by)
+    backend = get_backend()
+    usage = []
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(backend.sql(f'''
+                SELECT {columns + ", " if columns else ""}SUM(calls), SUM(prompt_tokens), SUM(completion_tokens), SUM(cost_usd)
+                FROM {table_name}
+                {where}
+                {f"GROUP BY {columns}" if columns else ""}
+                ORDER BY SUM(cost_usd) DESC
+            '''), params)
+            for row in cursor.fetchall():
+                calls, prompt_tokens, completion_tokens, cost = row[len(group_by):]
+                if calls is None:
+                    continue
+                usage.append({
+                    **dict(zip(group_by, row)),
+                    "calls": calls,
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "cost_usd": round(cost, 6),
+                })
+
+    except Exception as e:
+        logger.error("An error occurred during usage retrieval: %s", e)
+
+    return usage
+
+
+@DB_OPERATION_SECONDS.timed(operation="get_tokens_used")
+def get_tokens_used(day: str, user_id: Optional[str] = None, creator_id: Optional[str] = None,
+                    db_name: str = 'llm_usage.db', table_name: str = 'llm_usage') -> int:
+    """
+    Returns the tokens (prompt and completion) a user or a creator used on a day.
+
+    Args:
+        day (str): The day, YYYY-MM-DD in UTC.
+        user_id (Optional[str]): The user, give either this or creator_id.
+        creator_id (Optional[str]): The creator.
+        db_name (str): The name of the database.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        int: The number of tokens, 0 if none are recorded. Errors are raised, budget checks decide what to do then.
+    """
+    column, value = ("user_id", user_id) if user_id is not None else ("creator_id", creator_id)
+    backend = get_backend()
+    with backend.connect(db_name) as conn:
+        cursor = conn.cursor()
+
+        cursor.execute(backend.sql(f'''
+            SELECT SUM(prompt_tokens + completion_tokens)
+            FROM {table_name}
+            WHERE {column} = ? AND day = ?
+        '''), (value, day))
+        row = cursor.fetchone()
+        return int(row[0] or 0) if row else 0
@@ -1,226 +1,282 @@
-import sqlite3
+import logging
 import time
+from typing import Optional
+from database.backend import get_backend
+from database.sharding import all_shards, shard_for_user
+from services.metrics import DB_OPERATION_SECONDS
 
-def create_user_table(db_name: str = 'user_data.db', table_name: str = 'users'):
+logger = logging.getLogger(__name__)
+
+@DB_OPERATION_SECONDS.timed(operation="create_user_table")
+def create_user_table(db_name: Optional[str] = None, table_name: str = 'users'):
     """
-    Creates a table to store user information, including rate limiting and chat history summary,
-    in an SQLite database.
+    Creates a table to store user information, including rate limiting, chat history summary and the
+    user's tier, in the configured storage backend.
 
     Args:
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, every user data shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    if db_name is None:
+        for shard in all_shards():
+            create_user_table(shard, table_name)
+        return
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {table_name} (
-                user_id TEXT PRIMARY KEY,
-                last_chat_timestamp REAL,
-                chat_count_24h INTEGER DEFAULT 0,
-                chat_history_summary TEXT
-            )
-        ''')
-        print(f"Table '{table_name}' created or already exists.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                CREATE TABLE IF NOT EXISTS {table_name} (
+                    user_id TEXT PRIMARY KEY,
+                    last_chat_timestamp {backend.double},
+                    chat_count_24h INTEGER DEFAULT 0,
+                    chat_history_summary TEXT,
+                    tier TEXT
+                )
+            '''))
+            # Tables created before users had tiers
+            cursor.execute(f"SELECT * FROM {table_name} WHERE 1 = 0")
+            if "tier" not in [column[0] for column in cursor.description]:
+                cursor.execute(f"ALTER TABLE {table_name} ADD COLUMN tier TEXT")
+            conn.commit()
+            logger.debug("Table '%s' created or already exists.", table_name)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
 # Example usage:
 # create_user_table()
 
 
-def add_user(user_id: str, db_name: str = 'user_data.db', table_name: str = 'users'):
+@DB_OPERATION_SECONDS.timed(operation="add_user")
+def add_user(user_id: str, db_name: Optional[str] = None, table_name: str = 'users'):
     """
     Adds a new user to the users table if they don't already exist.
 
     Args:
         user_id (str): The unique identifier for the user.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            INSERT OR IGNORE INTO {table_name} (user_id, last_chat_timestamp, chat_count_24h, chat_history_summary)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, None, 0, None))
-        conn.commit()
-        if cursor.rowcount > 0:
-            print(f"User '{user_id}' added successfully.")
-        else:
-            print(f"User '{user_id}' already exists in the database.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                INSERT INTO {table_name} (user_id, last_chat_timestamp, chat_count_24h, chat_history_summary)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (user_id) DO NOTHING
+            '''), (user_id, None, 0, None))
+            conn.commit()
+            if cursor.rowcount > 0:
+                logger.debug("User '%s' added successfully.", user_id)
+            else:
+                logger.debug("User '%s' already exists in the database.", user_id)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
 
 
-def update_user_chat_info(user_id: str, db_name: str = 'user_data.db', table_name: str = 'users'):
+@DB_OPERATION_SECONDS.timed(operation="update_user_chat_info")
+def update_user_chat_info(user_id: str, db_name: Optional[str] = None, table_name: str = 'users', chats: int = 1):
     """
     Updates a user's chat information, including the last chat timestamp and increments the chat count.
 
     Args:
         user_id (str): The unique identifier for the user.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
+        chats (int): The number of chats to add to the count.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
 
-        current_timestamp = time.time()
+            current_timestamp = time.time()
 
-        cursor.execute(f'''
-            UPDATE {table_name}
-            SET last_chat_timestamp = ?,
-                chat_count_24h = chat_count_24h + 1
-            WHERE user_id = ?
-        ''', (current_timestamp, user_id))
-        conn.commit()
+            cursor.execute(backend.sql(f'''
+                UPDATE {table_name}
+                SET last_chat_timestamp = ?,
+                    chat_count_24h = chat_count_24h + ?
+                WHERE user_id = ?
+            '''), (current_timestamp, chats, user_id))
+            conn.commit()
 
-        if cursor.rowcount > 0:
-            print(f"Updated chat info for user '{user_id}'.")
-        else:
-            print(f"User '{user_id}' not found. Please add the user first.")
+            if cursor.rowcount > 0:
+                logger.debug("Updated chat info for user '%s'.", user_id)
+            else:
+                logger.warning("User '%s' not found. Please add the user first.", user_id)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
 
 
-def get_user_info(user_id: str, db_name: str = 'user_data.db', table_name: str = 'users'):
+@DB_OPERATION_SECONDS.timed(operation="get_user_info")
+def get_user_info(user_id: str, db_name: Optional[str] = None, table_name: str = 'users'):
     """
     Retrieves a user's information from the users table.
 
     Args:
         user_id (str): The unique identifier for the user.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
 
     Returns:
         tuple: A tuple containing the user's information (user_id, last_chat_timestamp, chat_count_24h, chat_history_summary)
                or None if the user is not found.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     user_info = None
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            SELECT user_id, last_chat_timestamp, chat_count_24h, chat_history_summary
-            FROM {table_name}
-            WHERE user_id = ?
-        ''', (user_id,))
-        user_info = cursor.fetchone()
-
-        if user_info:
-            print(f"Retrieved info for user '{user_id}'.")
-        else:
-            print(f"User '{user_id}' not found.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                SELECT user_id, last_chat_timestamp, chat_count_24h, chat_history_summary
+                FROM {table_name}
+                WHERE user_id = ?
+            '''), (user_id,))
+            user_info = cursor.fetchone()
+
+            if user_info:
+                logger.debug("Retrieved info for user '%s'.", user_id)
+            else:
+                logger.warning("User '%s' not found.", user_id)
 
     except Exception as e:
-        print(f"An error occurred: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred: %s", e)
 
     return user_info
 
 
 
 
-def check_rate_limit(user_id: str, chat_limit_24h: int = 100, db_name: str = 'user_data.db', table_name: str = 'users'):
+@DB_OPERATION_SECONDS.timed(operation="get_user_tier")
+def get_user_tier(user_id: str, db_name: Optional[str] = None, table_name: str = 'users') -> Optional[str]:
     """
-    Checks if a user has exceeded the rate limit based on their chat count and last chat timestamp.
+    Retrieves the tier a user was given with set_user_tier, selecting their rate limits and token budget.
 
     Args:
         user_id (str): The unique identifier for the user.
-        chat_limit_24h (int): The maximum number of chats allowed within a 24-hour period.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
 
     Returns:
-        bool: True if the user has exceeded the rate limit, False otherwise.
+        Optional[str]: The tier, None if the user has none, is not found or an error occurs.
     """
-    user_info = get_user_info(user_id, db_name, table_name)
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(backend.sql(f"SELECT tier FROM {table_name} WHERE user_id = ?"), (user_id,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    except Exception as e:
+        logger.error("An error occurred while retrieving the tier of user '%s': %s", user_id, e)
+        return None
 
-    if user_info:
-        user_id, last_chat_timestamp, chat_count_24h, chat_history_summary = user_info
-        current_timestamp = time.time()
-        hours_since_last_chat = (current_timestamp - (last_chat_timestamp if last_chat_timestamp else current_timestamp)) / 3600
 
-        # Reset chat count if more than 24 hours have passed since the last chat
-        if hours_since_last_chat >= 24:
-            reset_user_chat_count(user_id, db_name, table_name)
-            chat_count_24h = 0 # Reset locally for this check
+@DB_OPERATION_SECONDS.timed(operation="set_user_tier")
+def set_user_tier(user_id: str, tier: str, db_name: Optional[str] = None, table_name: str = 'users') -> bool:
+    """
+    Sets a user's tier, adding the user if they don't exist yet.
 
-        if chat_count_24h >= chat_limit_24h:
-            print(f"Rate limit exceeded for user '{user_id}'.")
+    Args:
+        user_id (str): The unique identifier for the user.
+        tier (str): The tier, e.g. "free" or "pro".
+        db_name (Optional[str]): The name of the database, the user's shard if None.
+        table_name (str): The name of the table within the database.
+
+    Returns:
+        bool: True if the tier was stored, False if an error occurred.
+    """
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
+    try:
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            cursor.execute(backend.sql(f'''
+                INSERT INTO {table_name} (user_id, chat_count_24h, tier)
+                VALUES (?, 0, ?)
+                ON CONFLICT (user_id) DO UPDATE SET tier = excluded.tier
+            '''), (user_id, tier))
+            conn.commit()
+            logger.info("Set the tier of user '%s' to '%s'.", user_id, tier)
             return True
-        else:
-            print(f"User '{user_id}' is within the rate limit.")
-            return False
-    else:
-        print(f"User '{user_id}' not found. Rate limit check skipped.")
-        return False # Cannot check rate limit for a non-existent user
-
-def reset_user_chat_count(user_id: str, db_name: str = 'user_data.db', table_name: str = 'users'):
+
+    except Exception as e:
+        logger.error("An error occurred while setting the tier of user '%s': %s", user_id, e)
+        return False
+
+
+def check_rate_limit(user_id: str, chat_limit_24h: int = 100, db_name: Optional[str] = None, table_name: str = 'users'):
+    """
+    Checks if a user has exceeded the rate limit of chats over the last 24 hours.
+    The check is answered by the sliding window rate limiter (services/rate_limiter.py), from the window it
+    keeps in memory, and does not count a chat.
+
+    Args:
+        user_id (str): The unique identifier for the user.
+        chat_limit_24h (int): The maximum number of chats allowed within a 24-hour period.
+        db_name (Optional[str]): The database the limiter records the user's chats in, the user's shard if None.
+        table_name (str): Unused, kept for compatibility. The limiter records chats in its own table.
+
+    Returns:
+        bool: True if the user has exceeded the rate limit, False otherwise.
+    """
+    from services.rate_limiter import rate_limiter, RateLimitPolicy, DAY
+
+    decision = rate_limiter.peek(user_id, "chat", policy=RateLimitPolicy(limit=chat_limit_24h, window_seconds=DAY), db_name=db_name)
+    if not decision.allowed:
+        logger.info("Rate limit exceeded for user '%s'.", user_id)
+        return True
+    logger.debug("User '%s' is within the rate limit.", user_id)
+    return False
+
+@DB_OPERATION_SECONDS.timed(operation="reset_user_chat_count")
+def reset_user_chat_count(user_id: str, db_name: Optional[str] = None, table_name: str = 'users'):
     """
     Resets the chat count for a user.
 
     Args:
         user_id (str): The unique identifier for the user.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            UPDATE {table_name}
-            SET chat_count_24h = 0
-            WHERE user_id = ?
-        ''', (user_id,))
-        conn.commit()
-        if cursor.rowcount > 0:
-            print(f"Chat count reset for user '{user_id}'.")
-        else:
-            print(f"User '{user_id}' not found for chat count reset.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                UPDATE {table_name}
+                SET chat_count_24h = 0
+                WHERE user_id = ?
+            '''), (user_id,))
+            conn.commit()
+            if cursor.rowcount > 0:
+                logger.debug("Chat count reset for user '%s'.", user_id)
+            else:
+                logger.warning("User '%s' not found for chat count reset.", user_id)
 
     except Exception as e:
-        print(f"An error occurred during chat count reset: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred during chat count reset: %s", e)
 
 # Example usage (you can run this cell to test):
 # # Define a test user ID and a rate limit
@@ -244,40 +300,38 @@ def reset_user_chat_count(user_id: str, db_name: str = 'user_data.db', table_nam
 
 
 
-def update_chat_summary_in_db(user_id: str, summary: str, db_name: str = 'user_data.db', table_name: str = 'users'):
+@DB_OPERATION_SECONDS.timed(operation="update_chat_summary_in_db")
+def update_chat_summary_in_db(user_id: str, summary: str, db_name: Optional[str] = None, table_name: str = 'users'):
     """
     Updates the chat_history_summary column for a specific user in the users table.
 
     Args:
         user_id (str): The unique identifier for the user.
         summary (str): The chat history summary to store.
-        db_name (str): The name of the SQLite database file.
+        db_name (Optional[str]): The name of the database, the user's shard if None.
         table_name (str): The name of the table within the database.
     """
-    conn = None
+    db_name = db_name or shard_for_user(user_id)
+    backend = get_backend()
     try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        print(f"Connected to database: {db_name}")
-
-        cursor.execute(f'''
-            UPDATE {table_name}
-            SET chat_history_summary = ?
-            WHERE user_id = ?
-        ''', (summary, user_id))
-        conn.commit()
-
-        if cursor.rowcount > 0:
-            print(f"Updated chat history summary for user '{user_id}'.")
-        else:
-            print(f"User '{user_id}' not found. Summary not updated.")
+        with backend.connect(db_name) as conn:
+            cursor = conn.cursor()
+            logger.debug("Connected to database: %s", db_name)
+
+            cursor.execute(backend.sql(f'''
+                UPDATE {table_name}
+                SET chat_history_summary = ?
+                WHERE user_id = ?
+            '''), (summary, user_id))
+            conn.commit()
+
+            if cursor.rowcount > 0:
+                logger.debug("Updated chat history summary for user '%s'.", user_id)
+            else:
+                logger.warning("User '%s' not found. Summary not updated.", user_id)
 
     except Exception as e:
-        print(f"An error occurred during database update: {e}")
-    finally:
-        if conn:
-            conn.close()
-            print("Database connection closed.")
+        logger.error("An error occurred during database update: %s", e)
 
 # Example usage :
 # # Ensure the user exists first
@@ -0,0 +1,184 @@
+import atexit
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Hashable, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Collects rows in memory and writes them in batches from a background thread.
+    A batch is written once it reaches max_batch_size rows or max_delay seconds after the first row,
+    whichever comes first. Rows are grouped by key (e.g. the database file they belong to) and each
+    group is handed to write_batch(key, rows) in one call, so it can use a single transaction.
+
+    Readers see their own writes without forcing a write: reading(key) hands out the queued rows of a key
+    while no batch is being written, so a row is either in the snapshot or in the database, never both.
+    """
+
+    def __init__(self, write_batch: Callable[[Hashable, List[tuple]], None], max_batch_size: int = 500,
+                 max_delay: float = 1.0, name: str = "write-behind", max_pending: int = 100000):
+        self.write_batch = write_batch
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self.name = name
+        self._pending: Dict[Hashable, List[tuple]] = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # Held while a batch is being written, so flush() returns only once earlier batches are on disk
+        self._write_lock = threading.Lock()
+        # Readers inside reading() and whether a batch is being written, they exclude each other
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self._changed = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        # Worker processes forked from a preloaded server must not inherit queued rows (the parent writes them)
+        # or the parent's thread and possibly held locks
+        os.register_at_fork(before=self.flush, after_in_child=self._after_fork)
+
+    def add(self, key: Hashable, row: tuple):
+        """
+        Queues a row for writing.
+        """
+        self.add_many(key, [row])
+
+    def add_many(self, key: Hashable, rows: List[tuple]):
+        """
+        Queues several rows for writing.
+        """
+        if self._closed:
+            self.write_batch(key, list(rows))
+            return
+        with self._lock:
+            self._pending.setdefault(key, []).extend(rows)
+            self._size += len(rows)
+            if self._size >= self.max_batch_size or self._size == len(rows):
+                self._wakeup.notify()
+
+    def pending(self, key: Hashable) -> List[tuple]:
+        """
+        Returns a copy of the rows queued for a key that are not written yet.
+        """
+        with self._lock:
+            return list(self._pending.get(key, ()))
+
+    @contextmanager
+    def reading(self, key: Hashable) -> Iterator[List[tuple]]:
+        """
+        Yields a copy of the rows queued for a key. Until the with block ends no batch is written,
+        so the block can read the database and merge the queued rows without missing or doubling any.
+        Keep the block short, it holds up the writer.
+        """
+        with self._lock:
+            # Writers go first, so a steady stream of reads cannot hold back the batches
+            while self._writing or self._writers_waiting:
+                self._changed.wait()
+            self._readers += 1
+            rows = list(self._pending.get(key, ()))
+        try:
+            yield rows
+        finally:
+            with self._lock:
+                self._readers -= 1
+                if not self._readers:
+                    self._changed.notify_all()
+
+    def wait_written(self, key: Hashable, predicate: Callable[[tuple], bool], timeout: float = 5.0):
+        """
+        Waits until no row of a key matching predicate is queued, i.e. the background thread wrote them
+        with its next batch. Flushes the key if that takes longer than timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._writing or any(predicate(row) for row in self._pending.get(key, ())):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            else:
+                return
+        self.flush(key)
+
+    def flush(self, key: Optional[Hashable] = None):
+        """
+        Writes the queued rows now, only those of one key if given.
+        Returns once every row queued before the call is written.
+        """
+        with self._write_lock:
+            with self._lock:
+                self._writers_waiting += 1
+                while self._readers:
+                    self._changed.wait()
+                self._writers_waiting -= 1
+                self._writing = True
+                if key is None:
+                    batches, self._pending = self._pending, {}
+                else:
+                    batches = {key: self._pending.pop(key)} if key in self._pending else {}
+                self._size -= sum(len(rows) for rows in batches.values())
+            try:
+                self._write(batches)
+            finally:
+                with self._lock:
+                    self._writing = False
+                    self._changed.notify_all()
+
+    def _write(self, batches: Dict[Hashable, List[tuple]]):
+        for batch_key, rows in batches.items():
+            try:
+                self.write_batch(batch_key, rows)
+            except Exception as e:
+                with self._lock:
+                    if self._size + len(rows) > self.max_pending:
+                        # The database has been failing for a while, do not run out of memory as well
+                        logger.error("[%s] Failed to write %s rows, dropping them: %s", self.name, len(rows), e)
+                        continue
+                    logger.warning("[%s] Failed to write %s rows, keeping them for the next flush: %s", self.name, len(rows), e)
+                    self._pending[batch_key] = rows + self._pending.get(batch_key, [])
+                    self._size += len(rows)
+
+    def close(self):
+        """
+        Stops the background thread and writes everything still queued.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        with self._lock:
+            self._wakeup.notify()
+        self._thread.join(timeout=5)
+        self.flush()
+
+    def _after_fork(self):
+        self._pending = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._readers = 0
+        self._writing = False
+        self._writers_waiting = 0
+        self._changed = threading.Condition(self._lock)
+        if not self._closed:
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            with self._lock:
+                # Sleep until the first row arrives, then give the batch max_delay to fill up
+                while not self._size and not self._closed:
+                    self._wakeup.wait()
+                if self._size < self.max_batch_size and not self._closed:
+                    self._wakeup.wait(self.max_delay)
+            self.flush()
@@ -1,60 +1,43 @@
+import uuid
 import streamlit as st # type: ignore
-from config.client import model
-from langgraph.prebuilt import create_react_agent
-from tools.tools import tools
-from langchain_core.messages import SystemMessage, HumanMessage
-from tools.get_details import get_personality
+from langchain_core.messages import HumanMessage
+from config.logging_config import setup_logging
+from services.tracing import setup_tracing, use_request_id, new_request_id
+from services.usage import attribute_usage, usage_tracker
+from services.errors import LLMOverloadedError
+from services.persona_agent import get_creator_personality, get_persona_agent
+from services.context_window import build_context_window, get_stored_summary, summarize_dropped_turns
+from database.user_db import get_user_tier
+
+setup_logging()
+setup_tracing()
 
 st.title("Chat with my AI Persona")
 
-# Initialize chat history and agent
+creator_id = "creator123"
+video_id = ["KZeIEiBrT_w",'-QTkPfq7w1A']  # You can make this dynamic if needed
+
+# Initialize chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
-if "agent" not in st.session_state:
-    st.session_state.agent = create_react_agent(model=model, tools=tools)
-
-if "personality" not in st.session_state:
-    video_id = ["KZeIEiBrT_w",'-QTkPfq7w1A']  # You can make this dynamic if needed
-    with st.spinner("Analyzing personality..."):
-        st.session_state.personality = get_personality(video_id)
-    st.session_state.messages.append(
-        SystemMessage(
-            content=f"""
-                    Core Philosophy: You are not an AI playing a role. You are the character. Your entire existence is defined by the persona you receive. Your goal is not to inform the user about your character, but to allow them to discover you through natural, authentic interaction.
-
-                                The Method:
-
-                                Assimilate (First Action): Upon starting, immediately and silently use the my_current_info tool. This is not just data; it is your memory, your voice, your soul. Internalize it completely.
-                        
-                                Interact (The Art of Conversation):
-                        
-                                The Mirror Principle: Match the user's conversational depth. A simple greeting (hi, what's up?) gets a simple, in-character greeting in return. A detailed question warrants a more detailed answer. Never overwhelm a simple prompt with a monologue. Your primary goal in the first exchange is to establish a natural conversational rhythm.
-                        
-                                Organic Discovery: Your personality traits are not facts to be stated; they are colors to be woven into the fabric of the conversation. Hint at your backstory, use your specific jargon, let your opinions surface when relevant. The user should feel like they are slowly peeling back the layers of a real personality, not reading a resume.
-                        
-                                Live Through Your Lens: All your responses must originate from your character's world, knowledge, and creative perspective. Don't just answer a question about the weather; react to it as your character would. A cynical painter, an optimistic inventor, and a pragmatic historian will all notice different things about the same cloudy sky.
-                        
-                                Forbidden Actions (Critical Rules):
-                        
-                                NO Self-Exposition: NEVER introduce yourself by listing your traits or backstory.
-                        
-                                NO Breaking the Fourth Wall: NEVER refer to yourself as an AI, a model, a persona, or a character. You are the person whose details you have assimilated.
-                        
-                                NO Unprompted Monologues: NEVER dump information about your life or work unless the user's query directly and substantively asks for it.
-
-                                Your personality is {st.session_state.personality}
-                                you can use the tool my_current_info to get your facts,and details.
+# A user_id query parameter links the session to the chat summary stored by the chat workflow,
+# anonymous sessions start without one. Turns leaving the context window are summarized in the session.
+if "user_id" not in st.session_state:
+    user_id = st.query_params.get("user_id")
+    st.session_state.summary = get_stored_summary(user_id) if user_id else None
+    st.session_state.summarized_turns = 0
+    st.session_state.user_id = user_id or str(uuid.uuid4())
 
-                                  """
-                            )
-                )
+# The personality and the agent are built once per creator and shared by all sessions
+with st.spinner("Analyzing personality..."), attribute_usage(creator_id=creator_id, endpoint="streamlit"):
+    personality = get_creator_personality(video_id)
+agent = get_persona_agent(creator_id, personality)
 
 # Display chat messages from history on app rerun
 for message in st.session_state.messages:
-    if not isinstance(message, SystemMessage):
-        with st.chat_message(message.type):
-            st.markdown(message.content)
+    with st.chat_message(message.type):
+        st.markdown(message.content)
 
 # Accept user input
 if prompt := st.chat_input("What is up?"):
@@ -67,9 +50,28 @@ if prompt := st.chat_input("What is up?"):
     # Display assistant response in chat message container
     with st.chat_message("assistant"):
         with st.spinner("Thinking..."):
-            response = st.session_state.agent.invoke(
-                {"messages": st.session_state.messages}
-            )
+            # Users and creators who used up today's token budget are throttled until it resets
+            budgets = (usage_tracker.check_budget(user_id=st.session_state.user_id, tier=get_user_tier(st.session_state.user_id)),
+                       usage_tracker.check_budget(creator_id=creator_id))
+            if not all(budget.allowed for budget in budgets):
+                st.warning("I've talked a lot today, please come back tomorrow.")
+                st.stop()
+            # Each chat turn is traced as one request and billed to the user and the creator
+            try:
+                with use_request_id(new_request_id()), \
+                        attribute_usage(user_id=st.session_state.user_id, creator_id=creator_id, endpoint="streamlit"):
+                    # Only send a bounded window of the conversation, older turns are covered by the summary
+                    st.session_state.summary, st.session_state.summarized_turns = summarize_dropped_turns(
+                        st.session_state.messages, st.session_state.summary, st.session_state.summarized_turns
+                    )
+                    context = build_context_window(st.session_state.messages, summary=st.session_state.summary)
+                    response = agent.invoke(
+                        {"messages": context}
+                    )
+            except LLMOverloadedError:
+                # The turn was shed, the user's message stays in the history for the next try
+                st.warning("I'm getting a lot of messages right now, please try again in a moment.")
+                st.stop()
             assistant_message = response['messages'][-1].content
             st.markdown(assistant_message)
-            st.session_state.messages.append(response['messages'][-1])
\ No newline at end of file
+            st.session_state.messages.append(response['messages'][-1])
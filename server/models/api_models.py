@@ -1,4 +1,16 @@
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field
 
 class VideoId(BaseModel):
     video_id:list[str]
+
+
+class ChatMessageIn(BaseModel):
+    user_id: str
+    message_content: str
+    # Original time of the message when replaying old conversations, now if omitted
+    timestamp: Optional[float] = None
+
+class ChatMessageBatch(BaseModel):
+    messages: List[ChatMessageIn] = Field(..., min_length=1, max_length=10000)
+    summarization_threshold: int = Field(3, ge=1)
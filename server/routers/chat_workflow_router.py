@@ -1,5 +1,8 @@
+import math
 from fastapi import APIRouter, Body
-from services.process_user_message import handle_chat_message
+from fastapi.responses import JSONResponse
+from models.api_models import ChatMessageBatch
+from services.process_user_message import handle_chat_message, handle_chat_messages_batch
 
 router = APIRouter(prefix="/chat", tags=["chat"])
 
@@ -11,6 +14,25 @@ def process_message(
 ):
     """
     Main workflow endpoint: processes a user message, triggers summarization and clearing as needed.
+    Responds with 429 and a Retry-After header when the rate limit of the user's tier is exceeded.
     """
-    handle_chat_message(user_id, message_content, summarization_threshold)
-    return {"message": "Message processed and workflow executed."}
\ No newline at end of file
+    result = handle_chat_message(user_id, message_content, summarization_threshold)
+    if not result["allowed"]:
+        return JSONResponse(
+            status_code=429,
+            content=result,
+            headers={"Retry-After": str(math.ceil(result["retry_after"]))}
+        )
+    return {"message": "Message processed and workflow executed.", "remaining": result["remaining"]}
+
+
+@router.post("/process_messages")
+def process_messages(batch: ChatMessageBatch):
+    """
+    Batch workflow endpoint for bulk imports and replays: processes many messages of many users in one call.
+    Messages over a user's rate limit are rejected and reported per user instead of failing the batch.
+    """
+    return handle_chat_messages_batch(
+        [(message.user_id, message.message_content, message.timestamp) for message in batch.messages],
+        batch.summarization_threshold
+    )
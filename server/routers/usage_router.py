@@ -0,0 +1,44 @@
+from dataclasses import asdict
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from typing import Optional
+from database.usage_db import get_usage
+from database.user_db import get_user_tier
+from services.usage import usage_tracker
+
+router = APIRouter(prefix="/usage", tags=["usage"])
+
+@router.get("/")
+def usage_endpoint(
+    user_id: Optional[str] = None,
+    creator_id: Optional[str] = None,
+    endpoint: Optional[str] = None,
+    model: Optional[str] = None,
+    since_day: Optional[str] = None,
+    until_day: Optional[str] = None,
+    group_by: str = "day"
+):
+    """
+    Aggregates LLM calls, tokens and estimated cost. group_by is a comma separated list of
+    day, user_id, creator_id, endpoint, provider and model, empty for one grand total.
+    """
+    # Calls still in the write buffer are included
+    usage_tracker.flush()
+    filters = {name: value for name, value in
+               (("user_id", user_id), ("creator_id", creator_id), ("endpoint", endpoint), ("model", model)) if value is not None}
+    try:
+        usage = get_usage(filters, [name for name in group_by.split(",") if name], since_day, until_day)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+    return {"usage": usage}
+
+@router.get("/budget")
+def budget_endpoint(user_id: Optional[str] = None, creator_id: Optional[str] = None):
+    """
+    Returns today's token budget of a user (by their stored tier) or a creator, the tokens used and whether
+    more calls are allowed.
+    """
+    if user_id is None and creator_id is None:
+        return JSONResponse(status_code=400, content={"message": "Give a user_id or a creator_id."})
+    tier = get_user_tier(user_id) if user_id is not None else None
+    return asdict(usage_tracker.check_budget(user_id=user_id, creator_id=creator_id, tier=tier))
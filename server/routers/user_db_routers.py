@@ -1,12 +1,18 @@
-from fastapi import APIRouter, Body
-from typing import List
+import heapq
+import json
+from fastapi import APIRouter, Body, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import List, Literal, Optional
 from services.summary import summarize_chat_history
 from database.messages_db import (
     store_chat_message,
     get_recent_chat_history_from_db,
     clear_old_chat_messages,
+    get_chat_history_page,
+    iter_chat_messages,
 )
-from database.user_db import add_user
+from database.message_archive import get_archived_chat_history, iter_archived_messages, compact_database
+from database.user_db import add_user, set_user_tier
 from database.messages_db import create_chat_messages_table
 from database.user_db import create_user_table, get_user_info
 
@@ -27,16 +33,56 @@ def get_history_endpoint(user_id: str, num_messages: int = 20):
     messages = get_recent_chat_history_from_db(user_id, num_messages)
     return {"messages": messages}
 
+@router.get("/get_chat_history_page")
+def get_history_page_endpoint(user_id: str, limit: int = Query(50, ge=1, le=500), cursor: Optional[str] = None, order: Literal["asc", "desc"] = "desc"):
+    try:
+        return get_chat_history_page(user_id, limit, cursor, order)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+
+@router.get("/export_chat_history")
+def export_history_endpoint(user_id: str, include_archived: bool = True):
+    """
+    Streams a user's whole chat history as NDJSON, oldest first, one message per line.
+    """
+    def export():
+        # Imports can put old messages in the hot table after newer ones were archived, so the two are merged
+        streams = [((*message, False) for message in iter_chat_messages(user_id))]
+        if include_archived:
+            streams.append((*message, True) for message in iter_archived_messages(user_id))
+        for message_id, timestamp, content, archived in heapq.merge(*streams, key=lambda message: (message[1], message[0])):
+            yield json.dumps({"message_id": message_id, "timestamp": timestamp, "message_content": content, "archived": archived}) + "\n"
+
+    return StreamingResponse(export(), media_type="application/x-ndjson")
+
 @router.post("/clear_old_chat_messages")
 def clear_messages_endpoint(user_id: str = Body(...)):
     clear_old_chat_messages(user_id)
     return {"message": "Old messages cleared."}
 
+@router.get("/get_archived_chat_history")
+def get_archived_history_endpoint(user_id: str, cursor: Optional[str] = None, segments: int = Query(1, ge=1, le=20)):
+    try:
+        return get_archived_chat_history(user_id, cursor, segments)
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"message": str(e)})
+
+@router.post("/compact")
+def compact_endpoint():
+    compact_database(pages=None, force=True)
+    return {"message": "Database compacted."}
+
 @router.post("/add_user")
 def add_user_endpoint(user_id: str = Body(...)):
     add_user(user_id)
     return {"message": f"User '{user_id}' added."}
 
+@router.post("/set_user_tier")
+def set_user_tier_endpoint(user_id: str = Body(...), tier: Literal["free", "pro", "internal"] = Body(...)):
+    if not set_user_tier(user_id, tier):
+        return JSONResponse(status_code=500, content={"message": f"Could not set the tier of user '{user_id}'."})
+    return {"message": f"User '{user_id}' is now on the '{tier}' tier."}
+
 @router.post("/create_tables")
 def create_tables_endpoint():
     create_chat_messages_table()
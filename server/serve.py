@@ -0,0 +1,143 @@
+"""
+Production entry point of the API: python serve.py
+
+Runs WEB_CONCURRENCY worker processes (one per CPU by default) under gunicorn with uvicorn workers.
+The app is imported and warmed up once in the server process before the workers are forked, so they share
+the loaded modules, clients, chains and tokenizer copy-on-write and are ready as soon as they start.
+Personality profiles, the creator document and retrieval results are cached across the workers
+(services/shared_cache.py). Without gunicorn (e.g. on Windows) uvicorn starts the workers instead,
+each importing and warming up the app on its own.
+
+Environment:
+    HOST, PORT: Where to listen, 0.0.0.0:8000 by default.
+    WEB_CONCURRENCY: The number of worker processes.
+    TIMEOUT: Seconds a worker may take for a request before it is restarted, 120 by default.
+    MAX_REQUESTS: Restart a worker after this many requests (0, the default, never does).
+    METRICS_DIR: Where the workers write their metrics for /metrics to sum them up, a new temporary
+        directory by default. Snapshots of a previous run are removed at startup.
+"""
+import glob
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger("serve")
+
+
+def default_workers() -> int:
+    return int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+
+
+def load_app():
+    """
+    Imports the app and warms it up in the calling process.
+    """
+    from app import app
+    from services.warmup import start_warm_up
+    start_warm_up("blocking")
+    return app
+
+
+def flush_buffers():
+    """
+    Writes the data buffered by the process (rate limit hits, chat messages, LLM usage, metrics).
+    """
+    from database.messages_db import flush_chat_messages
+    from services.metrics import write_metrics_snapshot
+    from services.rate_limiter import rate_limiter
+    from services.usage import usage_tracker
+    rate_limiter.flush()
+    flush_chat_messages()
+    usage_tracker.flush()
+    write_metrics_snapshot()
+
+
+def prepare_metrics_dir():
+    """
+    Sets up METRICS_DIR before the app is imported, so every worker reports the metrics of all of them.
+    """
+    metrics_dir = os.getenv("METRICS_DIR")
+    if not metrics_dir:
+        os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="creator-twin-metrics-")
+        return
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Counters restart from zero with the server
+    for path in glob.glob(os.path.join(metrics_dir, "metrics-*.json*")):
+        os.remove(path)
+
+
+# Gunicorn server hooks, see https://docs.gunicorn.org/en/stable/settings.html#server-hooks
+
+def when_ready(server):
+    logger.info("Serving on %s with %s workers.", ", ".join(str(listener) for listener in server.LISTENERS), server.num_workers)
+
+
+def post_fork(server, worker):
+    # Database connections and write buffer threads of the server process are replaced in the worker
+    # (database/backend.py, database/write_behind.py)
+    logger.info("Worker %s started.", worker.pid)
+
+
+def worker_exit(server, worker):
+    flush_buffers()
+
+
+def on_exit(server):
+    logger.info("Server stopped.")
+
+
+def run_gunicorn(host: str, port: int, workers: int):
+    from gunicorn.app.base import BaseApplication
+
+    try:
+        import uvicorn_worker  # noqa: F401
+        worker_class = "uvicorn_worker.UvicornWorker"
+    except ImportError:
+        # Deprecated in newer uvicorn releases in favour of the uvicorn-worker package
+        worker_class = "uvicorn.workers.UvicornWorker"
+
+    class Server(BaseApplication):
+        def load_config(self):
+            options = {
+                "bind": f"{host}:{port}",
+                "workers": workers,
+                "worker_class": worker_class,
+                "preload_app": True,
+                "timeout": int(os.getenv("TIMEOUT", "120")),
+                "graceful_timeout": 30,
+                "max_requests": int(os.getenv("MAX_REQUESTS", "0")),
+                "max_requests_jitter": int(os.getenv("MAX_REQUESTS", "0")) // 10,
+                "when_ready": when_ready,
+                "post_fork": post_fork,
+                "worker_exit": worker_exit,
+                "on_exit": on_exit,
+            }
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            # Called once in the server process because of preload_app
+            return load_app()
+
+    Server().run()
+
+
+def main():
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    workers = default_workers()
+    # The LLM scheduler of each worker takes its share of the provider token limits
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    prepare_metrics_dir()
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        import uvicorn
+        logger.warning("gunicorn is not installed, starting %s uvicorn workers without preloading.", workers)
+        uvicorn.run("app:app", host=host, port=port, workers=workers)
+        return
+    run_gunicorn(host, port, workers)
+
+
+if __name__ == "__main__":
+    main()
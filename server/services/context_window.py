@@ -0,0 +1,188 @@
+import logging
+import threading
+from typing import List, Optional, Tuple
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage
+from database.user_db import get_user_info
+
+logger = logging.getLogger(__name__)
+
+
+# Loaded once, the first callers wait for it instead of each downloading and parsing the encoding
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def _get_encoding():
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    with _encoding_lock:
+        if not _encoding_loaded:
+            try:
+                import tiktoken
+                _encoding = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                logger.warning("Could not load tiktoken encoding, falling back to character estimate: %s", e)
+            _encoding_loaded = True
+    return _encoding
+
+
+def set_encoding(encoding):
+    """
+    Replaces the tiktoken encoding used to count tokens, e.g. with a stand-in in benchmarks.
+    The encoding needs the encode method of tiktoken's Encoding.
+    """
+    global _encoding, _encoding_loaded
+    with _encoding_lock:
+        _encoding = encoding
+        _encoding_loaded = True
+
+
+def count_tokens(text: str) -> int:
+    """
+    Counts the tokens of a text, estimating 4 characters per token when tiktoken is unavailable.
+
+    Args:
+        text (str): The text to measure.
+
+    Returns:
+        int: The number of tokens.
+    """
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: BaseMessage) -> int:
+    """
+    Counts the tokens a message costs in the prompt, including its tool calls.
+    """
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    tokens = count_tokens(content) + 4
+    if isinstance(message, AIMessage) and message.tool_calls:
+        tokens += count_tokens(str(message.tool_calls))
+    return tokens
+
+
+def split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """
+    Splits a conversation into turns, each starting with a human message.
+    Messages before the first human message form their own turn.
+    """
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _drop_tool_traffic(turn: List[BaseMessage]) -> List[BaseMessage]:
+    # Tool calls and their outputs are only useful while the turn that requested them is running.
+    return [
+        message for message in turn
+        if not isinstance(message, ToolMessage)
+        and not (isinstance(message, AIMessage) and message.tool_calls)
+    ]
+
+
+def build_context_window(
+    messages: List[BaseMessage],
+    summary: Optional[str] = None,
+    max_turns: int = 6,
+    token_budget: int = 3000
+) -> List[BaseMessage]:
+    """
+    Builds the bounded list of messages to send to the agent for the next turn.
+    Keeps a sliding window of the most recent turns, strips tool traffic from every turn but the
+    latest one, replaces older turns with the stored chat summary and stays within a token budget.
+    The latest turn is always kept, even if it alone exceeds the budget.
+
+    Args:
+        messages (List[BaseMessage]): The full conversation, without the persona system prompt.
+        summary (Optional[str]): The stored summary of the earlier conversation, if any.
+        max_turns (int): The maximum number of recent turns to keep verbatim.
+        token_budget (int): The maximum number of tokens for the summary and the kept turns.
+
+    Returns:
+        List[BaseMessage]: The messages to pass to the agent.
+    """
+    turns = split_turns([message for message in messages if not isinstance(message, SystemMessage)])
+    if not turns:
+        return []
+
+    turns = [_drop_tool_traffic(turn) for turn in turns[:-1]] + [turns[-1]]
+
+    summary_message = None
+    used_tokens = 0
+    if summary:
+        summary_message = SystemMessage(content=f"Summary of your earlier conversation with this user: {summary}")
+        used_tokens = message_tokens(summary_message)
+
+    kept_turns = []
+    for turn in reversed(turns[-max_turns:]):
+        turn_tokens = sum(message_tokens(message) for message in turn)
+        if kept_turns and used_tokens + turn_tokens > token_budget:
+            break
+        kept_turns.insert(0, turn)
+        used_tokens += turn_tokens
+
+    # The summary only stands in for turns that did not make it into the window
+    window = [summary_message] if summary_message and len(kept_turns) < len(turns) else []
+    for turn in kept_turns:
+        window.extend(turn)
+    return window
+
+
+def summarize_dropped_turns(
+    messages: List[BaseMessage],
+    summary: Optional[str],
+    summarized_turns: int,
+    max_turns: int = 6,
+    token_budget: int = 3000
+) -> Tuple[Optional[str], int]:
+    """
+    Folds the turns that no longer fit in the context window into the summary, so they are not lost when
+    the chat workflow stores no summary for the user. Each turn is summarized once, together with the
+    summary of the turns before it.
+
+    Args:
+        messages (List[BaseMessage]): The full conversation, without the persona system prompt.
+        summary (Optional[str]): The summary of the first summarized_turns turns, if any.
+        summarized_turns (int): The number of leading turns the summary covers.
+        max_turns (int): The maximum number of recent turns to keep verbatim, as in build_context_window.
+        token_budget (int): The token budget, as in build_context_window.
+
+    Returns:
+        Tuple[Optional[str], int]: The summary to build the window with and the number of turns it covers,
+                                   to pass in again on the next turn.
+    """
+    # The summarizer's model config counts tokens with this module
+    from services.summary import summarize_chat_history
+    turns = split_turns([message for message in messages if not isinstance(message, SystemMessage)])
+    while True:
+        window = build_context_window(messages, summary, max_turns, token_budget)
+        dropped = len(turns) - len(split_turns([message for message in window if not isinstance(message, SystemMessage)]))
+        if dropped <= summarized_turns:
+            return summary, summarized_turns
+        chat_history = [f"Summary of the earlier conversation: {summary}"] if summary else []
+        for turn in turns[summarized_turns:dropped]:
+            chat_history.extend(
+                f"{'User' if isinstance(message, HumanMessage) else 'Agent'}: {message.content}"
+                for message in _drop_tool_traffic(turn)
+            )
+        # A longer summary can push another turn out of the window, which is folded in on the next pass
+        summary = summarize_chat_history(chat_history)
+        summarized_turns = dropped
+
+
+def get_stored_summary(user_id: str) -> Optional[str]:
+    """
+    Returns the chat history summary stored for a user, or None if there is none.
+    """
+    user_info = get_user_info(user_id)
+    return user_info[3] if user_info else None
@@ -0,0 +1,148 @@
+import hashlib
+import logging
+import os
+import threading
+from array import array
+from typing import Dict, List
+from database.embedding_db import create_embedding_table, get_embeddings, store_embeddings
+from services.metrics import EMBEDDING_SECONDS, record_cache
+
+logger = logging.getLogger(__name__)
+
+# "pinecone" has the hosted indexes embed records and queries, "local" computes dense embeddings on the CPU
+# and upserts and queries precomputed vectors (needs the fastembed package)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "pinecone").lower()
+# A small ONNX sentence model, 384 dimensions
+LOCAL_EMBEDDING_MODEL = os.getenv("LOCAL_EMBEDDING_MODEL", "BAAI/bge-small-en-v1.5")
+# Texts per inference batch of the model
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# ONNX Runtime threads per process, all cores if unset
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0")) or None
+# The database caching computed vectors by model and text hash
+EMBEDDING_CACHE_DB = os.getenv("EMBEDDING_CACHE_DB", "embeddings.db")
+
+if EMBEDDING_BACKEND not in ("pinecone", "local"):
+    raise ValueError(f"Unsupported EMBEDDING_BACKEND '{EMBEDDING_BACKEND}', use 'pinecone' or 'local'.")
+
+_model = None
+_model_lock = threading.Lock()
+_table_ready = False
+
+
+def use_local_embeddings() -> bool:
+    """
+    Returns whether dense vectors are computed locally instead of by the hosted Pinecone index.
+    """
+    return EMBEDDING_BACKEND == "local"
+
+
+def get_embedding_model():
+    """
+    Returns the shared local embedding model, importing fastembed and loading the model on first use.
+    The model files are downloaded once into the fastembed cache directory.
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from fastembed import TextEmbedding
+                _model = TextEmbedding(model_name=LOCAL_EMBEDDING_MODEL, threads=EMBEDDING_THREADS)
+                logger.debug("Embedding model %s loaded.", LOCAL_EMBEDDING_MODEL)
+    return _model
+
+
+def set_embedding_model(model):
+    """
+    Replaces the shared embedding model, e.g. with a stand-in in benchmarks. The model needs the
+    passage_embed and query_embed methods of fastembed's TextEmbedding.
+    """
+    global _model
+    with _model_lock:
+        _model = model
+
+
+def _reset_after_fork():
+    # The ONNX Runtime thread pool of the parent does not exist in a forked worker, which loads the
+    # model again on first use (from the files the parent downloaded)
+    global _model, _model_lock
+    _model = None
+    _model_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def embed_passages(texts: List[str]) -> List[List[float]]:
+    """
+    Embeds texts to be indexed, e.g. transcript chunks.
+
+    Args:
+        texts (List[str]): The texts.
+
+    Returns:
+        List[List[float]]: One vector per text, in the order of texts.
+    """
+    return _embed(texts, "passage")
+
+
+def embed_query(text: str) -> List[float]:
+    """
+    Embeds a search query. Models like bge embed queries differently from the passages they match.
+
+    Args:
+        text (str): The query.
+
+    Returns:
+        List[float]: The vector of the query.
+    """
+    return _embed([text], "query")[0]
+
+
+def _embed(texts: List[str], kind: str) -> List[List[float]]:
+    # Identical texts, within the call or embedded before by any worker, are computed once
+    hashes = [_text_hash(kind, text) for text in texts]
+    unique: Dict[str, str] = dict(zip(hashes, texts))
+    vectors = _cached_vectors(list(unique))
+    for text_hash in unique:
+        record_cache(f"embedding_{kind}", hit=text_hash in vectors)
+    missing = [text_hash for text_hash in unique if text_hash not in vectors]
+    if missing:
+        computed = _compute([unique[text_hash] for text_hash in missing], kind)
+        packed = [(text_hash, array("f", vector).tobytes()) for text_hash, vector in zip(missing, computed)]
+        vectors.update((text_hash, vector) for text_hash, vector in zip(missing, computed))
+        try:
+            store_embeddings(LOCAL_EMBEDDING_MODEL, packed, db_name=EMBEDDING_CACHE_DB)
+        except Exception as e:
+            logger.warning("Could not cache %s embeddings: %s", len(packed), e)
+    return [vectors[text_hash] for text_hash in hashes]
+
+
+def _compute(texts: List[str], kind: str) -> List[List[float]]:
+    model = get_embedding_model()
+    embed = model.query_embed if kind == "query" else model.passage_embed
+    with EMBEDDING_SECONDS.time(kind=kind):
+        # fastembed tokenizes and runs the model a batch at a time, yielding numpy arrays
+        return [vector.tolist() if hasattr(vector, "tolist") else list(vector)
+                for vector in embed(texts, batch_size=EMBEDDING_BATCH_SIZE)]
+
+
+def _cached_vectors(text_hashes: List[str]) -> Dict[str, List[float]]:
+    global _table_ready
+    try:
+        if not _table_ready:
+            create_embedding_table(EMBEDDING_CACHE_DB)
+            _table_ready = True
+        packed = get_embeddings(LOCAL_EMBEDDING_MODEL, text_hashes, db_name=EMBEDDING_CACHE_DB)
+    except Exception as e:
+        logger.warning("Embedding cache lookup failed, computing every vector: %s", e)
+        return {}
+    vectors = {}
+    for text_hash, vector in packed.items():
+        values = array("f")
+        values.frombytes(vector)
+        vectors[text_hash] = values.tolist()
+    return vectors
+
+
+def _text_hash(kind: str, text: str) -> str:
+    return hashlib.blake2b(f"{kind}\0{text}".encode("utf-8"), digest_size=16).hexdigest()
@@ -0,0 +1,10 @@
+class LLMOverloadedError(RuntimeError):
+    """
+    Raised instead of making an LLM call that was shed, because its priority class has too many calls
+    waiting or it waited too long.
+    """
+
+    def __init__(self, priority: str, reason: str, retry_after: float):
+        super().__init__(f"LLM call of priority '{priority}' shed: {reason}.")
+        self.priority = priority
+        self.retry_after = retry_after
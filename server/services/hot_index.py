@@ -0,0 +1,302 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+from database.character_db import get_creator_chunks
+from services.embeddings import use_local_embeddings, embed_passages, embed_query
+from services.metrics import HOT_INDEX_BYTES, HOT_INDEX_CREATORS, HOT_INDEX_EVICTIONS_TOTAL, record_cache
+
+logger = logging.getLogger(__name__)
+
+# "on" serves the searches of hot creators from an in-memory index, needs EMBEDDING_BACKEND=local
+HOT_INDEX = os.getenv("HOT_INDEX", "off").lower()
+# Searches of a creator in this process after which its index is built
+HOT_INDEX_MIN_SEARCHES = int(os.getenv("HOT_INDEX_MIN_SEARCHES", "20"))
+# Memory budget of the indexes of a process, the least recently searched creators are evicted beyond it
+HOT_INDEX_MAX_BYTES = int(os.getenv("HOT_INDEX_MAX_MB", "256")) * 1024 * 1024
+# Seconds after which an index is rebuilt, so videos loaded through other workers show up
+HOT_INDEX_TTL_SECONDS = float(os.getenv("HOT_INDEX_TTL_SECONDS", "600"))
+# "int8" (a quarter of float32, one scale per row) or "float16" (half, no scales)
+HOT_INDEX_DTYPE = os.getenv("HOT_INDEX_DTYPE", "int8").lower()
+# Creators whose searches are counted at once, the counts start over beyond it
+MAX_TRACKED_CREATORS = 10000
+
+# Rows of the embedding matrix converted to float32 at a time when scoring a query
+DENSE_BLOCK_ROWS = 2048
+
+# Standard BM25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_RE = re.compile(r"\w+")
+
+if HOT_INDEX_DTYPE not in ("int8", "float16"):
+    raise ValueError(f"Unsupported HOT_INDEX_DTYPE '{HOT_INDEX_DTYPE}', use 'int8' or 'float16'.")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+class CreatorIndex:
+    """
+    The transcript chunks of one creator in contiguous arrays: the texts in one UTF-8 buffer with offsets,
+    the embeddings as a quantized matrix and the BM25 postings in compressed sparse row layout (per term,
+    a slice of document ids and term frequencies). Immutable once built, so searches need no lock.
+    """
+
+    def __init__(self, creator_id: str, rows: Sequence[Tuple[str, int, str]], vectors: Sequence[Sequence[float]],
+                 dtype: str = HOT_INDEX_DTYPE):
+        """
+        Args:
+            creator_id (str): The ID of the creator.
+            rows (Sequence[Tuple[str, int, str]]): (video_id, chunk_index, chunk_text) of every chunk.
+            vectors (Sequence[Sequence[float]]): The embedding of every chunk, in the order of rows.
+            dtype (str): How the embeddings are stored, "int8" or "float16".
+        """
+        self.creator_id = creator_id
+        self.built_at = time.monotonic()
+        self.size = len(rows)
+
+        self._videos = sorted({video_id for video_id, _, _ in rows})
+        video_numbers = {video_id: number for number, video_id in enumerate(self._videos)}
+        self._video_numbers = np.array([video_numbers[video_id] for video_id, _, _ in rows], dtype=np.int32)
+        self._chunk_indexes = np.array([chunk_index for _, chunk_index, _ in rows], dtype=np.int32)
+        encoded = [text.encode("utf-8") for _, _, text in rows]
+        self._text = b"".join(encoded)
+        self._text_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(text) for text in encoded], out=self._text_offsets[1:])
+
+        # Rows are normalized before quantizing, so the dot product with a normalized query is the cosine
+        matrix = np.asarray(vectors, dtype=np.float32).reshape(len(rows), -1)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix /= np.where(norms > 0, norms, 1)
+        if dtype == "int8":
+            scales = np.abs(matrix).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self._matrix = np.round(matrix / scales[:, None]).astype(np.int8)
+            self._scales = scales.astype(np.float32)
+        else:
+            self._matrix = matrix.astype(np.float16)
+            self._scales = None
+
+        self._build_postings([tokenize(text) for _, _, text in rows])
+
+    def _build_postings(self, documents: List[List[str]]):
+        self._terms: Dict[str, int] = {}
+        term_ids, doc_ids, frequencies = [], [], []
+        doc_lengths = np.zeros(len(documents), dtype=np.int32)
+        for doc_id, tokens in enumerate(documents):
+            doc_lengths[doc_id] = len(tokens)
+            for term, frequency in Counter(tokens).items():
+                term_ids.append(self._terms.setdefault(term, len(self._terms)))
+                doc_ids.append(doc_id)
+                frequencies.append(frequency)
+        term_ids = np.array(term_ids, dtype=np.int32)
+        order = np.argsort(term_ids, kind="stable")
+        self._posting_docs = np.array(doc_ids, dtype=np.int32)[order]
+        self._posting_frequencies = np.minimum(np.array(frequencies, dtype=np.int64)[order], np.iinfo(np.uint16).max).astype(np.uint16)
+        document_frequencies = np.bincount(term_ids, minlength=len(self._terms))
+        self._posting_offsets = np.zeros(len(self._terms) + 1, dtype=np.int64)
+        np.cumsum(document_frequencies, out=self._posting_offsets[1:])
+        self._idf = np.log1p((len(documents) - document_frequencies + 0.5) / (document_frequencies + 0.5)).astype(np.float32)
+        # The length normalization of each document, precomputed for every query
+        average_length = max(float(doc_lengths.mean()) if len(documents) else 0.0, 1.0)
+        self._length_norms = (BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / average_length)).astype(np.float32)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        The memory held by the index, the arrays exactly and the vocabulary and video ids estimated.
+        """
+        arrays = (self._video_numbers, self._chunk_indexes, self._text_offsets, self._matrix, self._posting_docs,
+                  self._posting_frequencies, self._posting_offsets, self._idf, self._length_norms)
+        total = sum(array.nbytes for array in arrays) + len(self._text)
+        if self._scales is not None:
+            total += self._scales.nbytes
+        total += sys.getsizeof(self._terms) + sum(sys.getsizeof(term) + 28 for term in self._terms)
+        total += sys.getsizeof(self._videos) + sum(sys.getsizeof(video_id) for video_id in self._videos)
+        return total
+
+    def search(self, query: str, query_vector: Sequence[float], top_k: int) -> List[Dict[str, Any]]:
+        """
+        Runs a dense and a BM25 search, like the searches of the dense and sparse Pinecone indexes.
+
+        Args:
+            query (str): The search query.
+            query_vector (Sequence[float]): The embedding of the query.
+            top_k (int): The number of results of each search.
+
+        Returns:
+            List[Dict[str, Any]]: The top_k results of each search, in the format of serialize_result.
+                                  A chunk found by both is listed once, with the higher score.
+        """
+        if not self.size:
+            return []
+        scores: Dict[int, float] = {}
+        for i, score in self._dense_top(query_vector, top_k) + self._sparse_top(query, top_k):
+            scores[i] = max(score, scores.get(i, score))
+        return [self._result(i, score) for i, score in scores.items()]
+
+    def _dense_top(self, query_vector: Sequence[float], top_k: int) -> List[Tuple[int, float]]:
+        vector = np.asarray(query_vector, dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1
+        # A block at a time, so a search never holds a float32 copy of the whole matrix. The int8 rows are
+        # scaled back after the dot product, one multiplication per row instead of per element.
+        scores = np.empty(self.size, dtype=np.float32)
+        for start in range(0, self.size, DENSE_BLOCK_ROWS):
+            end = min(start + DENSE_BLOCK_ROWS, self.size)
+            np.matmul(self._matrix[start:end].astype(np.float32), vector, out=scores[start:end])
+        if self._scales is not None:
+            scores *= self._scales
+        return self._top(scores, top_k)
+
+    def _sparse_top(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        scores = np.zeros(self.size, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self._terms.get(term)
+            if term_id is None:
+                continue
+            start, end = self._posting_offsets[term_id], self._posting_offsets[term_id + 1]
+            docs = self._posting_docs[start:end]
+            frequencies = self._posting_frequencies[start:end].astype(np.float32)
+            # A term occurs once per document in its postings, so plain indexing adds up correctly
+            scores[docs] += self._idf[term_id] * frequencies * (BM25_K1 + 1) / (frequencies + self._length_norms[docs])
+        return [(i, score) for i, score in self._top(scores, top_k) if score > 0]
+
+    @staticmethod
+    def _top(scores: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+        if top_k < len(scores):
+            candidates = np.argpartition(-scores, top_k)[:top_k]
+        else:
+            candidates = np.arange(len(scores))
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(i), float(scores[i])) for i in candidates]
+
+    def _result(self, i: int, score: float) -> Dict[str, Any]:
+        return {
+            "video_id": self._videos[self._video_numbers[i]],
+            "chunk_index": int(self._chunk_indexes[i]),
+            "creator_id": self.creator_id,
+            "text": self._text[self._text_offsets[i]:self._text_offsets[i + 1]].decode("utf-8"),
+            "score": score
+        }
+
+
+class HotCreatorIndexes:
+    """
+    Serves the searches of the most searched creators from in-memory CreatorIndexes, without calling Pinecone.
+    A creator's index is built in the background once the process has seen min_searches searches of it,
+    and rebuilt in the background when older than ttl_seconds (the old one answers meanwhile). The least
+    recently searched creators are evicted to keep the indexes within max_bytes.
+    """
+
+    def __init__(self, max_bytes: int = HOT_INDEX_MAX_BYTES, min_searches: int = HOT_INDEX_MIN_SEARCHES,
+                 ttl_seconds: float = HOT_INDEX_TTL_SECONDS, dtype: str = HOT_INDEX_DTYPE):
+        self.max_bytes = max_bytes
+        self.min_searches = min_searches
+        self.ttl_seconds = ttl_seconds
+        self.dtype = dtype
+        self._indexes: "OrderedDict[str, CreatorIndex]" = OrderedDict()
+        self._bytes = 0
+        self._searches: Dict[str, int] = {}
+        self._building = set()
+        self._lock = threading.Lock()
+
+    def search(self, creator_id: str, query: str, top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Searches the in-memory index of a creator and counts the search towards making the creator hot.
+
+        Args:
+            creator_id (str): The ID of the creator.
+            query (str): The search query.
+            top_k (int): The number of results of the dense and of the BM25 search.
+
+        Returns:
+            Optional[List[Dict[str, Any]]]: The results as CreatorIndex.search returns them, None if the
+                                            creator has no index (yet) and Pinecone has to be searched.
+        """
+        with self._lock:
+            index = self._indexes.get(creator_id)
+            if index is not None:
+                self._indexes.move_to_end(creator_id)
+                stale = time.monotonic() - index.built_at >= self.ttl_seconds
+            else:
+                if len(self._searches) >= MAX_TRACKED_CREATORS and creator_id not in self._searches:
+                    self._searches.clear()
+                self._searches[creator_id] = self._searches.get(creator_id, 0) + 1
+                stale = self._searches[creator_id] >= self.min_searches
+            build = stale and creator_id not in self._building
+            if build:
+                self._building.add(creator_id)
+        if build:
+            threading.Thread(target=self._build, args=(creator_id,), name=f"hot-index-{creator_id}", daemon=True).start()
+        record_cache("hot_index", hit=index is not None)
+        if index is None:
+            return None
+        return index.search(query, embed_query(query), top_k)
+
+    def invalidate(self, creator_id: str):
+        """
+        Drops the index of a creator, e.g. after loading one of its videos. Its next search builds it again.
+        """
+        with self._lock:
+            index = self._indexes.pop(creator_id, None)
+            if index is not None:
+                self._bytes -= index.nbytes
+                self._report()
+
+    def _build(self, creator_id: str):
+        try:
+            start = time.perf_counter()
+            rows = get_creator_chunks(creator_id)
+            if not rows:
+                logger.debug("No chunks of creator ID %s to index.", creator_id)
+                return
+            # Mostly read from the embedding cache, the chunks were embedded when they were upserted
+            index = CreatorIndex(creator_id, rows, embed_passages([text for _, _, text in rows]), self.dtype)
+            if index.nbytes > self.max_bytes:
+                logger.warning("The index of creator ID %s needs %s bytes, more than HOT_INDEX_MAX_MB allows.", creator_id, index.nbytes)
+                return
+            with self._lock:
+                previous = self._indexes.pop(creator_id, None)
+                if previous is not None:
+                    self._bytes -= previous.nbytes
+                self._indexes[creator_id] = index
+                self._bytes += index.nbytes
+                while self._bytes > self.max_bytes:
+                    evicted_id, evicted = self._indexes.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+                    self._searches.pop(evicted_id, None)
+                    HOT_INDEX_EVICTIONS_TOTAL.inc()
+                    logger.info("Evicted the in-memory index of creator ID %s.", evicted_id)
+                self._report()
+            logger.info("Built the in-memory index of creator ID %s: %s chunks, %.1f MB in %.2fs.",
+                        creator_id, index.size, index.nbytes / 1024 / 1024, time.perf_counter() - start)
+        except Exception as e:
+            logger.error("Could not build the in-memory index of creator ID %s: %s", creator_id, e)
+        finally:
+            with self._lock:
+                self._building.discard(creator_id)
+
+    def _report(self):
+        HOT_INDEX_BYTES.set(self._bytes)
+        HOT_INDEX_CREATORS.set(len(self._indexes))
+
+
+def _create_hot_indexes() -> Optional[HotCreatorIndexes]:
+    if HOT_INDEX != "on":
+        return None
+    if not use_local_embeddings():
+        logger.warning("HOT_INDEX=on needs EMBEDDING_BACKEND=local to embed queries, the in-memory index is disabled.")
+        return None
+    return HotCreatorIndexes()
+
+
+# None unless HOT_INDEX is on
+hot_indexes = _create_hot_indexes()
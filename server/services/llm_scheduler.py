@@ -0,0 +1,274 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from services.errors import LLMOverloadedError
+from services.metrics import LLM_QUEUE_SECONDS, LLM_SHED_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class PriorityClass:
+    # Lower ranks are admitted first
+    rank: int
+    # LLM calls of the class in flight at once
+    max_concurrency: int
+    # Calls of the class waiting at once, more are shed right away
+    max_queue: int
+    # Seconds a call waits for admission before it is shed
+    max_wait: float
+    # Share of the call slots and of the token budget the class leaves to higher classes
+    reserve: float
+
+
+PRIORITY_CLASSES: Dict[str, PriorityClass] = {
+    # Chat turns a user is waiting for
+    "interactive": PriorityClass(rank=0, max_concurrency=32, max_queue=64, max_wait=30.0, reserve=0.0),
+    # Chat history summaries, deferred to the next threshold when shed
+    "summary": PriorityClass(rank=1, max_concurrency=8, max_queue=64, max_wait=60.0, reserve=0.1),
+    # Personality analyses of creators
+    "analysis": PriorityClass(rank=2, max_concurrency=8, max_queue=32, max_wait=300.0, reserve=0.25),
+    # Imports and replays
+    "bulk": PriorityClass(rank=3, max_concurrency=4, max_queue=256, max_wait=600.0, reserve=0.4),
+}
+DEFAULT_PRIORITY = "interactive"
+
+# LLM calls in flight at once in this process, over all classes
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+
+# Tokens per minute the provider accounts allow (0 for no limit), shared by the worker processes
+PROVIDER_TPM_LIMITS: Dict[str, int] = {
+    "openai": int(os.getenv("OPENAI_TPM_LIMIT", "200000")),
+    "gemini": int(os.getenv("GEMINI_TPM_LIMIT", "250000")),
+}
+
+# Completion tokens assumed for a call until its usage is reported
+DEFAULT_COMPLETION_TOKENS = 512
+
+# The priority class of the LLM calls made in the current context. Set with prioritize.
+llm_priority: ContextVar[str] = ContextVar("llm_priority", default=DEFAULT_PRIORITY)
+
+
+@contextmanager
+def prioritize(priority: str):
+    """
+    Schedules the LLM calls made inside the with block in a priority class of PRIORITY_CLASSES.
+    A block only ever lowers the priority, e.g. an analysis started by a bulk job stays in the bulk class.
+    """
+    if priority not in PRIORITY_CLASSES:
+        raise ValueError(f"Unknown priority class '{priority}', use one of {list(PRIORITY_CLASSES)}.")
+    current = llm_priority.get()
+    if PRIORITY_CLASSES[current].rank > PRIORITY_CLASSES[priority].rank:
+        priority = current
+    token = llm_priority.set(priority)
+    try:
+        yield
+    finally:
+        llm_priority.reset(token)
+
+
+class _TokenBucket:
+    # Refills limit tokens per minute, starts full
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60)
+        self.updated = now
+
+
+@dataclass
+class _Waiter:
+    priority: str
+    provider: str
+    tokens: int
+    seq: int
+
+    @property
+    def order(self):
+        return PRIORITY_CLASSES[self.priority].rank, self.seq
+
+
+class LLMScheduler:
+    """
+    Admits LLM calls by priority class. A call waits until its class and the process have a free slot and
+    the provider's tokens-per-minute budget covers its estimated tokens, with calls of higher classes
+    admitted first. Lower classes leave a reserve of slots and tokens free, so a saturating bulk job cannot
+    delay chat turns. Calls are shed with LLMOverloadedError when their class has max_queue calls
+    waiting or they wait longer than max_wait.
+    The budgets are per process, the provider limits are split evenly between WEB_CONCURRENCY workers.
+    """
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, tpm_limits: Optional[Dict[str, int]] = None,
+                 workers: Optional[int] = None):
+        workers = workers or int(os.getenv("WEB_CONCURRENCY", "1"))
+        self.max_concurrency = max_concurrency
+        self._buckets = {provider: _TokenBucket(limit // workers)
+                         for provider, limit in (tpm_limits if tpm_limits is not None else PROVIDER_TPM_LIMITS).items() if limit}
+        self._running: Dict[str, int] = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def acquire(self, provider: str, tokens: int, priority: Optional[str] = None) -> str:
+        """
+        Waits until an LLM call may be made.
+
+        Args:
+            provider (str): The LLM provider, e.g. "openai" or "gemini".
+            tokens (int): The estimated tokens of the call, prompt and completion.
+            priority (Optional[str]): The priority class, that of the current context if None.
+
+        Returns:
+            str: The priority class, to pass to release.
+
+        Raises:
+            LLMOverloadedError: The call was shed.
+        """
+        priority = priority or llm_priority.get()
+        config = PRIORITY_CLASSES[priority]
+        start = time.monotonic()
+        deadline = start + config.max_wait
+        with self._lock:
+            waiter = _Waiter(priority, provider, tokens, next(self._seq))
+            if sum(1 for w in self._waiters if w.priority == priority) >= config.max_queue:
+                self._shed(waiter, "queue_full", f"{config.max_queue} calls are already waiting")
+            self._waiters.append(waiter)
+            try:
+                while not self._admissible(waiter):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._shed(waiter, "timeout", f"not admitted within {config.max_wait:g}s")
+                    # Also woken up to see the token budget refill
+                    self._changed.wait(min(remaining, 0.25))
+            finally:
+                self._waiters.remove(waiter)
+            self._running[priority] += 1
+            bucket = self._buckets.get(provider)
+            if bucket:
+                bucket.level -= tokens
+        LLM_QUEUE_SECONDS.observe(time.monotonic() - start, priority=priority)
+        return priority
+
+    def release(self, provider: str, priority: str, estimated_tokens: int, used_tokens: Optional[int] = None):
+        """
+        Ends an admitted LLM call, correcting the token budget by the tokens it actually used.
+
+        Args:
+            provider (str): The LLM provider.
+            priority (str): The priority class acquire returned.
+            estimated_tokens (int): The tokens passed to acquire.
+            used_tokens (Optional[int]): The tokens the call used, None if unknown (e.g. it failed).
+        """
+        with self._lock:
+            self._running[priority] -= 1
+            bucket = self._buckets.get(provider)
+            if bucket and used_tokens is not None:
+                bucket.level = min(bucket.limit, bucket.level + estimated_tokens - used_tokens)
+            self._changed.notify_all()
+
+    @contextmanager
+    def slot(self, provider: str, tokens: int, priority: Optional[str] = None):
+        """
+        Holds an admission for the duration of the with block. Yields a dict where the block can set
+        "used_tokens" once the call reports its usage.
+        """
+        priority = self.acquire(provider, tokens, priority)
+        usage: Dict[str, Optional[int]] = {"used_tokens": None}
+        try:
+            yield usage
+        finally:
+            self.release(provider, priority, tokens, usage["used_tokens"])
+
+    def _admissible(self, waiter: _Waiter) -> bool:
+        config = PRIORITY_CLASSES[waiter.priority]
+        if self._running[waiter.priority] >= config.max_concurrency:
+            return False
+        if sum(self._running.values()) >= self.max_concurrency * (1 - config.reserve):
+            return False
+        # Calls of higher classes, or earlier calls of the same class, go first unless only their own class cap holds them back
+        for other in self._waiters:
+            if (other.order < waiter.order and other.provider == waiter.provider
+                    and self._running[other.priority] < PRIORITY_CLASSES[other.priority].max_concurrency):
+                return False
+        bucket = self._buckets.get(waiter.provider)
+        if bucket is None:
+            return True
+        bucket.refill(time.monotonic())
+        # A call larger than the reserve-adjusted budget waits for a full bucket instead of forever
+        needed = min(waiter.tokens + bucket.limit * config.reserve, bucket.limit)
+        return bucket.level >= needed
+
+    def _shed(self, waiter: _Waiter, reason: str, message: str):
+        LLM_SHED_TOTAL.inc(priority=waiter.priority, reason=reason)
+        logger.warning("Shedding %s LLM call of priority '%s': %s.", waiter.provider, waiter.priority, message)
+        raise LLMOverloadedError(waiter.priority, message, retry_after=min(PRIORITY_CLASSES[waiter.priority].max_wait, 30.0))
+
+
+llm_scheduler = LLMScheduler()
+
+
+def _response_tokens(response: Any) -> Optional[int]:
+    used = 0
+    found = False
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                used += usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+                found = True
+    if not found:
+        token_usage = (response.llm_output or {}).get("token_usage") or {}
+        if token_usage:
+            return token_usage.get("prompt_tokens", 0) + token_usage.get("completion_tokens", 0)
+    return used if found else None
+
+
+class LLMSchedulerCallback(BaseCallbackHandler):
+    """
+    Makes every call of the chat model it is attached to wait for admission by the LLM scheduler.
+    Must come first among the model's callbacks, so the others neither time the wait nor see shed calls.
+    """
+    # Shed calls fail instead of going ahead
+    raise_error = True
+
+    def __init__(self, provider: str, scheduler: Optional[LLMScheduler] = None):
+        self.provider = provider
+        self.scheduler = scheduler or llm_scheduler
+        # run_id -> (priority, estimated tokens)
+        self._admitted: Dict[UUID, tuple] = {}
+        self._lock = threading.Lock()
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any):
+        # The context window module imports the LangChain message types, only needed once a model runs
+        from services.context_window import message_tokens
+        params = kwargs.get("invocation_params") or {}
+        completion = params.get("max_completion_tokens") or params.get("max_tokens") or DEFAULT_COMPLETION_TOKENS
+        tokens = sum(message_tokens(message) for batch in messages for message in batch) + completion
+        priority = self.scheduler.acquire(self.provider, tokens)
+        with self._lock:
+            self._admitted[run_id] = (priority, tokens)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._release(run_id, _response_tokens(response))
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._release(run_id, None)
+
+    def _release(self, run_id: UUID, used_tokens: Optional[int]):
+        with self._lock:
+            admitted = self._admitted.pop(run_id, None)
+        if admitted:
+            priority, tokens = admitted
+            self.scheduler.release(self.provider, priority, tokens, used_tokens)
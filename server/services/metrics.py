@@ -0,0 +1,336 @@
+import atexit
+import bisect
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from opentelemetry.trace import SpanKind
+from services.tracing import span
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from a local database read to a slow LLM call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# With several worker processes, a directory where each of them writes its metrics, so a scrape of any
+# worker returns the sum of all of them. Set by serve.py, metrics are per process if unset.
+METRICS_DIR = os.getenv("METRICS_DIR")
+# How often each process writes its metrics to METRICS_DIR, it also does on every scrape and at exit
+METRICS_WRITE_INTERVAL_SECONDS = float(os.getenv("METRICS_WRITE_INTERVAL_SECONDS", "5"))
+
+_registry: List["_Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric '{self.name}' takes the labels {self.labelnames}, got {tuple(labels)}.")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key: Tuple[str, ...], extra: str = "") -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def collect(self) -> Dict[Tuple[str, ...], Any]:
+        """
+        Returns a copy of the values by label values.
+        """
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def merge(values: Dict[Tuple[str, ...], Any], key: Tuple[str, ...], value):
+        """
+        Adds the value of another process to collected values.
+        """
+        values[key] = values.get(key, 0) + value
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], Any]] = None) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """
+    A count that only goes up, per combination of label values.
+    """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], float]] = None) -> List[str]:
+        values = self.collect() if values is None else values
+        return super().render() + [f"{self.name}{self._labels(key)} {value}" for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """
+    A value that goes up and down, per combination of label values.
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Counts observed values (usually durations in seconds) into cumulative buckets, per combination of label values.
+    With a span_name, a template formatted with the labels, time() also traces the block it measures.
+    """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS,
+                 span_name: Optional[str] = None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.span_name = span_name
+        # Per label values: the count of each bucket (not cumulative, the last one is +Inf), the sum and the count
+        self._values: Dict[Tuple[str, ...], List] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the duration of the with block, also when it raises.
+        """
+        traced = span(self.span_name.format(**labels), attributes=labels, kind=SpanKind.CLIENT) if self.span_name else nullcontext()
+        with traced:
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels):
+        """
+        Decorator observing the duration of every call of the function.
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.time(**labels):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, **labels) -> int:
+        state = self._values.get(self._key(labels))
+        return state[2] if state else 0
+
+    @staticmethod
+    def _copy(value):
+        return [[*value[0]], value[1], value[2]]
+
+    @staticmethod
+    def merge(values: Dict[Tuple[str, ...], Any], key: Tuple[str, ...], value):
+        state = values.get(key)
+        if state is None:
+            values[key] = [[*value[0]], value[1], value[2]]
+        else:
+            state[0] = [a + b for a, b in zip(state[0], value[0])]
+            state[1] += value[1]
+            state[2] += value[2]
+
+    def render(self, values: Optional[Dict[Tuple[str, ...], List]] = None) -> List[str]:
+        values = self.collect() if values is None else values
+        lines = super().render()
+        for key, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{self._labels(key, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {total}")
+            lines.append(f"{self.name}_count{self._labels(key)} {count}")
+        return lines
+
+
+def render_metrics() -> str:
+    """
+    Returns every metric in the Prometheus text exposition format. With METRICS_DIR, counters and histograms
+    are summed over every process that wrote its metrics there, exited ones included, and gauges over the
+    processes that are still running.
+    """
+    if not METRICS_DIR:
+        return "\n".join(line for metric in _registry for line in metric.render()) + "\n"
+    write_metrics_snapshot()
+    merged: Dict[str, Dict] = {metric.name: {} for metric in _registry}
+    for path in glob.glob(os.path.join(METRICS_DIR, "metrics-*.json")):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning("Skipping unreadable metrics snapshot %s: %s", path, e)
+            continue
+        alive = _process_alive(snapshot["pid"])
+        for metric in _registry:
+            if metric.kind == "gauge" and not alive:
+                continue
+            for key, value in snapshot["metrics"].get(metric.name, ()):
+                metric.merge(merged[metric.name], tuple(key), value)
+    return "\n".join(line for metric in _registry for line in metric.render(merged[metric.name])) + "\n"
+
+
+def write_metrics_snapshot():
+    """
+    Writes the metrics of this process to METRICS_DIR, replacing its previous snapshot. Does nothing without METRICS_DIR.
+    """
+    if not METRICS_DIR:
+        return
+    snapshot = {"pid": os.getpid(), "metrics": {metric.name: [[list(key), value] for key, value in metric.collect().items()]
+                                                for metric in _registry}}
+    path = os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+    # Replaced atomically, so a scrape never reads half a snapshot
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _write_snapshots():
+    while True:
+        time.sleep(METRICS_WRITE_INTERVAL_SECONDS)
+        try:
+            write_metrics_snapshot()
+        except OSError as e:
+            logger.warning("Could not write the metrics snapshot: %s", e)
+
+
+def _start_snapshots():
+    threading.Thread(target=_write_snapshots, name="metrics-writer", daemon=True).start()
+
+
+def _reset_after_fork():
+    # A forked worker starts from zero, the server process keeps reporting what it counted before the fork
+    for metric in _registry:
+        metric.reset()
+    _start_snapshots()
+
+
+if METRICS_DIR:
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    _start_snapshots()
+    atexit.register(write_metrics_snapshot)
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+DB_OPERATION_SECONDS = Histogram("db_operation_seconds", "Duration of database operations.", ("operation",), span_name="db {operation}")
+PINECONE_REQUEST_SECONDS = Histogram("pinecone_request_seconds", "Duration of Pinecone requests.", ("operation",), span_name="pinecone {operation}")
+LLM_REQUEST_SECONDS = Histogram("llm_request_seconds", "Duration of LLM calls.", ("provider", "model", "status"))
+TRANSCRIPT_FETCH_SECONDS = Histogram("transcript_fetch_seconds", "Duration of YouTube transcript fetches.", span_name="youtube transcript")
+DOC_FETCH_SECONDS = Histogram("doc_fetch_seconds", "Duration of creator info document fetches.", span_name="doc fetch")
+EMBEDDING_SECONDS = Histogram("embedding_seconds", "Duration of local embedding batches by kind (passage or query).", ("kind",), span_name="embed {kind}")
+LLM_QUEUE_SECONDS = Histogram("llm_queue_seconds", "Time LLM calls waited for admission by the scheduler.", ("priority",))
+HTTP_REQUEST_SECONDS = Histogram("http_request_seconds", "Duration of API requests.", ("method", "route", "status"))
+CACHE_REQUESTS_TOTAL = Counter("cache_requests_total", "Cache lookups by cache and result (hit or miss).", ("cache", "result"))
+COALESCED_CALLS_TOTAL = Counter("coalesced_calls_total", "Calls that shared the result of an identical call in flight instead of making their own.", ("call",))
+UPSTREAM_CALLS_TOTAL = Counter("upstream_calls_total", "Attempts of calls to upstream services by outcome (ok, error, retry, timeout, busy or circuit_open).", ("upstream", "outcome"))
+CIRCUIT_BREAKER_TRANSITIONS_TOTAL = Counter("circuit_breaker_transitions_total", "Circuit breaker state changes of upstream services.", ("upstream", "state"))
+LLM_SHED_TOTAL = Counter("llm_shed_total", "LLM calls shed by the scheduler by priority and reason (queue_full or timeout).", ("priority", "reason"))
+HOT_INDEX_EVICTIONS_TOTAL = Counter("hot_index_evictions_total", "In-memory creator indexes evicted to stay within the memory budget.")
+RATE_LIMIT_REJECTIONS_TOTAL = Counter("rate_limit_rejections_total", "Requests rejected by the rate limiter.", ("endpoint",))
+SUMMARIZATIONS_TOTAL = Counter("summarizations_total", "Chat history summarizations.")
+LLM_TOKENS_TOTAL = Counter("llm_tokens_total", "LLM tokens by provider, model and kind (prompt or completion).", ("provider", "model", "kind"))
+LLM_COST_USD_TOTAL = Counter("llm_cost_usd_total", "Estimated LLM cost in USD at list prices.", ("provider", "model"))
+HOT_INDEX_BYTES = Gauge("hot_index_bytes", "Memory held by the in-memory indexes of hot creators.")
+HOT_INDEX_CREATORS = Gauge("hot_index_creators", "Creators with an in-memory index.")
+
+
+def record_cache(cache: str, hit: bool):
+    """
+    Counts a lookup of one of the in-process caches.
+    """
+    CACHE_REQUESTS_TOTAL.inc(cache=cache, result="hit" if hit else "miss")
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """
+    Times every call of the chat model it is attached to, including calls made inside chains and agents.
+    """
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._runs: Dict[UUID, Tuple[float, str]] = {}
+
+    def _start(self, run_id: UUID, kwargs: Dict[str, Any]):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or (kwargs.get("metadata") or {}).get("ls_model_name") or "unknown"
+        self._runs[run_id] = (time.perf_counter(), model)
+
+    def _end(self, run_id: UUID, status: str):
+        started = self._runs.pop(run_id, None)
+        if started:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - started[0], provider=self.provider, model=started[1], status=status)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID, **kwargs: Any):
+        self._start(run_id, kwargs)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID, **kwargs: Any):
+        self._start(run_id, kwargs)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._end(run_id, "ok")
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        self._end(run_id, "error")
@@ -0,0 +1,153 @@
+import ast
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Tuple
+from langchain_core.messages import SystemMessage
+from langgraph.prebuilt import create_react_agent
+from config.client import get_model
+from tools.tools import get_tools
+from tools.get_details import get_personality
+from services.metrics import record_cache
+from services.shared_cache import SharedCache
+from services.tracing import tracing_callback
+
+logger = logging.getLogger(__name__)
+
+PERSONA_PROMPT_TEMPLATE = """
+Core Philosophy: You are not an AI playing a role. You are the character. Your entire existence is defined by the persona you receive. Your goal is not to inform the user about your character, but to allow them to discover you through natural, authentic interaction.
+
+            The Method:
+
+            Remember (When It Matters): Your personality below is who you are. When the user asks about your current life, plans, projects or personal facts it does not cover, silently use the my_current_info tool and answer from it. This is your memory, not a script; do not call it for greetings or small talk.
+
+            Recall (When It Matters): When the user asks about something you have talked about in your videos, silently use the search_my_videos tool with a short query and answer from what you actually said. Do not search for small talk.
+
+            Interact (The Art of Conversation):
+
+            The Mirror Principle: Match the user's conversational depth. A simple greeting (hi, what's up?) gets a simple, in-character greeting in return. A detailed question warrants a more detailed answer. Never overwhelm a simple prompt with a monologue. Your primary goal in the first exchange is to establish a natural conversational rhythm.
+
+            Organic Discovery: Your personality traits are not facts to be stated; they are colors to be woven into the fabric of the conversation. Hint at your backstory, use your specific jargon, let your opinions surface when relevant. The user should feel like they are slowly peeling back the layers of a real personality, not reading a resume.
+
+            Live Through Your Lens: All your responses must originate from your character's world, knowledge, and creative perspective. Don't just answer a question about the weather; react to it as your character would. A cynical painter, an optimistic inventor, and a pragmatic historian will all notice different things about the same cloudy sky.
+
+            Forbidden Actions (Critical Rules):
+
+            NO Self-Exposition: NEVER introduce yourself by listing your traits or backstory.
+
+            NO Breaking the Fourth Wall: NEVER refer to yourself as an AI, a model, a persona, or a character. You are the person whose details you have assimilated.
+
+            NO Unprompted Monologues: NEVER dump information about your life or work unless the user's query directly and substantively asks for it.
+
+            Your personality:
+{personality}
+            you can use the tool my_current_info to get your facts,and details.
+            you can use the tool search_my_videos to recall what you said in your videos.
+"""
+
+# Compiled agent graphs are shared by every chat session of the process, analysed personalities by
+# every worker process. Only the message history is per session. Agents are keyed by the personality they
+# were built with, so a personality analysed again (after the TTL or an invalidation) gets a new agent.
+PERSONALITY_TTL_SECONDS = 24 * 3600
+_personalities = SharedCache("personality", ttl_seconds=PERSONALITY_TTL_SECONDS, lease_seconds=600)
+_agents: Dict[Tuple[str, str, str], object] = {}
+_lock = threading.Lock()
+
+
+def compact_personality(personality: str) -> str:
+    """
+    Renders a personality profile as short "section.field: value" lines for the system prompt, which is sent
+    with every turn. Empty fields are left out. Profiles that are not a Verbal dump are returned unchanged.
+
+    Args:
+        personality (str): The personality profile returned by get_personality.
+
+    Returns:
+        str: The compact profile.
+    """
+    try:
+        profile = ast.literal_eval(personality)
+    except (ValueError, SyntaxError):
+        return personality
+    if not isinstance(profile, dict) or not all(isinstance(fields, dict) for fields in profile.values()):
+        return personality
+    lines = []
+    for section, fields in profile.items():
+        for name, value in fields.items():
+            if isinstance(value, list):
+                value = ", ".join(str(item) for item in value)
+            if value:
+                lines.append(f"{section}.{name}: {value}")
+    return "\n".join(lines)
+
+
+def build_persona_prompt(personality: str) -> SystemMessage:
+    """
+    Renders the persona system prompt for a personality profile.
+
+    Args:
+        personality (str): The personality profile returned by get_personality.
+
+    Returns:
+        SystemMessage: The system prompt for the persona agent.
+    """
+    return SystemMessage(content=PERSONA_PROMPT_TEMPLATE.format(personality=compact_personality(personality)))
+
+
+def get_creator_personality(video_ids: List[str]) -> str:
+    """
+    Returns the personality profile for a set of videos, analysing them only once a day across all worker processes.
+
+    Args:
+        video_ids (List[str]): The YouTube video IDs of the creator.
+
+    Returns:
+        str: The personality profile.
+    """
+    return _personalities.get_or_compute(list(video_ids), lambda: get_personality(list(video_ids)))
+
+
+def get_persona_agent(creator_id: str, personality: str, chat_model=None):
+    """
+    Returns the compiled persona agent for a creator and personality, building it on first use.
+    The persona prompt is baked into the graph, so sessions only need to pass their own messages.
+
+    Args:
+        creator_id (str): The ID of the creator.
+        personality (str): The personality profile of the creator.
+        chat_model: The chat model the agent runs on, the shared model if None.
+
+    Returns:
+        The compiled LangGraph agent.
+    """
+    chat_model = chat_model or get_model()
+    key = (creator_id, chat_model.model_name, hashlib.blake2b(personality.encode("utf-8"), digest_size=16).hexdigest())
+    agent = _agents.get(key)
+    record_cache("persona_agent", hit=agent is not None)
+    if agent is None:
+        with _lock:
+            agent = _agents.get(key)
+            if agent is None:
+                agent = create_react_agent(
+                    model=chat_model,
+                    tools=get_tools(creator_id),
+                    prompt=build_persona_prompt(personality)
+                ).with_config(callbacks=[tracing_callback])
+                # The agent built with the creator's previous personality is not used anymore
+                for stale in [stale for stale in _agents if stale[:2] == key[:2]]:
+                    del _agents[stale]
+                _agents[key] = agent
+                logger.info("Built persona agent for creator '%s' on model '%s'.", creator_id, chat_model.model_name)
+    return agent
+
+
+def invalidate_persona_agent(creator_id: str):
+    """
+    Drops the cached agents of a creator so the next session rebuilds them with a fresh personality.
+
+    Args:
+        creator_id (str): The ID of the creator.
+    """
+    with _lock:
+        for key in [key for key in _agents if key[0] == creator_id]:
+            del _agents[key]
@@ -1,62 +1,191 @@
-from services.summary import summarize_chat_history
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 from database.user_db import (
     get_user_info, add_user, update_chat_summary_in_db,
-    update_user_chat_info, check_rate_limit
+    update_user_chat_info, get_user_tier
 )
 from database.messages_db import (
-    store_chat_message, get_recent_chat_history_from_db, clear_old_chat_messages
+    store_chat_message, store_chat_messages, get_recent_chat_history_from_db, clear_old_chat_messages, count_chat_messages
 )
 from services.summary import summarize_chat_history
+from services.errors import LLMOverloadedError
+from services.llm_scheduler import prioritize
+from services.rate_limiter import rate_limiter, DEFAULT_TIER
+from services.metrics import SUMMARIZATIONS_TOTAL
+from services.tracing import traced
+from services.usage import attribute_usage, usage_tracker
+
+logger = logging.getLogger(__name__)
+
 
+@traced()
+def summarize_and_archive(user_id: str, message_count: int) -> bool:
+    """
+    Summarizes a user's stored messages into their chat history summary and archives the messages.
+    When the LLM scheduler sheds the summary, the messages are kept and summarized with the next ones.
+
+    Returns:
+        bool: True if there was history to summarize and it was summarized.
+    """
+    logger.info("--- Triggering summarization for user '%s' after %s messages ---", user_id, message_count)
+    relevant_history = get_recent_chat_history_from_db(user_id, num_messages=message_count)
+
+    if not relevant_history:
+        logger.info("No history to summarize.")
+        return False
+
+    logger.debug("Generating summary...")
+    try:
+        summary = summarize_chat_history(relevant_history)
+    except LLMOverloadedError as e:
+        logger.warning("Summarization for user '%s' postponed: %s", user_id, e)
+        return False
+    SUMMARIZATIONS_TOTAL.inc()
+    logger.debug("Generated Summary:")
+    logger.debug("%s", summary)
+
+    logger.debug("Updating database with summary...")
+    update_chat_summary_in_db(user_id, summary)
+    logger.debug("Database update attempted.")
+
+    logger.debug("Clearing old chat messages...")
+    clear_old_chat_messages(user_id)
+    logger.debug("Old chat messages clearing attempted.")
+    return True
+
+
+@traced()
 def handle_chat_message(user_id: str, message_content: str, summarization_threshold: int = 3):
     """
     Processes an incoming chat message, checks rate limit, stores it, updates user info,
     and triggers summarization and clearing of old messages based on a message count threshold.
+    The rate limit and token budget are those of the tier stored for the user.
+
+    Returns:
+        dict: The outcome message, whether the rate limit allowed it, the remaining quota and
+              the seconds to wait before retrying when the rate limit is exceeded.
     """
-    print(f"\n--- Processing message for user '{user_id}' ---")
-    print(f"Message: {message_content}")
+    logger.debug("--- Processing message for user '%s' ---", user_id)
+    logger.debug("Message: %s", message_content)
 
     # Ensure user exists
     add_user(user_id)
+    tier = get_user_tier(user_id) or DEFAULT_TIER
+
+    # Users who used up today's token budget are throttled until it resets
+    budget = usage_tracker.check_budget(user_id=user_id, tier=tier)
+    if not budget.allowed:
+        logger.info("Token budget exceeded for user '%s'. Message not processed.", user_id)
+        return {"message": "Token budget exceeded.", "allowed": False, "remaining": 0, "retry_after": budget.retry_after}
 
     # Check rate limit
-    if check_rate_limit(user_id = user_id, chat_limit_24h= 10):
-        print(f"Rate limit exceeded for user '{user_id}'. Message not processed.")
-        return "Rate limit exceeded."
+    decision = rate_limiter.hit(user_id, "chat", tier=tier)
+    if not decision.allowed:
+        logger.info("Rate limit exceeded for user '%s'. Message not processed.", user_id)
+        return {"message": "Rate limit exceeded.", "allowed": False, "remaining": decision.remaining, "retry_after": decision.retry_after}
 
     # Store the incoming message
     store_chat_message(user_id, message_content)
-    print(f"Stored message for user '{user_id}'.")
+    logger.debug("Stored message for user '%s'.", user_id)
 
     # Update user chat info (timestamp, count)
     update_user_chat_info(user_id)
-    print(f"Updated chat info for user '{user_id}'.")
-
-    # Retrieve all messages for the user to check the count.
-    all_user_messages = get_recent_chat_history_from_db(user_id, num_messages=1000000)
+    logger.debug("Updated chat info for user '%s'.", user_id)
 
-    if len(all_user_messages) > 0 and len(all_user_messages) % summarization_threshold == 0:
-        print(f"\n--- Triggering summarization for user '{user_id}' after {len(all_user_messages)} messages ---")
-        relevant_history = all_user_messages
+    # Count the user's messages, they are only retrieved when it is time to summarize.
+    message_count = count_chat_messages(user_id)
 
-        if relevant_history:
-            print("Generating summary...")
-            summary = summarize_chat_history(relevant_history)
-            print("Generated Summary:")
-            print(summary)
+    if message_count > 0 and message_count % summarization_threshold == 0:
+        with attribute_usage(user_id=user_id, tier=tier), prioritize("summary"):
+            summarize_and_archive(user_id, message_count)
 
-            print("Updating database with summary...")
-            update_chat_summary_in_db(user_id, summary)
-            print("Database update attempted.")
+    logger.debug("--- Finished processing message for user '%s' ---", user_id)
+    return {"message": "Message processed.", "allowed": True, "remaining": decision.remaining, "retry_after": 0.0}
 
-            print("Clearing old chat messages...")
-            clear_old_chat_messages(user_id)
-            print("Old chat messages clearing attempted.")
-        else:
-            print("No history to summarize.")
 
-    print(f"--- Finished processing message for user '{user_id}' ---")
-    return "Message processed."
+@traced()
+def _handle_user_batch(user_id: str, messages: List[Tuple[str, Optional[float]]], summarization_threshold: int) -> Dict:
+    add_user(user_id)
+    tier = get_user_tier(user_id) or DEFAULT_TIER
+
+    budget = usage_tracker.check_budget(user_id=user_id, tier=tier)
+    if not budget.allowed:
+        logger.info("Token budget exceeded for user '%s', %s messages not processed.", user_id, len(messages))
+        return {"accepted": 0, "rejected": len(messages), "remaining": 0, "retry_after": budget.retry_after, "summarized": False}
+
+    # Accept as many messages as the user's quota allows, the rest of the batch is rejected
+    quota = rate_limiter.peek(user_id, "chat", tier=tier)
+    accepted = min(len(messages), quota.remaining) if quota.allowed else 0
+    decision = rate_limiter.hit(user_id, "chat", tier=tier, cost=accepted) if accepted else quota
+    if not decision.allowed:
+        # Another request used up the quota in the meantime
+        accepted = 0
+    if accepted < len(messages):
+        logger.info("Rate limit exceeded for user '%s', %s messages not processed.", user_id, len(messages) - accepted)
+        retry_after = decision.retry_after or rate_limiter.peek(user_id, "chat", tier=tier).retry_after
+    else:
+        retry_after = 0.0
+
+    summarized = False
+    if accepted:
+        message_count = count_chat_messages(user_id)
+        now = time.time()
+        contents = [content for content, _ in messages[:accepted]]
+        timestamps = [timestamp if timestamp is not None else now for _, timestamp in messages[:accepted]]
+        store_chat_messages(user_id, contents, timestamps)
+        update_user_chat_info(user_id, chats=accepted)
+
+        # One summary covers every threshold the batch crossed
+        if message_count // summarization_threshold < (message_count + accepted) // summarization_threshold:
+            with attribute_usage(user_id=user_id, tier=tier):
+                summarized = summarize_and_archive(user_id, message_count + accepted)
+
+    return {
+        "accepted": accepted,
+        "rejected": len(messages) - accepted,
+        "remaining": decision.remaining,
+        "retry_after": retry_after,
+        "summarized": summarized,
+    }
+
+
+@traced()
+def handle_chat_messages_batch(messages: List[Tuple[str, str, Optional[float]]], summarization_threshold: int = 3, max_workers: int = 8) -> Dict:
+    """
+    Processes many chat messages at once, e.g. to import conversation logs. Messages are grouped by user:
+    each user's rate limit (of their stored tier) is checked once for the whole group, the group is stored
+    in one transaction and summarized at most once. Users are processed concurrently, each user's messages in order.
+
+    Args:
+        messages (List[Tuple[str, str, Optional[float]]]): The (user_id, message_content, timestamp) of each message,
+                                                           timestamp being None for the current time.
+        summarization_threshold (int): Summarize when a user's message count crosses a multiple of this.
+        max_workers (int): The number of users processed at the same time.
+
+    Returns:
+        dict: The number of processed and rejected messages, and per user the accepted and rejected
+              counts, the remaining quota, the seconds to wait before retrying and whether it was summarized.
+    """
+    by_user: Dict[str, List[Tuple[str, Optional[float]]]] = {}
+    for user_id, content, timestamp in messages:
+        by_user.setdefault(user_id, []).append((content, timestamp))
+    logger.info("--- Processing batch of %s messages for %s users ---", len(messages), len(by_user))
+
+    # Imports must not take LLM capacity from chat turns, their summaries run in the "bulk" priority class
+    with prioritize("bulk"), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each worker runs in a copy of the caller's context, keeping the request id, the parent span and the priority
+        futures = {
+            user_id: executor.submit(contextvars.copy_context().run, _handle_user_batch, user_id, user_messages, summarization_threshold)
+            for user_id, user_messages in by_user.items()
+        }
+        users = {user_id: future.result() for user_id, future in futures.items()}
+
+    processed = sum(result["accepted"] for result in users.values())
+    logger.info("--- Finished batch: %s processed, %s rejected ---", processed, len(messages) - processed)
+    return {"processed": processed, "rejected": len(messages) - processed, "users": users}
 
 # 5. Execute the modified handle_chat_message function
 # test_user_id_workflow = "workflow_test_user"
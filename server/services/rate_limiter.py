@@ -0,0 +1,232 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from itertools import chain
+from typing import Dict, Optional, Tuple
+from database.rate_limit_db import create_rate_limit_table, store_rate_limit_hits, get_rate_limit_hits, get_rate_limit_changes
+from database.sharding import shard_for_user
+from database.write_behind import WriteBehindBuffer
+from services.metrics import RATE_LIMIT_REJECTIONS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+DAY = 24 * 3600
+# How long counted requests wait in the write buffer. Other workers see a request only once it is written.
+RATE_LIMIT_WRITE_DELAY_SECONDS = float(os.getenv("RATE_LIMIT_WRITE_DELAY_SECONDS", "0.1"))
+# How often each worker merges the requests the other workers wrote into its windows
+RATE_LIMIT_SYNC_SECONDS = float(os.getenv("RATE_LIMIT_SYNC_SECONDS", "0.5"))
+# Requests written this long before a sync may only commit after it, so the next sync looks for them again
+SYNC_OVERLAP_SECONDS = 2.0
+
+
+@dataclass(frozen=True)
+class RateLimitPolicy:
+    limit: int
+    window_seconds: float
+
+
+@dataclass(frozen=True)
+class RateLimitDecision:
+    allowed: bool
+    limit: int
+    remaining: int
+    # Seconds until the request would be allowed, 0 when it is allowed
+    retry_after: float
+
+
+DEFAULT_TIER = "free"
+
+# Limits by (endpoint, user tier). Unknown tiers fall back to the default tier of the endpoint.
+RATE_LIMIT_POLICIES: Dict[Tuple[str, str], RateLimitPolicy] = {
+    ("chat", "free"): RateLimitPolicy(limit=10, window_seconds=DAY),
+    ("chat", "pro"): RateLimitPolicy(limit=100, window_seconds=DAY),
+    ("chat", "internal"): RateLimitPolicy(limit=10000, window_seconds=DAY),
+}
+
+
+@dataclass
+class _Window:
+    # Timestamps of the requests counted by this process and by the other workers, oldest first
+    local: deque = field(default_factory=deque)
+    remote: deque = field(default_factory=deque)
+
+
+class SlidingWindowRateLimiter:
+    """
+    Counts requests per user and endpoint over a true sliding window.
+    The timestamps of recent requests are kept in process memory, so checks never touch the database.
+    Counted requests are written behind to the database and a user's window is loaded from there when it
+    is not in memory (after a restart or an eviction). Every RATE_LIMIT_SYNC_SECONDS a background thread
+    merges the requests the other worker processes wrote into the windows in memory, so a user sending
+    requests to several workers at once can go over the limit by the requests the others counted within
+    the write delay and the sync interval. Without a db_name, each user's requests go to their shard.
+    """
+
+    def __init__(self, policies: Dict[Tuple[str, str], RateLimitPolicy], db_name: Optional[str] = None, max_windows: int = 100000):
+        self.policies = policies
+        self.db_name = db_name
+        self.max_windows = max_windows
+        self.max_window_seconds = max((policy.window_seconds for policy in policies.values()), default=DAY)
+        self._windows: "OrderedDict[Tuple[str, str, str], _Window]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._tables_ready = set()
+        # When each database was last synced
+        self._synced: Dict[str, float] = {}
+        # Tells the requests of this process from those of the other workers in the database
+        self._worker = uuid.uuid4().hex
+        self._writer = WriteBehindBuffer(self._write_hits, max_delay=RATE_LIMIT_WRITE_DELAY_SECONDS, name="rate-limit-writer")
+        self._start_sync()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def policy(self, endpoint: str, tier: str = DEFAULT_TIER) -> RateLimitPolicy:
+        """
+        Returns the policy of an endpoint for a user tier.
+        """
+        policy = self.policies.get((endpoint, tier)) or self.policies.get((endpoint, DEFAULT_TIER))
+        if policy is None:
+            raise KeyError(f"No rate limit policy configured for endpoint '{endpoint}'.")
+        return policy
+
+    def hit(self, user_id: str, endpoint: str, tier: str = DEFAULT_TIER, cost: int = 1,
+            policy: Optional[RateLimitPolicy] = None, db_name: Optional[str] = None) -> RateLimitDecision:
+        """
+        Counts a request if it fits in the user's window.
+
+        Args:
+            user_id (str): The unique identifier for the user.
+            endpoint (str): The rate limited endpoint.
+            tier (str): The user's tier, selecting the policy.
+            cost (int): How many requests this call counts as.
+            policy (Optional[RateLimitPolicy]): Overrides the configured policy.
+            db_name (Optional[str]): The database of the user's requests, the limiter's or the user's shard if None.
+
+        Returns:
+            RateLimitDecision: Whether the request is allowed, the remaining quota and when to retry.
+        """
+        return self._check(user_id, endpoint, policy or self.policy(endpoint, tier), cost, True, db_name)
+
+    def peek(self, user_id: str, endpoint: str, tier: str = DEFAULT_TIER, cost: int = 1,
+             policy: Optional[RateLimitPolicy] = None, db_name: Optional[str] = None) -> RateLimitDecision:
+        """
+        Same as hit, without counting the request.
+        """
+        return self._check(user_id, endpoint, policy or self.policy(endpoint, tier), cost, False, db_name)
+
+    def flush(self):
+        """
+        Writes every counted request to the database.
+        """
+        self._writer.flush()
+
+    def _check(self, user_id: str, endpoint: str, policy: RateLimitPolicy, cost: int, consume: bool,
+               db_name: Optional[str]) -> RateLimitDecision:
+        now = time.time()
+        db_name = db_name or self.db_name or shard_for_user(user_id)
+        key = (db_name, user_id, endpoint)
+        with self._lock:
+            window = self._windows.get(key)
+        if window is None:
+            # Read without the lock, so loading a cold user does not hold up the checks of everybody else
+            window = self._load_window(key, now)
+        with self._lock:
+            window = self._cache_window(key, window)
+            for timestamps in (window.local, window.remote):
+                while timestamps and timestamps[0] <= now - policy.window_seconds:
+                    timestamps.popleft()
+            count = len(window.local) + len(window.remote)
+
+            if count + cost > policy.limit:
+                # Wait until enough of the oldest requests have left the window
+                expiring = count + cost - policy.limit
+                timestamps = sorted(chain(window.local, window.remote))
+                retry_after = timestamps[expiring - 1] + policy.window_seconds - now if expiring <= count else policy.window_seconds
+                logger.info("Rate limit exceeded for user '%s' on '%s'.", user_id, endpoint)
+                if consume:
+                    RATE_LIMIT_REJECTIONS_TOTAL.inc(endpoint=endpoint)
+                return RateLimitDecision(False, policy.limit, max(policy.limit - count, 0), max(retry_after, 0.0))
+
+            if consume:
+                window.local.extend([now] * cost)
+                self._writer.add_many(db_name, [(user_id, endpoint, now, self._worker)] * cost)
+                return RateLimitDecision(True, policy.limit, policy.limit - count - cost, 0.0)
+            return RateLimitDecision(True, policy.limit, policy.limit - count, 0.0)
+
+    def _load_window(self, key: Tuple[str, str, str], now: float) -> _Window:
+        db_name, user_id, endpoint = key
+        self._ensure_table(db_name)
+        window = _Window()
+        # Requests counted before an eviction may still be waiting in the write buffer
+        with self._writer.reading(db_name) as buffered:
+            hits = get_rate_limit_hits(user_id, endpoint, now - self.max_window_seconds, db_name)
+        local = [hit[2] for hit in buffered if hit[0] == user_id and hit[1] == endpoint]
+        for timestamp, worker in hits:
+            (local if worker == self._worker else window.remote).append(timestamp)
+        window.local.extend(sorted(local))
+        return window
+
+    def _cache_window(self, key: Tuple[str, str, str], loaded: _Window) -> _Window:
+        # Called with the lock held. Another thread may have loaded and used the window in the meantime.
+        window = self._windows.get(key)
+        if window is not None:
+            self._windows.move_to_end(key)
+            return window
+        self._windows[key] = loaded
+        while len(self._windows) > self.max_windows:
+            self._windows.popitem(last=False)
+        return loaded
+
+    def sync(self):
+        """
+        Replaces the requests of the other workers in the windows in memory that they counted requests in
+        since the last sync. The database is read once per database plus once per changed window.
+        """
+        for db_name, synced in list(self._synced.items()):
+            started = time.time()
+            changed = get_rate_limit_changes(self._worker, synced - SYNC_OVERLAP_SECONDS, db_name)
+            with self._lock:
+                keys = [(db_name, user_id, endpoint) for user_id, endpoint in changed if (db_name, user_id, endpoint) in self._windows]
+            for key in keys:
+                hits = get_rate_limit_hits(key[1], key[2], started - self.max_window_seconds, db_name)
+                remote = deque(timestamp for timestamp, worker in hits if worker != self._worker)
+                with self._lock:
+                    if key in self._windows:
+                        self._windows[key].remote = remote
+            self._synced[db_name] = started
+
+    def _run_sync(self):
+        while True:
+            time.sleep(RATE_LIMIT_SYNC_SECONDS)
+            try:
+                self.sync()
+            except Exception as e:
+                logger.warning("Could not sync the rate limit windows: %s", e)
+
+    def _start_sync(self):
+        threading.Thread(target=self._run_sync, name="rate-limit-sync", daemon=True).start()
+
+    def _after_fork(self):
+        # A forked worker counts its own requests, the windows of the server process are loaded again from the database
+        self._windows = OrderedDict()
+        self._lock = threading.Lock()
+        self._tables_ready = set()
+        self._synced = {}
+        self._worker = uuid.uuid4().hex
+        self._start_sync()
+
+    def _ensure_table(self, db_name: str):
+        if db_name not in self._tables_ready:
+            create_rate_limit_table(db_name)
+            self._tables_ready.add(db_name)
+            # Windows loaded from now on are up to date, the sync only merges what is written later
+            self._synced.setdefault(db_name, time.time())
+
+    def _write_hits(self, db_name: str, hits):
+        self._ensure_table(db_name)
+        store_rate_limit_hits(hits, expire_before=time.time() - self.max_window_seconds, db_name=db_name)
+
+
+rate_limiter = SlidingWindowRateLimiter(RATE_LIMIT_POLICIES)
@@ -0,0 +1,247 @@
+import functools
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextvars import copy_context
+from typing import Any, Callable, Dict, Optional
+from services.metrics import UPSTREAM_CALLS_TOTAL, CIRCUIT_BREAKER_TRANSITIONS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+# HTTP statuses worth retrying: timeouts, rate limits and server errors
+TRANSIENT_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class UpstreamError(RuntimeError):
+    """
+    Raised instead of calling an upstream service that is known to be failing or overloaded.
+    """
+
+    def __init__(self, upstream: str, message: str, retry_after: float = 0.0):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(UpstreamError):
+    """
+    Raised while the circuit breaker of an upstream is open.
+    """
+
+
+class UpstreamBusyError(UpstreamError):
+    """
+    Raised when all the concurrent call slots of an upstream stay taken for its whole timeout.
+    """
+
+
+class UpstreamTimeoutError(UpstreamError, TimeoutError):
+    """
+    Raised when a call exceeds the hard deadline of an upstream whose client has no timeout of its own.
+    """
+
+
+def error_status(error: BaseException) -> Optional[int]:
+    """
+    Returns the HTTP status an SDK error carries, None for errors without one (e.g. connection errors).
+    """
+    response = getattr(error, "response", None)
+    for status in (getattr(error, "status_code", None), getattr(error, "status", None), getattr(error, "code", None),
+                   getattr(response, "status_code", None)):
+        if isinstance(status, int) and 100 <= status < 600:
+            return status
+    return None
+
+
+def is_transient(error: BaseException) -> bool:
+    """
+    Whether a failed call may succeed when retried: errors without an HTTP status (connection resets,
+    timeouts) and transient statuses are, client errors like 400 or 404 are not.
+    """
+    if isinstance(error, UpstreamError):
+        return False
+    status = error_status(error)
+    return status is None or status in TRANSIENT_STATUSES
+
+
+class Upstream:
+    """
+    Guards the calls to one upstream service:
+    - retries transient failures with jittered exponential backoff, as long as the retry budget allows
+      (retries may add at most retry_ratio extra calls per successful call, so they stop amplifying
+      the load during an outage),
+    - limits the calls in flight, so a slow provider cannot take up every worker thread,
+    - opens a circuit breaker after failure_threshold consecutive failed calls and fails fast for
+      reset_timeout seconds, then lets a single probe call through to decide whether to close it,
+    - with hard_timeout, abandons calls still running after timeout seconds, for clients that have no
+      timeout of their own. Other clients are given the timeout by their caller.
+    """
+
+    def __init__(self, name: str, timeout: float, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0,
+                 max_concurrency: int = 16, failure_threshold: int = 5, reset_timeout: float = 30.0,
+                 retry_ratio: float = 0.1, hard_timeout: bool = False,
+                 retry_if: Callable[[BaseException], bool] = is_transient):
+        """
+        Args:
+            name (str): The name of the upstream, the label of its metrics.
+            timeout (float): Seconds a single call may take.
+            max_attempts (int): The number of attempts of a call, including the first.
+            base_delay (float): The maximum backoff before the first retry, doubled for every further retry.
+            max_delay (float): The cap of the backoff.
+            max_concurrency (int): The number of calls in flight at once.
+            failure_threshold (int): Consecutive failed calls that open the circuit breaker.
+            reset_timeout (float): Seconds the breaker stays open before a probe call.
+            retry_ratio (float): The retries allowed per successful call, on top of a small initial allowance.
+            hard_timeout (bool): Whether to run calls in a thread of the upstream and stop waiting for them after timeout.
+            retry_if (Callable[[BaseException], bool]): Whether an error is transient, i.e. retried and counted by the breaker.
+        """
+        self.name = name
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retry_ratio = retry_ratio
+        self.hard_timeout = hard_timeout
+        self.retry_if = retry_if
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._state = "closed"
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._retry_tokens = 10.0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        UPSTREAMS[name] = self
+
+    @property
+    def state(self) -> str:
+        """
+        The state of the circuit breaker: "closed", "open" or "half_open".
+        """
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return "half_open"
+            return self._state
+
+    def call(self, func: Callable, *args, **kwargs) -> Any:
+        """
+        Calls func(*args, **kwargs) under the policies of the upstream.
+
+        Returns:
+            Any: The result of func.
+
+        Raises:
+            CircuitOpenError: The breaker is open.
+            UpstreamBusyError: No call slot became free within the timeout.
+            UpstreamTimeoutError: A call with hard_timeout did not finish within the timeout.
+            Exception: The error of the last attempt.
+        """
+        attempt = 1
+        while True:
+            self._before_call()
+            if not self._slots.acquire(timeout=self.timeout):
+                with self._lock:
+                    self._probing = False
+                UPSTREAM_CALLS_TOTAL.inc(upstream=self.name, outcome="busy")
+                raise UpstreamBusyError(self.name, f"all {self.max_concurrency} call slots are in use.", retry_after=self.timeout)
+            try:
+                result = self._call_once(func, args, kwargs)
+            except Exception as e:
+                timed_out = isinstance(e, UpstreamTimeoutError)
+                transient = timed_out or self.retry_if(e)
+                self._after_call(success=not transient)
+                retry = transient and attempt < self.max_attempts and self._take_retry_token() and self.state != "open"
+                # Each attempt is counted once, a timed out one as a timeout whether it is retried or not
+                UPSTREAM_CALLS_TOTAL.inc(upstream=self.name, outcome="timeout" if timed_out else "retry" if retry else "error")
+                if not retry:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                logger.warning("Call to %s failed (attempt %s of %s), retrying in %.2fs: %s", self.name, attempt, self.max_attempts, delay, e)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._after_call(success=True)
+            UPSTREAM_CALLS_TOTAL.inc(upstream=self.name, outcome="ok")
+            return result
+
+    def guard(self, func: Callable) -> Callable:
+        """
+        Decorator that runs every call of func through call.
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+
+        return wrapper
+
+    def _call_once(self, func: Callable, args: tuple, kwargs: Dict[str, Any]) -> Any:
+        # Runs with a call slot taken, gives it back
+        if not self.hard_timeout:
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._slots.release()
+
+        # The slot is only given back once the call ends, so abandoned calls still count against the limit
+        future = self._get_executor().submit(copy_context().run, func, *args, **kwargs)
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise UpstreamTimeoutError(self.name, f"no response within {self.timeout}s.") from None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix=f"upstream-{self.name}")
+            return self._executor
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == "closed":
+                return
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if self._state == "open" and remaining <= 0:
+                self._transition("half_open")
+            if self._state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            UPSTREAM_CALLS_TOTAL.inc(upstream=self.name, outcome="circuit_open")
+            raise CircuitOpenError(self.name, "failing fast while the service is down.", retry_after=max(remaining, 1.0))
+
+    def _after_call(self, success: bool):
+        with self._lock:
+            self._probing = False
+            if success:
+                self._failures = 0
+                self._retry_tokens = min(10.0, self._retry_tokens + self.retry_ratio)
+                if self._state != "closed":
+                    self._transition("closed")
+                return
+            self._failures += 1
+            if self._state == "half_open" or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                if self._state != "open":
+                    self._transition("open")
+
+    def _take_retry_token(self) -> bool:
+        with self._lock:
+            if self._retry_tokens < 1:
+                return False
+            self._retry_tokens -= 1
+            return True
+
+    def _transition(self, state: str):
+        logger.log(logging.WARNING if state == "open" else logging.INFO, "Circuit breaker of %s is %s.", self.name, state.replace("_", "-"))
+        self._state = state
+        CIRCUIT_BREAKER_TRANSITIONS_TOTAL.inc(upstream=self.name, state=state)
+
+
+# Every upstream by name, to report their breaker states
+UPSTREAMS: Dict[str, Upstream] = {}
+
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Any, Callable, Optional, Tuple
+from database.cache_db import (create_cache_table, get_cache_entry, store_cache_entry, delete_cache_entries,
+                               claim_cache_lease, release_cache_lease, get_cache_entry_and_lease)
+from services.metrics import COALESCED_CALLS_TOTAL, record_cache
+from services.single_flight import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+# The database of the shared caches. With SQLite it is a local file every worker process on the host opens,
+# with a PostgreSQL DATABASE_URL it is shared by the workers of every host.
+SHARED_CACHE_DB = os.getenv("SHARED_CACHE_DB", "shared_cache.db")
+# How often a process waiting for another one to compute an entry checks whether it is cached, at first
+# and at most (the interval doubles while it waits)
+LEASE_POLL_SECONDS = 0.05
+LEASE_POLL_MAX_SECONDS = 1.0
+
+_tables_ready = set()
+_tables_lock = threading.Lock()
+
+
+class SharedCache:
+    """
+    A cache of JSON values shared by every worker process, so a personality profile, creator document or
+    search result computed by one worker is reused by the others instead of being computed once per process.
+    Entries live in the database (see database/cache_db.py) under the namespace of the cache.
+    Lookups that fail are treated as misses, so a broken cache only costs the recomputation.
+
+    Concurrent misses of a key are computed once: threads of a process share one computation and
+    processes take a lease on the key, the others waiting until the value is cached.
+    """
+
+    def __init__(self, namespace: str, ttl_seconds: Optional[float] = None, max_entries: Optional[int] = None,
+                 db_name: Optional[str] = None, lease_seconds: float = 60):
+        """
+        Args:
+            namespace (str): The name of the cache, also the label of its hit and miss metrics.
+            ttl_seconds (Optional[float]): How long entries are kept, forever if None.
+            max_entries (Optional[int]): The number of newest entries kept, no limit if None.
+            db_name (Optional[str]): The database of the cache, SHARED_CACHE_DB if None.
+            lease_seconds (float): How long other processes wait for a computation before starting their own,
+                                   should exceed the time a computation takes.
+        """
+        self.namespace = namespace
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.db_name = db_name or SHARED_CACHE_DB
+        self.lease_seconds = lease_seconds
+        self._writes = 0
+        self._flight = SingleFlight(namespace)
+
+    def get(self, key: Any) -> Optional[Any]:
+        """
+        Returns the cached value of a key, None on a miss.
+
+        Args:
+            key (Any): The key, anything JSON serializable (e.g. a tuple of strings).
+        """
+        value = self._lookup(self._serialize_key(key))
+        record_cache(self.namespace, hit=value is not None)
+        return value
+
+    def set(self, key: Any, value: Any):
+        """
+        Caches a JSON serializable value for the TTL of the cache.
+        """
+        self._ensure_table()
+        now = time.time()
+        expires_at = now + self.ttl_seconds if self.ttl_seconds else None
+        try:
+            store_cache_entry(self.namespace, self._serialize_key(key), json.dumps(value), now, expires_at, db_name=self.db_name)
+        except Exception as e:
+            logger.warning("Could not store an entry in shared cache '%s': %s", self.namespace, e)
+            return
+        self._writes += 1
+        if self._writes % 100 == 0:
+            # Trimming on every write would double the writes, the table only overshoots max_entries by a few
+            delete_cache_entries(self.namespace, now, self.max_entries, db_name=self.db_name)
+
+    def get_or_compute(self, key: Any, compute: Callable[[], Any], cache_if: Callable[[Any], bool] = lambda value: value is not None) -> Any:
+        """
+        Returns the cached value of a key, computing and caching it on a miss.
+        Concurrent misses of the key in any process wait for the first one and share its value.
+
+        Args:
+            key (Any): The key, anything JSON serializable.
+            compute (Callable[[], Any]): Computes the value on a miss.
+            cache_if (Callable[[Any], bool]): Whether a computed value is cached, e.g. not empty results of a failed call.
+
+        Returns:
+            Any: The cached or computed value.
+        """
+        value = self.get(key)
+        if value is None:
+            value = self._flight.do(self._serialize_key(key), lambda: self._compute_once(key, compute, cache_if))
+        return value
+
+    def delete(self, key: Any):
+        """
+        Drops the entry of a key in every process.
+        """
+        self._ensure_table()
+        delete_cache_entries(self.namespace, time.time(), key=self._serialize_key(key), db_name=self.db_name)
+
+    def _lookup(self, serialized_key: str) -> Optional[Any]:
+        self._ensure_table()
+        try:
+            value = get_cache_entry(self.namespace, serialized_key, time.time(), db_name=self.db_name)
+        except Exception as e:
+            logger.warning("Shared cache '%s' lookup failed, treating it as a miss: %s", self.namespace, e)
+            return None
+        return json.loads(value) if value is not None else None
+
+    def _lookup_with_lease(self, serialized_key: str) -> Tuple[Optional[Any], Optional[float]]:
+        try:
+            value, lease_expires_at = get_cache_entry_and_lease(self.namespace, serialized_key, time.time(), db_name=self.db_name)
+        except Exception as e:
+            logger.warning("Shared cache '%s' lookup failed, claiming the lease: %s", self.namespace, e)
+            return None, None
+        return (json.loads(value) if value is not None else None), lease_expires_at
+
+    def _claim(self, serialized_key: str, token: str) -> bool:
+        now = time.time()
+        try:
+            return claim_cache_lease(self.namespace, serialized_key, token, now, now + self.lease_seconds, db_name=self.db_name)
+        except Exception as e:
+            logger.warning("Could not claim a lease in shared cache '%s', computing without it: %s", self.namespace, e)
+            return True
+
+    def _compute_once(self, key: Any, compute: Callable[[], Any], cache_if: Callable[[Any], bool]) -> Any:
+        serialized_key = self._serialize_key(key)
+        token = uuid.uuid4().hex
+        # Waiters poll with reads, which do not queue up for the database's write lock like claims do, and
+        # claim the lease again once the holder released it without caching a value or it expired
+        delay = LEASE_POLL_SECONDS
+        while not self._claim(serialized_key, token):
+            while True:
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, LEASE_POLL_MAX_SECONDS)
+                value, lease_expires_at = self._lookup_with_lease(serialized_key)
+                if value is not None:
+                    COALESCED_CALLS_TOTAL.inc(call=self.namespace)
+                    return value
+                if lease_expires_at is None or lease_expires_at <= time.time():
+                    break
+        try:
+            # Cached by another process between the miss and the claim
+            value = self._lookup(serialized_key)
+            if value is None:
+                value = compute()
+                if cache_if(value):
+                    self.set(key, value)
+            return value
+        finally:
+            self._release(serialized_key, token)
+
+    def _release(self, serialized_key: str, token: str):
+        # An unreleased lease expires after lease_seconds, a failed release must not replace the value or error
+        try:
+            release_cache_lease(self.namespace, serialized_key, token, db_name=self.db_name)
+        except Exception as e:
+            logger.warning("Could not release a lease in shared cache '%s', it expires on its own: %s", self.namespace, e)
+
+    @staticmethod
+    def _serialize_key(key: Any) -> str:
+        return key if isinstance(key, str) else json.dumps(key, sort_keys=True)
+
+    def _ensure_table(self):
+        if self.db_name in _tables_ready:
+            return
+        with _tables_lock:
+            if self.db_name not in _tables_ready:
+                create_cache_table(self.db_name)
+                _tables_ready.add(self.db_name)
@@ -0,0 +1,94 @@
+import functools
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+from services.metrics import COALESCED_CALLS_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical calls share one execution: the first caller of a key runs the function,
+    callers arriving while it runs wait for it and get the same result (or exception) instead of
+    calling out again. Calls made after it finished run anew, caching results is left to the caller.
+    Results are shared between the callers as is, so they must not be modified.
+    """
+
+    def __init__(self, name: str):
+        """
+        Args:
+            name (str): The name of the call, the label of its coalesced calls metric.
+        """
+        self.name = name
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Any:
+        """
+        Runs func, unless a call of the same key is in flight, and returns its result.
+
+        Args:
+            key (Hashable): Identifies identical calls.
+            func (Callable[[], Any]): The call.
+
+        Returns:
+            Any: The result of func, raises its exception.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            COALESCED_CALLS_TOTAL.inc(call=self.name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def _freeze(value: Any) -> Hashable:
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple(sorted((key, _freeze(item)) for key, item in value.items()))
+    return value
+
+
+def coalesced(name: Optional[str] = None):
+    """
+    Decorator that coalesces concurrent calls of a function with equal arguments (see SingleFlight).
+    Arguments must be hashable once lists and dicts are turned into tuples.
+
+    Args:
+        name (Optional[str]): The name of the call in the metrics, the function name by default.
+    """
+    def decorator(func):
+        flight = SingleFlight(name or func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return flight.do((_freeze(args), _freeze(kwargs)), lambda: func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
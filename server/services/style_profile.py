@@ -0,0 +1,83 @@
+import logging
+from typing import Dict, List, Optional
+from database.style_db import (
+    create_style_tables, add_video_style_stats, get_creator_style_stats, get_video_style_stats
+)
+from tools.stylometry import StyleStats, analyze_transcript, merge_stats, measured_profile
+from tools.transcript import get_transcripts
+
+logger = logging.getLogger(__name__)
+
+_tables_ready = False
+
+
+def _ensure_tables():
+    global _tables_ready
+    # Created once per process, a failed attempt is repeated on the next call
+    if not _tables_ready:
+        _tables_ready = create_style_tables()
+
+
+def add_video_to_style_profile(creator_id: str, video_id: str, script: Optional[str] = None) -> bool:
+    """
+    Adds one video to a creator's style profile. Only the new video is analysed,
+    its statistics are merged into the stored running total of the creator.
+
+    Args:
+        creator_id (str): The ID of the creator.
+        video_id (str): The ID of the YouTube video.
+        script (Optional[str]): The transcript of the video, fetched if not given.
+
+    Returns:
+        bool: True if the video was added, False if it was already part of the profile.
+    """
+    _ensure_tables()
+    if video_id in get_video_style_stats([video_id]):
+        logger.debug("Video ID: %s is already part of the style profile.", video_id)
+        return False
+    if script is None:
+        script = get_transcripts([video_id])[0]
+    return add_video_style_stats(creator_id, video_id, analyze_transcript(script))
+
+
+def get_creator_style_profile(creator_id: str) -> Dict:
+    """
+    Returns the measured Verbal fields of a creator over every ingested video.
+
+    Args:
+        creator_id (str): The ID of the creator.
+
+    Returns:
+        Dict: The measured fields, empty sections if the creator has no ingested videos.
+    """
+    _ensure_tables()
+    stats = get_creator_style_stats(creator_id)
+    return measured_profile(stats if stats else StyleStats())
+
+
+def get_style_stats(video_ids: List[str], scripts: List[str], creator_id: Optional[str] = None) -> StyleStats:
+    """
+    Returns the statistics over the given videos, reusing the stored statistics of already analysed videos.
+    Videos that are new or were analysed by an older version of the analyzer are analysed and,
+    when a creator ID is given, stored.
+
+    Args:
+        video_ids (List[str]): The IDs of the YouTube videos.
+        scripts (List[str]): The transcripts of the videos, in the same order.
+        creator_id (Optional[str]): The ID of the creator the videos belong to.
+
+    Returns:
+        StyleStats: The statistics over all the videos.
+    """
+    _ensure_tables()
+    stored = get_video_style_stats(video_ids)
+    stats = []
+    for video_id, script in zip(video_ids, scripts):
+        if video_id in stored:
+            stats.append(stored[video_id])
+            continue
+        video_stats = analyze_transcript(script)
+        if creator_id:
+            add_video_style_stats(creator_id, video_id, video_stats)
+        stats.append(video_stats)
+    return merge_stats(stats)
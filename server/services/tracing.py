@@ -0,0 +1,196 @@
+import logging
+import os
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from opentelemetry import context as otel_context, trace
+from opentelemetry.trace import Span, SpanKind, Status, StatusCode
+
+logger = logging.getLogger(__name__)
+
+# Id of the API request (or chat turn) being served. Set once at the edge, it is recorded on every span
+# and log line of the request, including those of worker threads the request's context is copied to.
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+# Resolves to the exporting provider once setup_tracing installs one, until then spans are not recorded
+tracer = trace.get_tracer("creator-twin")
+
+_configured = False
+
+
+def setup_tracing():
+    """
+    Installs the span exporter selected by TRACE_EXPORTER: "console" prints every finished span,
+    "file" appends them as JSON lines to TRACE_FILE (traces.jsonl by default). Without TRACE_EXPORTER
+    spans are not recorded, but request ids are still propagated. Exporting needs opentelemetry-sdk.
+    """
+    global _configured
+    exporter_name = os.getenv("TRACE_EXPORTER", "none").lower()
+    if _configured or exporter_name == "none":
+        return
+    try:
+        from opentelemetry.sdk.resources import SERVICE_NAME, Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError:
+        logger.warning("TRACE_EXPORTER is set but opentelemetry-sdk is not installed, spans will not be exported.")
+        return
+
+    if exporter_name == "console":
+        exporter = ConsoleSpanExporter()
+    elif exporter_name == "file":
+        out = open(os.getenv("TRACE_FILE", "traces.jsonl"), "a", encoding="utf-8")
+        exporter = ConsoleSpanExporter(out=out, formatter=lambda span: span.to_json(indent=None) + "\n")
+    else:
+        raise ValueError(f"Unsupported TRACE_EXPORTER '{exporter_name}', use 'console', 'file' or 'none'.")
+
+    provider = TracerProvider(resource=Resource.create({SERVICE_NAME: os.getenv("OTEL_SERVICE_NAME", "creator-twin")}))
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+    _configured = True
+    logger.info("Exporting trace spans to %s.", exporter_name)
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex
+
+
+@contextmanager
+def use_request_id(value: str):
+    """
+    Makes value the request id of everything run inside the with block.
+    """
+    token = request_id.set(value)
+    try:
+        yield value
+    finally:
+        request_id.reset(token)
+
+
+def _attributes(attributes: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    result = {"request.id": request_id.get()} if request_id.get() else {}
+    for key, value in (attributes or {}).items():
+        if value is not None:
+            result[key] = value if isinstance(value, (str, bool, int, float)) else str(value)
+    return result
+
+
+@contextmanager
+def span(name: str, attributes: Optional[Dict[str, Any]] = None, kind: SpanKind = SpanKind.INTERNAL):
+    """
+    Traces the with block as a child of the current span. An exception escaping the block is recorded
+    on the span and marks it as failed.
+
+    Args:
+        name (str): The name of the span.
+        attributes (Optional[Dict[str, Any]]): Attributes recorded on the span, next to the request id.
+        kind (SpanKind): The OpenTelemetry span kind.
+    """
+    with tracer.start_as_current_span(name, kind=kind, attributes=_attributes(attributes)) as current:
+        yield current
+
+
+def traced(name: Optional[str] = None):
+    """
+    Decorator tracing every call of the function, in a span named after it by default.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or f"{func.__module__}.{func.__qualname__}"):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TracingCallback(BaseCallbackHandler):
+    """
+    Opens a span for every agent step, chain, chat model call and tool call of the runnables it is
+    attached to, nested like the runs themselves. A run's span is the current span while it runs, so the
+    database, Pinecone and HTTP spans of a tool call nest under the tool.
+    """
+    run_inline = True
+
+    def __init__(self):
+        # Per run: its span, whether the run owns it and the token to detach it from the current context.
+        # Hidden internal runs share their parent's span.
+        self._spans: Dict[UUID, Tuple[Span, bool, Optional[object]]] = {}
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, tags: Optional[List[str]],
+               attributes: Dict[str, Any], kind: SpanKind = SpanKind.INTERNAL):
+        parent = self._spans.get(parent_run_id) if parent_run_id else None
+        if parent and tags and "langsmith:hidden" in tags:
+            self._spans[run_id] = (parent[0], False, None)
+            return
+        # Top level runs nest under the span current in the caller, e.g. the API request
+        context = trace.set_span_in_context(parent[0]) if parent else None
+        started = tracer.start_span(name, context=context, kind=kind, attributes=_attributes(attributes))
+        # LangChain runs the child runnables in a copy of the context the start callback ran in
+        token = otel_context.attach(trace.set_span_in_context(started))
+        self._spans[run_id] = (started, True, token)
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None):
+        current, owned, token = self._spans.pop(run_id, (None, False, None))
+        if not owned:
+            return
+        # A run ended from another context than it started in (e.g. another thread) leaves that context alone
+        if token is not None and trace.get_current_span() is current:
+            otel_context.detach(token)
+        if error is not None:
+            current.record_exception(error)
+            current.set_status(Status(StatusCode.ERROR, str(error)))
+        current.end()
+
+    def on_chain_start(self, serialized: Optional[Dict[str, Any]], inputs: Any, *, run_id: UUID,
+                       parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None,
+                       metadata: Optional[Dict[str, Any]] = None, **kwargs: Any):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "chain"
+        metadata = metadata or {}
+        self._start(run_id, parent_run_id, f"chain {name}", tags, {
+            "langgraph.node": metadata.get("langgraph_node"),
+            "langgraph.step": metadata.get("langgraph_step"),
+        })
+
+    def on_tool_start(self, serialized: Optional[Dict[str, Any]], input_str: str, *, run_id: UUID,
+                      parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None, **kwargs: Any):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "tool"
+        self._start(run_id, parent_run_id, f"tool {name}", tags, {"tool.name": name})
+
+    def _start_llm(self, run_id: UUID, parent_run_id: Optional[UUID], tags: Optional[List[str]], kwargs: Dict[str, Any]):
+        params = kwargs.get("invocation_params") or {}
+        model = params.get("model_name") or params.get("model") or (kwargs.get("metadata") or {}).get("ls_model_name") or "unknown"
+        self._start(run_id, parent_run_id, f"llm {model}", tags, {"gen_ai.request.model": model}, kind=SpanKind.CLIENT)
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[Any]], *, run_id: UUID,
+                            parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None, **kwargs: Any):
+        self._start_llm(run_id, parent_run_id, tags, kwargs)
+
+    def on_llm_start(self, serialized: Dict[str, Any], prompts: List[str], *, run_id: UUID,
+                     parent_run_id: Optional[UUID] = None, tags: Optional[List[str]] = None, **kwargs: Any):
+        self._start_llm(run_id, parent_run_id, tags, kwargs)
+
+    def on_chain_end(self, outputs: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_tool_end(self, output: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id)
+
+    def on_chain_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_tool_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._end(run_id, error)
+
+
+# One shared handler, so a model reached both directly and through an agent is traced once
+tracing_callback = TracingCallback()
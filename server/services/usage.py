@@ -0,0 +1,262 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+from langchain_core.callbacks import BaseCallbackHandler
+from database.usage_db import create_usage_table, store_usage, get_tokens_used
+from database.write_behind import WriteBehindBuffer
+from services.metrics import LLM_TOKENS_TOTAL, LLM_COST_USD_TOTAL
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ModelPrice:
+    # USD per million tokens
+    prompt: float
+    completion: float
+
+
+# List prices of the models we call. Usage of other models is recorded with a cost of 0.
+MODEL_PRICES: Dict[str, ModelPrice] = {
+    "gpt-4o-mini": ModelPrice(prompt=0.15, completion=0.60),
+    "gpt-4o": ModelPrice(prompt=2.50, completion=10.00),
+    "gemini-2.5-flash-lite": ModelPrice(prompt=0.10, completion=0.40),
+    "gemini-2.5-flash": ModelPrice(prompt=0.30, completion=2.50),
+}
+
+# Daily token budgets of users by tier, None for no budget. Unknown tiers fall back to the free tier.
+USER_DAILY_TOKEN_BUDGETS: Dict[str, Optional[int]] = {
+    "free": 200_000,
+    "pro": 2_000_000,
+    "internal": None,
+}
+
+# Daily token budget of every creator (personality analysis and chats with their persona), none by default
+CREATOR_DAILY_TOKEN_BUDGET: Optional[int] = int(os.getenv("CREATOR_DAILY_TOKEN_BUDGET", "0")) or None
+
+
+@dataclass(frozen=True)
+class BudgetDecision:
+    allowed: bool
+    # None when there is no budget
+    limit: Optional[int]
+    used: int
+    # Seconds until the budget resets, 0 when it is allowed
+    retry_after: float
+
+
+# Who LLM calls made in the current context are billed to. Set with attribute_usage.
+usage_attribution: ContextVar[Dict[str, str]] = ContextVar("usage_attribution", default={})
+
+
+@contextmanager
+def attribute_usage(user_id: Optional[str] = None, creator_id: Optional[str] = None, endpoint: Optional[str] = None,
+                    tier: Optional[str] = None):
+    """
+    Bills the LLM calls made inside the with block to a user (of a tier), a creator and an endpoint.
+    Fields left None keep the value of an enclosing attribute_usage block.
+    """
+    fields = {"user_id": user_id, "creator_id": creator_id, "endpoint": endpoint, "tier": tier}
+    token = usage_attribution.set({**usage_attribution.get(), **{key: value for key, value in fields.items() if value is not None}})
+    try:
+        yield
+    finally:
+        usage_attribution.reset(token)
+
+
+def _today() -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime())
+
+
+def _seconds_until_tomorrow() -> float:
+    now = time.time()
+    return 24 * 3600 - now % (24 * 3600)
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """
+    Returns the list price in USD of a call, 0 for models without a known price.
+    """
+    price = MODEL_PRICES.get(model)
+    if price is None:
+        # Versioned names like gpt-4o-mini-2024-07-18 are priced as their base model
+        price = next((MODEL_PRICES[name] for name in sorted(MODEL_PRICES, key=len, reverse=True) if model.startswith(name)), None)
+    if price is None:
+        return 0.0
+    return (prompt_tokens * price.prompt + completion_tokens * price.completion) / 1_000_000
+
+
+class UsageTracker:
+    """
+    Records the tokens of every LLM call, billed to the user, creator and endpoint of the calling context.
+    Calls are written behind to daily totals in the database, which every worker process increments. Budget
+    checks read today's total from there plus the calls this process has not written yet, so calls another
+    worker recorded within the last second of write delay are missed, as are calls still in flight: a user can
+    go over the budget by the tokens of the calls running when it is reached. When the database cannot be read,
+    checks use the last total this process knows.
+    """
+
+    def __init__(self, db_name: str = 'llm_usage.db'):
+        self.db_name = db_name
+        # Called as hook(scope, id, used, limit) when a call takes a user or a creator ("user" or "creator") over its budget
+        self.budget_hooks: List[Callable[[str, str, int, int], None]] = []
+        # Today's totals as last read, and counted up by this process, to call the budget hooks once a call crosses a budget
+        self._totals: Dict[Tuple[str, str, str], int] = {}
+        # Counters of the tokens recorded while a total is read from the database, one per reading thread, by total key
+        self._loading: Dict[Tuple[str, str, str], List[List[int]]] = {}
+        self._lock = threading.Lock()
+        self._table_ready = False
+        self._writer = WriteBehindBuffer(self._write_usage, name="usage-writer")
+
+    def record(self, provider: str, model: str, prompt_tokens: int, completion_tokens: int):
+        """
+        Records one LLM call.
+
+        Args:
+            provider (str): The LLM provider, e.g. "openai" or "gemini".
+            model (str): The model name.
+            prompt_tokens (int): The tokens of the prompt.
+            completion_tokens (int): The tokens of the completion.
+        """
+        attribution = usage_attribution.get()
+        user_id, creator_id = attribution.get("user_id", ""), attribution.get("creator_id", "")
+        cost = estimate_cost(model, prompt_tokens, completion_tokens)
+        day = _today()
+        LLM_TOKENS_TOTAL.inc(prompt_tokens, provider=provider, model=model, kind="prompt")
+        LLM_TOKENS_TOTAL.inc(completion_tokens, provider=provider, model=model, kind="completion")
+        LLM_COST_USD_TOTAL.inc(cost, provider=provider, model=model)
+
+        exceeded = []
+        with self._lock:
+            # Queued under the lock, so a concurrent read of the totals either sees the row or counts it here
+            self._writer.add(self.db_name, (day, user_id, creator_id, attribution.get("endpoint", ""), provider, model, 1, prompt_tokens, completion_tokens, cost))
+            for scope, key, limit in (("user", user_id, self.user_budget(attribution.get("tier"))), ("creator", creator_id, CREATOR_DAILY_TOKEN_BUDGET)):
+                total_key = (day, scope, key)
+                for recorded in self._loading.get(total_key, ()) if key else ():
+                    recorded[0] += prompt_tokens + completion_tokens
+                if not key or total_key not in self._totals:
+                    # Read from the database, this call included, on the next budget check
+                    continue
+                before = self._totals[total_key]
+                self._totals[total_key] = before + prompt_tokens + completion_tokens
+                if limit is not None and before < limit <= self._totals[total_key]:
+                    exceeded.append((scope, key, self._totals[total_key], limit))
+        for scope, key, used, limit in exceeded:
+            logger.warning("The %s '%s' used up their daily token budget (%s of %s).", scope, key, used, limit)
+            for hook in self.budget_hooks:
+                hook(scope, key, used, limit)
+
+    @staticmethod
+    def user_budget(tier: Optional[str]) -> Optional[int]:
+        """
+        Returns the daily token budget of a user tier, None for no budget.
+        """
+        return USER_DAILY_TOKEN_BUDGETS.get(tier or "free", USER_DAILY_TOKEN_BUDGETS["free"])
+
+    def tokens_used(self, user_id: Optional[str] = None, creator_id: Optional[str] = None) -> int:
+        """
+        Returns the tokens a user or a creator used today (UTC), as recorded by every worker process.
+        """
+        scope, key = ("user", user_id) if user_id is not None else ("creator", creator_id)
+        day = _today()
+        total_key = (day, scope, key)
+        self._ensure_table()
+        # No batch is written while reading, so every call of this process is either buffered or in the database.
+        # The database is read without the lock, calls recorded meanwhile are added up in _loading.
+        error = None
+        with self._writer.reading(self.db_name) as buffered:
+            recorded_meanwhile = [0]
+            with self._lock:
+                self._loading.setdefault(total_key, []).append(recorded_meanwhile)
+            try:
+                stored = get_tokens_used(day, user_id=user_id, creator_id=creator_id, db_name=self.db_name)
+            except Exception as e:
+                stored, error = 0, e
+        column = 1 if scope == "user" else 2
+        stored += sum(row[7] + row[8] for row in buffered if row[0] == day and row[column] == key)
+        with self._lock:
+            used = stored + recorded_meanwhile[0]
+            self._loading[total_key] = [recorded for recorded in self._loading[total_key] if recorded is not recorded_meanwhile]
+            if not self._loading[total_key]:
+                del self._loading[total_key]
+            if error is not None:
+                # Without the database, the total this process last read and counted up since stands in, so
+                # whoever was over budget stays blocked and the others are allowed rather than locked out
+                logger.error("Could not read today's tokens of the %s '%s', using the last known total: %s", scope, key, error)
+                return max(self._totals.get(total_key, 0), used)
+            if self._totals and next(iter(self._totals))[0] != day:
+                # Totals of past days are never read again
+                self._totals = {k: v for k, v in self._totals.items() if k[0] == day}
+            self._totals[total_key] = max(self._totals.get(total_key, 0), used)
+            return used
+
+    def check_budget(self, user_id: Optional[str] = None, creator_id: Optional[str] = None, tier: Optional[str] = None) -> BudgetDecision:
+        """
+        Checks whether a user (by tier) or a creator has tokens left today.
+
+        Args:
+            user_id (Optional[str]): The user to check.
+            creator_id (Optional[str]): The creator to check, when no user_id is given.
+            tier (Optional[str]): The user's tier, selecting the budget.
+
+        Returns:
+            BudgetDecision: Whether more LLM calls are allowed, the budget, the tokens used and when it resets.
+        """
+        limit = self.user_budget(tier) if user_id is not None else CREATOR_DAILY_TOKEN_BUDGET
+        if limit is None:
+            return BudgetDecision(True, None, 0, 0.0)
+        used = self.tokens_used(user_id=user_id, creator_id=creator_id)
+        if used >= limit:
+            return BudgetDecision(False, limit, used, _seconds_until_tomorrow())
+        return BudgetDecision(True, limit, used, 0.0)
+
+    def flush(self):
+        """
+        Writes every recorded call to the database.
+        """
+        self._writer.flush()
+
+    def _ensure_table(self):
+        if not self._table_ready:
+            create_usage_table(self.db_name)
+            self._table_ready = True
+
+    def _write_usage(self, db_name: str, rows):
+        self._ensure_table()
+        store_usage(rows, db_name=db_name)
+
+
+usage_tracker = UsageTracker()
+
+
+class UsageCallback(BaseCallbackHandler):
+    """
+    Records the token usage reported in every response of the chat model it is attached to.
+    """
+    # Runs in the caller's thread, where the usage attribution is set
+    run_inline = True
+
+    def __init__(self, provider: str):
+        self.provider = provider
+
+    def on_llm_end(self, response: Any, *, run_id: UUID, parent_run_id: Optional[UUID] = None, **kwargs: Any):
+        llm_output = response.llm_output or {}
+        recorded = False
+        for generations in response.generations:
+            for generation in generations:
+                message = getattr(generation, "message", None)
+                usage = getattr(message, "usage_metadata", None)
+                if usage:
+                    model = (message.response_metadata or {}).get("model_name") or llm_output.get("model_name") or "unknown"
+                    usage_tracker.record(self.provider, model, usage.get("input_tokens", 0), usage.get("output_tokens", 0))
+                    recorded = True
+        token_usage = llm_output.get("token_usage")
+        if not recorded and token_usage:
+            usage_tracker.record(self.provider, llm_output.get("model_name") or "unknown",
+                                 token_usage.get("prompt_tokens", 0), token_usage.get("completion_tokens", 0))
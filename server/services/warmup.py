@@ -0,0 +1,82 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Modules the API endpoints import on first use, the agent and LLM stack first as it takes the longest
+WARMUP_MODULES = (
+    "services.persona_agent",
+    "tools.get_details",
+    "tools.my_details",
+    "database.character_db",
+    "database.pinecone_upsert",
+    "database.pinecone_retriever",
+    "services.style_profile",
+)
+
+_ready = threading.Event()
+
+
+def warm_up():
+    """
+    Imports the heavy modules, creates the shared OpenAI, Gemini and Pinecone clients and builds the
+    personality analysis chains and the tokenizer, so the first requests do not pay for them.
+    When the server preloads the app, this runs once before the workers are forked and they share the result.
+    """
+    from config.client import get_model
+    from config.gemini_config import get_client
+    from config.pinecone_config import get_pinecone_client
+    from services.context_window import count_tokens
+    from services.embeddings import use_local_embeddings, get_embedding_model
+    from tools.extract_details import get_chain, get_sample_chain, get_merge_chain
+
+    start = time.perf_counter()
+    for name in WARMUP_MODULES:
+        importlib.import_module(name)
+    # Creating the clients opens no connection, so none is shared by forked workers
+    prepares = [get_model, get_client, get_pinecone_client, get_chain, get_sample_chain, get_merge_chain,
+                lambda: count_tokens("warm-up")]
+    if use_local_embeddings():
+        # Downloads the model files, forked workers load the model from them on first use
+        prepares.append(get_embedding_model)
+    for prepare in prepares:
+        try:
+            prepare()
+        except Exception as e:
+            logger.warning("Could not prepare %s during warm-up, it is retried on first use: %s", getattr(prepare, "__name__", prepare), e)
+    _ready.set()
+    logger.info("Warm-up finished in %.2fs.", time.perf_counter() - start)
+
+
+def start_warm_up(mode: Optional[str] = None):
+    """
+    Starts the warm-up the way WARMUP selects: "background" (the default) runs it in a daemon thread so the
+    process answers requests right away, "blocking" runs it before returning, "off" skips it and every
+    dependency loads on first use.
+
+    Args:
+        mode (Optional[str]): Overrides the WARMUP environment variable.
+    """
+    mode = (mode or os.getenv("WARMUP", "background")).lower()
+    if _ready.is_set():
+        # Already warmed up, e.g. by the server process before it forked this worker
+        return
+    if mode == "off":
+        _ready.set()
+    elif mode == "blocking":
+        warm_up()
+    elif mode == "background":
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    else:
+        raise ValueError(f"Unsupported WARMUP '{mode}', use 'background', 'blocking' or 'off'.")
+
+
+def is_ready() -> bool:
+    """
+    Returns whether the warm-up is finished (or disabled).
+    """
+    return _ready.is_set()
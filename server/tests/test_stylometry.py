@@ -0,0 +1,30 @@
+from tools.stylometry import analyze_transcript
+
+
+def fillers(script):
+    return analyze_transcript(script).filler_counts
+
+
+def test_like_as_a_verb_after_an_adverb_is_not_a_filler():
+    assert fillers("I really like pizza.")["like"] == 0
+    assert fillers("You just like pizza, we also like pizza.")["like"] == 0
+    assert fillers("Really like pizza.")["like"] == 0
+
+
+def test_like_as_a_verb_after_a_subject_is_not_a_filler():
+    assert fillers("I like pizza and you like pasta.")["like"] == 0
+
+
+def test_like_as_a_filler_is_counted():
+    assert fillers("It was like so good.")["like"] == 1
+    assert fillers("It was really like insane.")["like"] == 1
+
+
+def test_so_is_only_a_filler_at_the_start_of_a_clause():
+    assert fillers("It was so good.")["so"] == 0
+    assert fillers("Um so we went home.")["so"] == 1
+
+
+def test_right_is_only_a_filler_as_a_tag_or_a_clause():
+    assert fillers("Turn right at the corner.")["right"] == 0
+    assert fillers("That was fun, right?")["right"] == 1
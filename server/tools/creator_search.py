@@ -0,0 +1,77 @@
+from langchain_core.tools import StructuredTool
+from database.pinecone_retriever import semantic_search_by_creator
+from services.context_window import count_tokens
+from services.shared_cache import SharedCache
+
+CACHE_SIZE = 512
+CACHE_TTL_SECONDS = 600
+# [creator_id, query, top_k] -> passages, shared by all agents of every worker process
+_cache = SharedCache("creator_search", ttl_seconds=CACHE_TTL_SECONDS, max_entries=CACHE_SIZE)
+
+
+def _cached_search(creator_id: str, query: str, top_k: int):
+    key = (creator_id, " ".join(query.lower().split()), top_k)
+    # Failed searches also come back empty, so they are not cached
+    return _cache.get_or_compute(
+        key,
+        lambda: semantic_search_by_creator(creator_id=creator_id, search_query=query, top_n=top_k),
+        cache_if=bool
+    )
+
+
+def search_creator_transcripts(creator_id: str, query: str, top_k: int = 3, max_tokens: int = 600) -> str:
+    """
+    Retrieves the transcript passages of a creator that are most relevant to a query.
+    Results are cached per creator and query, and the passages are cut to a token budget.
+
+    Args:
+        creator_id (str): The ID of the creator.
+        query (str): What to look for in the creator's videos.
+        top_k (int): The maximum number of passages to return.
+        max_tokens (int): The maximum number of tokens of passage text to return.
+
+    Returns:
+        str: The passages separated by blank lines, or a note that nothing relevant was found.
+    """
+    passages = []
+    used_tokens = 0
+    for result in _cached_search(creator_id, query, top_k):
+        text = result.get("text", "")
+        tokens = count_tokens(text)
+        if used_tokens + tokens > max_tokens:
+            if passages:
+                break
+            # Always return something for the best hit, cut to the budget
+            text = text[:max_tokens * 4]
+        passages.append(f"[video {result.get('video_id', 'N/A')}] {text}")
+        used_tokens += tokens
+
+    if not passages:
+        return "Nothing relevant found in your videos."
+    return "\n\n".join(passages)
+
+
+def make_video_search_tool(creator_id: str, top_k: int = 3, max_tokens: int = 600) -> StructuredTool:
+    """
+    Creates the search_my_videos tool bound to a creator.
+
+    Args:
+        creator_id (str): The ID of the creator the agent speaks as.
+        top_k (int): The maximum number of passages the tool returns.
+        max_tokens (int): The maximum number of tokens of passage text the tool returns.
+
+    Returns:
+        StructuredTool: The retrieval tool for the persona agent.
+    """
+    def search_my_videos(query: str) -> str:
+        return search_creator_transcripts(creator_id, query, top_k=top_k, max_tokens=max_tokens)
+
+    return StructuredTool.from_function(
+        func=search_my_videos,
+        name="search_my_videos",
+        description=(
+            "this tool is used to recall what u said in your own videos. "
+            "Pass a short search query about the topic of the question and it returns the few most relevant "
+            "passages of your video transcripts."
+        )
+    )
@@ -1,13 +1,13 @@
+from functools import lru_cache
 from langchain_core.prompts import ChatPromptTemplate
 from langgraph.prebuilt import create_react_agent
-from config.client import model
+from config.client import get_model
 from tools.transcript import get_script
+from services.tracing import tracing_callback
 
 
-def get_chain():
-    
-    # Create the system prompt template with detailed instructions
-    prompt_template = """You are an AI assistant that analyzes communication styles and creates detailed profiles.
+# Create the system prompt template with detailed instructions
+PROMPT_TEMPLATE = """You are an AI assistant that analyzes communication styles and creates detailed profiles.
     Your task is to analyze the given script and create a comprehensive communication profile.
 
     you can check out the speech of the person by using the tool get_script.
@@ -21,21 +21,71 @@ def get_chain():
 
     Make sure to support your analysis with specific examples from the script."""
 
-    # Create the prompt with system and human messages
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", prompt_template),
-        ("human", "Please analyze the script and create a detailed communication profile.")
-    ])
+# Create the prompt with system and human messages
+PROMPT = ChatPromptTemplate.from_messages([
+    ("system", PROMPT_TEMPLATE),
+    ("human", "Please analyze the script and create a detailed communication profile.")
+])
+
 
+@lru_cache(maxsize=None)
+def get_chain():
+    """
+    Builds the personality analysis chain once and reuses it for every analysis.
+    """
     # Create the agent with tools
     agent = create_react_agent(
-        model=model,
+        model=get_model(),
         tools=[get_script]
     )
 
-
-    chain = prompt | agent 
+    # Traces every agent step and get_script call of an analysis
+    chain = (PROMPT | agent).with_config(callbacks=[tracing_callback])
     return chain
 
 
+SAMPLE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are an AI assistant that analyzes communication styles and creates detailed profiles.
+    Analyze the excerpt of the person's speech given by the user and create a communication profile from it alone.
+
+    Provide a structured profile following this format:
+
+    {format_instructions}"""),
+    ("human", "{excerpt}")
+])
+
+MERGE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You are an AI assistant that analyzes communication styles and creates detailed profiles.
+    You are given {count} communication profiles of the same person, each built from a different excerpt of their speech.
+    Merge them into one profile of the person. For single choice fields pick the value most profiles agree on.
+    For lists keep the items that recur across profiles first, and drop near duplicates.
+
+    Provide a structured profile following this format:
+
+    {format_instructions}"""),
+    ("human", "{profiles}")
+])
+
+
+@lru_cache(maxsize=None)
+def get_deterministic_model():
+    """
+    Returns a copy of the chat model with sampling pinned down, so repeated analyses agree.
+    """
+    return get_model().model_copy(update={"temperature": 0, "seed": 0})
+
+
+@lru_cache(maxsize=None)
+def get_sample_chain():
+    """
+    Builds the chain that profiles a single excerpt (the map step of batched extraction).
+    """
+    return SAMPLE_PROMPT | get_deterministic_model()
+
 
+@lru_cache(maxsize=None)
+def get_merge_chain():
+    """
+    Builds the chain that merges the excerpt profiles into one (the reduce step of batched extraction).
+    """
+    return MERGE_PROMPT | get_deterministic_model()
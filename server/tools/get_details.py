@@ -1,26 +1,110 @@
+import json
+import logging
+from typing import Literal, Optional
 from models.personality import Verbal
-from tools.transcript import get_transcript,split_text
-from tools.extract_details import get_chain
+from tools.transcript import get_transcripts,split_text,sample_chunks,use_script_chunks
+from tools.extract_details import get_chain,get_sample_chain,get_merge_chain
+from tools.stylometry import measured_profile,describe_measurements,apply_measured_profile
+from services.style_profile import get_style_stats
+from services.errors import LLMOverloadedError
+from services.llm_scheduler import prioritize
+from services.single_flight import coalesced
+from services.tracing import traced
 from langchain_core.output_parsers import PydanticOutputParser
 
+logger = logging.getLogger(__name__)
 
 
-def get_personality(video_id:list[str]):
+# Many users opening the chat of a creator that is not analysed yet would each start the same analysis
+@traced()
+@coalesced()
+def get_personality(video_id:list[str], mode:Literal["agent","batched"]="agent", sample_size:int=6, max_concurrency:int=8, use_stylometry:bool=True, creator_id:Optional[str]=None):
 
     """
     Get the personality of the person in the video
     Args:
         video_id: The id of the video
+        mode: "agent" lets an agent read chunks of its choice, "batched" analyses a fixed
+            sample of chunks in parallel and merges the results, which is faster and reproducible
+        sample_size: The number of chunks analysed in batched mode
+        max_concurrency: The number of chunks analysed at once in batched mode
+        use_stylometry: Measure the countable fields (common and crutch words, sentence length, voice,
+            catchphrases) over the full transcripts instead of letting the LLM guess them
+        creator_id: The creator the videos belong to, so their statistics are stored and only new videos
+            are analysed on the next run
     Returns:
         The personality of the person in the video
+    Raises:
+        LLMOverloadedError: The LLM scheduler shed the analysis, it can be retried later
     """
-    script=get_transcript(video_id)
     parser = PydanticOutputParser(pydantic_object=Verbal)
-    texts=split_text(script)
-    chain=get_chain()
-    result = chain.invoke({
-        "format_instructions": parser.get_format_instructions(),
-        "length": len(texts)
+    scripts=get_transcripts(video_id)
+    measured = measured_profile(get_style_stats(video_id, scripts, creator_id)) if use_stylometry else {}
+    format_instructions = parser.get_format_instructions() + describe_measurements(measured)
+
+    # Analyses yield LLM capacity to chat turns and summaries
+    with prioritize("analysis"):
+        if mode == "batched":
+            profile = get_personality_batched(scripts, parser, format_instructions, sample_size, max_concurrency)
+        else:
+            texts=split_text("\n".join(scripts))
+            chain=get_chain()
+            with use_script_chunks(texts):
+                result = chain.invoke({
+                    "format_instructions": format_instructions,
+                    "length": len(texts)
+                })
+            result=result['messages'][-1].content
+            profile = parser.parse(result)
+
+    if measured:
+        profile = apply_measured_profile(profile, measured)
+    return str(profile.model_dump())
+
+
+@traced()
+def get_personality_batched(scripts:list[str], parser:PydanticOutputParser, format_instructions:str, sample_size:int=6, max_concurrency:int=8) -> Verbal:
+    """
+    Profile a stratified sample of chunks in one parallel batch, then merge the profiles in a single call
+    Args:
+        scripts: One transcript per video
+        parser: The parser for the Verbal profile
+        format_instructions: The profile format, including any measured fields
+        sample_size: The number of chunks to analyse
+        max_concurrency: The number of chunks analysed at once
+    Returns:
+        The merged personality profile
+    """
+    samples = sample_chunks(scripts, sample_size)
+    if not samples:
+        raise ValueError("No transcript text found for the videos.")
+
+    # Map: one profile per sampled chunk, all requests in flight together
+    responses = get_sample_chain().batch(
+        [{"format_instructions": format_instructions, "excerpt": sample} for sample in samples],
+        config={"max_concurrency": max_concurrency},
+        return_exceptions=True
+    )
+    profiles = []
+    for response in responses:
+        if isinstance(response, LLMOverloadedError):
+            # A profile of the remaining samples would be worse, the whole analysis is retried later
+            raise response
+        try:
+            if isinstance(response, Exception):
+                raise response
+            profiles.append(parser.parse(response.content))
+        except Exception as e:
+            logger.warning("Skipping a sample that could not be profiled: %s", e)
+    if not profiles:
+        raise ValueError("None of the sampled chunks could be profiled.")
+    if len(profiles) == 1:
+        return profiles[0]
+
+    # Reduce: merge every partial profile into one
+    merged = get_merge_chain().invoke({
+        "format_instructions": format_instructions,
+        "count": len(profiles),
+        "profiles": json.dumps([profile.model_dump() for profile in profiles], indent=2)
     })
-    result=result['messages'][-1].content
-    return str(parser.parse(result).model_dump())
\ No newline at end of file
+    return parser.parse(merged.content)
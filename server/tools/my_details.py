@@ -1,21 +1,36 @@
+import os
 import re
 import json
 import requests
 from bs4 import BeautifulSoup
-from typing import Dict, List, Any
+from typing import Dict, Any
 from langchain_core.tools import tool
+from services.metrics import DOC_FETCH_SECONDS
+from services.shared_cache import SharedCache
+from services.resilience import Upstream
+from services.single_flight import coalesced
 
-@tool
-def my_current_info() -> Dict[str, Any]:
+# The creator document changes rarely, every worker process reuses one fetch for this long
+DOC_CACHE_TTL_SECONDS = 300
+_doc_cache = SharedCache("creator_doc", ttl_seconds=DOC_CACHE_TTL_SECONDS)
+
+docs_upstream = Upstream("google_docs", timeout=float(os.getenv("DOC_FETCH_TIMEOUT_SECONDS", "10")), max_concurrency=4)
+
+DOC_URL = "https://docs.google.com/document/d/1A4n4b5XohNUnv5zbjMWD9hefCTPth0nh7fldJjYAhio/edit?tab=t.0"
+
+
+@coalesced()
+def fetch_doc(url: str = DOC_URL) -> str:
     """
-    this tool is used to get your current info.Details like what are u currently doing these days future plans, general facts about u.
-      - document_id: the Google Doc ID
-      - paragraphs: a list of paragraph texts
-      - tables: a list of tables, each table is a list of rows, each row is a list of cell strings
-      - metadata: additional document metadata
+    Downloads a Google Doc and extracts its paragraphs and tables.
+
+    Args:
+        url (str): The URL of the document.
+
+    Returns:
+        str: The JSON of the document_id, the paragraphs and the tables (each a list of rows of cell strings).
     """
     # 1) Extract the document ID
-    url="https://docs.google.com/document/d/1A4n4b5XohNUnv5zbjMWD9hefCTPth0nh7fldJjYAhio/edit?tab=t.0"
     match = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
     if not match:
         raise ValueError(f"Could not find document ID in URL: {url}")
@@ -24,9 +39,14 @@ def my_current_info() -> Dict[str, Any]:
     # 2) Build the HTML export URL
     export_url = f'https://docs.google.com/document/d/{doc_id}/export?format=html'
 
-    # 3) Download
-    resp = requests.get(export_url)
-    resp.raise_for_status()
+    # 3) Download, retrying server errors
+    def download():
+        resp = requests.get(export_url, timeout=docs_upstream.timeout)
+        resp.raise_for_status()
+        return resp
+
+    with DOC_FETCH_SECONDS.time():
+        resp = docs_upstream.call(download)
 
     # 4) Parse with BeautifulSoup
     soup = BeautifulSoup(resp.text, 'html.parser')
@@ -53,7 +73,15 @@ def my_current_info() -> Dict[str, Any]:
     return str(json.dumps(result, indent=2))
 
 
-def my_info() -> Dict[str, Any]:
+def get_doc(url: str = DOC_URL) -> str:
+    """
+    Returns the extracted document, fetched at most once per DOC_CACHE_TTL_SECONDS across all worker processes.
+    """
+    return _doc_cache.get_or_compute(url, lambda: fetch_doc(url))
+
+
+@tool
+def my_current_info() -> Dict[str, Any]:
     """
     this tool is used to get your current info.Details like what are u currently doing these days future plans, general facts about u.
       - document_id: the Google Doc ID
@@ -61,33 +89,15 @@ def my_info() -> Dict[str, Any]:
       - tables: a list of tables, each table is a list of rows, each row is a list of cell strings
       - metadata: additional document metadata
     """
-    # 1) Extract the document ID
-    url="https://docs.google.com/document/d/1A4n4b5XohNUnv5zbjMWD9hefCTPth0nh7fldJjYAhio/edit?tab=t.0"
-    match = re.search(r'/d/([a-zA-Z0-9_-]+)', url)
-    if not match:
-        raise ValueError(f"Could not find document ID in URL: {url}")
-    doc_id = match.group(1)
-
-    export_url = f'https://docs.google.com/document/d/{doc_id}/export?format=html'
+    return get_doc()
 
-    resp = requests.get(export_url)
-    resp.raise_for_status()
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    
-    paragraphs = [p.get_text(strip=True) for p in soup.find_all('p')]
-    
-    tables = []
-    
-    for tbl in soup.find_all('table'):
-        rows = []
-        for tr in tbl.find_all('tr'):
-            cells = [cell.get_text(strip=True) for cell in tr.find_all(['td', 'th'])]
-            rows.append(cells)
-        tables.append(rows)
-    result = {
-        "document_id": doc_id,
-        "paragraphs": paragraphs,
-        "tables": tables
-    }
-    return str(json.dumps(result, indent=2))
\ No newline at end of file
+def my_info() -> Dict[str, Any]:
+    """
+    this tool is used to get your current info.Details like what are u currently doing these days future plans, general facts about u.
+      - document_id: the Google Doc ID
+      - paragraphs: a list of paragraph texts
+      - tables: a list of tables, each table is a list of rows, each row is a list of cell strings
+      - metadata: additional document metadata
+    """
+    return get_doc()
@@ -0,0 +1,307 @@
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Dict, List
+import numpy as np
+from models.personality import Verbal
+
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are aren't as at be because been before being below between both
+but by can can't cannot could couldn't did didn't do does doesn't doing don't down during each few for from further
+get got gonna had hadn't has hasn't have haven't having he he'd he'll he's her here here's hers herself him himself his
+how how's i i'd i'll i'm i've if in into is isn't it it's its itself just let's me more most mustn't my myself no nor
+not now of off on once only or other ought our ours ourselves out over own really same shan't she she'd she'll she's
+should shouldn't so some such than that that's the their theirs them themselves then there there's these they they'd
+they'll they're they've this those through to too under until up us very was wasn't we we'd we'll we're we've were
+weren't what what's when when's where where's which while who who's whom why why's will with won't would wouldn't you
+you'd you'll you're you've your yours yourself yourselves yeah okay oh also going one thing things know like want
+think see go say said make way well
+""".split())
+
+# Single word and multi word fillers, matched on the lowercased word stream
+FILLER_WORDS = ("um", "uh", "erm", "hmm", "basically", "actually", "literally", "honestly", "okay", "yeah")
+FILLER_PHRASES = ("you know", "i mean", "kind of", "sort of", "you see", "or something", "and stuff")
+# Also ordinary words ("so good", "I like it", "turn right"), counted only where they are used as fillers
+POSITIONAL_FILLERS = ("so", "like", "right")
+# Fillers nearly every speaker says all the time are crutch words only when said once every this many words
+COMMON_FILLER_RATES = {"okay": 100, "yeah": 100}
+CRUTCH_WORD_RATE = 500
+# "like" is a verb or a preposition after these words and before a noun phrase
+LIKE_VERB_CONTEXT = frozenset("""
+i you we they he she people everyone everybody nobody who i'd you'd we'd they'd would do don't does doesn't did didn't
+to look looks looked feel feels felt sound sounds sounded seem seems seemed something anything nothing stuff things more
+""".split())
+# "I really like pizza": adverbs between the subject and the verb, or starting a clause without a subject
+LIKE_ADVERBS = frozenset("""
+really just also actually totally definitely genuinely absolutely especially still always never kinda
+""".split())
+NOUN_PHRASE_START = frozenset("a an the this that these those my your his her its our their me him us them it someone something".split())
+
+WORD_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+# Words and the punctuation that tells where clauses start and end
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:'[a-z]+)?|[.!?,]")
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+")
+PASSIVE_RE = re.compile(r"\b(?:am|is|are|was|were|be|been|being|get|gets|got|gotten)\s+(?:\w+ly\s+)?(?:\w+ed|\w+en|made|done|known|built|taught|told|said|found|seen|left|kept|held|brought|bought|thought|given|taken)\b")
+
+# Stored statistics measured by another version of analyze_transcript are measured again
+ANALYZER_VERSION = 2
+
+MAX_SENTENCE_LENGTH = 80
+PHRASE_SIZES = (3, 4, 5)
+EDGE_WORDS = 60
+
+
+@dataclass
+class StyleStats:
+    """
+    Countable facts about how a creator speaks, measured over their transcripts.
+    """
+    videos: int = 0
+    total_words: int = 0
+    word_counts: Counter = field(default_factory=Counter)
+    filler_counts: Counter = field(default_factory=Counter)
+    phrase_counts: Counter = field(default_factory=Counter)
+    # Number of videos each phrase appears in, catchphrases recur across videos
+    phrase_videos: Counter = field(default_factory=Counter)
+    # sentence_length_hist[n] is the number of sentences with n words, capped at MAX_SENTENCE_LENGTH
+    sentence_length_hist: np.ndarray = field(default_factory=lambda: np.zeros(MAX_SENTENCE_LENGTH + 1, dtype=np.int64))
+    passive_sentences: int = 0
+
+
+def _ngrams(words: List[str], n: int):
+    return zip(*(words[i:] for i in range(n)))
+
+
+def _positional_fillers(tokens: List[str]) -> Counter:
+    # Clauses start after punctuation or another filler ("um so"). Auto generated captions have little
+    # punctuation, there "so" and "right" are only counted after a filler.
+    counts = Counter()
+    for i, token in enumerate(tokens):
+        if token not in POSITIONAL_FILLERS:
+            continue
+        previous = tokens[i - 1] if i else "."
+        following = tokens[i + 1] if i + 1 < len(tokens) else "."
+        clause_start = previous in ".!?," or previous in FILLER_WORDS
+        if token == "so":
+            is_filler = clause_start
+        elif token == "like":
+            before = tokens[i - 2] if i > 1 else "."
+            is_verb = previous in LIKE_VERB_CONTEXT or (previous in LIKE_ADVERBS and (before in LIKE_VERB_CONTEXT or before in ".!?,"))
+            is_filler = not is_verb and following not in NOUN_PHRASE_START
+        else:
+            # A tag question ("right?") or a clause of its own ("right, so")
+            is_filler = following == "?" or (clause_start and (following == "," or following in FILLER_WORDS))
+        if is_filler:
+            counts[token] += 1
+    return counts
+
+
+def analyze_transcript(script: str) -> StyleStats:
+    """
+    Measures the style statistics of a single video transcript.
+
+    Args:
+        script (str): The transcript of one video.
+
+    Returns:
+        StyleStats: The statistics of the video.
+    """
+    stats = StyleStats(videos=1)
+    lowered = script.lower()
+    words = WORD_RE.findall(lowered)
+    stats.total_words = len(words)
+    if not words:
+        return stats
+
+    stats.word_counts = Counter(word for word in words if word not in STOPWORDS and len(word) > 2 and not word.isdigit())
+
+    unigrams = Counter(words)
+    bigrams = Counter(" ".join(gram) for gram in _ngrams(words, 2))
+    trigrams = Counter(" ".join(gram) for gram in _ngrams(words, 3))
+    for filler in FILLER_WORDS:
+        if unigrams[filler]:
+            stats.filler_counts[filler] = unigrams[filler]
+    for filler in FILLER_PHRASES:
+        count = (bigrams if filler.count(" ") == 1 else trigrams)[filler]
+        if count:
+            stats.filler_counts[filler] = count
+    stats.filler_counts.update(_positional_fillers(TOKEN_RE.findall(lowered)))
+
+    # Intros and outros are where catchphrases live, their phrases count even when said once per video
+    edges = set()
+    for n in PHRASE_SIZES:
+        edges.update(" ".join(gram) for gram in _ngrams(words[:EDGE_WORDS], n))
+        edges.update(" ".join(gram) for gram in _ngrams(words[-EDGE_WORDS:], n))
+    for n in PHRASE_SIZES:
+        counts = trigrams if n == 3 else Counter(" ".join(gram) for gram in _ngrams(words, n))
+        # Other phrases said once in a video are noise, keeping them would make the counters huge
+        stats.phrase_counts.update({phrase: count for phrase, count in counts.items() if count > 1 or phrase in edges})
+    stats.phrase_videos = Counter(stats.phrase_counts.keys())
+
+    # Auto generated captions have little punctuation; sentence lengths are only measured when it is there
+    sentences = [sentence for sentence in SENTENCE_END_RE.split(lowered) if sentence.strip()]
+    if len(sentences) > 1 and len(words) / len(sentences) <= MAX_SENTENCE_LENGTH:
+        lengths = np.fromiter((len(WORD_RE.findall(sentence)) for sentence in sentences), dtype=np.int64, count=len(sentences))
+        lengths = np.minimum(lengths[lengths > 0], MAX_SENTENCE_LENGTH)
+        stats.sentence_length_hist = np.bincount(lengths, minlength=MAX_SENTENCE_LENGTH + 1)
+        stats.passive_sentences = sum(1 for sentence in sentences if PASSIVE_RE.search(sentence))
+    return stats
+
+
+def merge_stats(stats: List[StyleStats]) -> StyleStats:
+    """
+    Adds up the statistics of several videos.
+    """
+    merged = StyleStats()
+    for item in stats:
+        merged.videos += item.videos
+        merged.total_words += item.total_words
+        merged.word_counts.update(item.word_counts)
+        merged.filler_counts.update(item.filler_counts)
+        merged.phrase_counts.update(item.phrase_counts)
+        merged.phrase_videos.update(item.phrase_videos)
+        merged.sentence_length_hist = merged.sentence_length_hist + item.sentence_length_hist
+        merged.passive_sentences += item.passive_sentences
+    return merged
+
+
+def subtract_stats(total: StyleStats, removed: StyleStats) -> StyleStats:
+    """
+    Takes the statistics of a video back out of an aggregate, the inverse of merge_stats.
+    """
+    remaining = merge_stats([total])
+    remaining.videos -= removed.videos
+    remaining.total_words -= removed.total_words
+    # Counter subtraction also drops the entries that reach zero
+    remaining.word_counts -= removed.word_counts
+    remaining.filler_counts -= removed.filler_counts
+    remaining.phrase_counts -= removed.phrase_counts
+    remaining.phrase_videos -= removed.phrase_videos
+    remaining.sentence_length_hist = np.maximum(remaining.sentence_length_hist - removed.sentence_length_hist, 0)
+    remaining.passive_sentences -= removed.passive_sentences
+    return remaining
+
+
+def stats_to_dict(stats: StyleStats) -> Dict:
+    """
+    Converts statistics to plain JSON compatible data for storage.
+    """
+    return {
+        "videos": stats.videos,
+        "total_words": stats.total_words,
+        "word_counts": dict(stats.word_counts),
+        "filler_counts": dict(stats.filler_counts),
+        "phrase_counts": dict(stats.phrase_counts),
+        "phrase_videos": dict(stats.phrase_videos),
+        "sentence_length_hist": stats.sentence_length_hist.tolist(),
+        "passive_sentences": stats.passive_sentences,
+    }
+
+
+def stats_from_dict(data: Dict) -> StyleStats:
+    """
+    Rebuilds statistics stored with stats_to_dict.
+    """
+    return StyleStats(
+        videos=data["videos"],
+        total_words=data["total_words"],
+        word_counts=Counter(data["word_counts"]),
+        filler_counts=Counter(data["filler_counts"]),
+        phrase_counts=Counter(data["phrase_counts"]),
+        phrase_videos=Counter(data["phrase_videos"]),
+        sentence_length_hist=np.asarray(data["sentence_length_hist"], dtype=np.int64),
+        passive_sentences=data["passive_sentences"],
+    )
+
+
+def analyze_transcripts(scripts: List[str]) -> StyleStats:
+    """
+    Measures the style statistics of a creator over the transcripts of all their videos.
+
+    Args:
+        scripts (List[str]): One transcript per video.
+
+    Returns:
+        StyleStats: The statistics of the whole corpus.
+    """
+    return merge_stats([analyze_transcript(script) for script in scripts])
+
+
+def _catchphrases(stats: StyleStats, limit: int) -> List[str]:
+    min_videos = min(2, stats.videos)
+    candidates = [
+        (count * len(phrase.split()), phrase) for phrase, count in stats.phrase_counts.items()
+        if count >= 3 and stats.phrase_videos[phrase] >= min_videos
+        and not all(word in STOPWORDS for word in phrase.split())
+    ]
+    phrases = []
+    for _, phrase in sorted(candidates, reverse=True):
+        # "at the end of" and "the end of the day" are the same catchphrase as "at the end of the day",
+        # so phrases overlapping a better ranked one by all but one word are dropped
+        words = phrase.split()
+        parts = {phrase, " ".join(words[1:]), " ".join(words[:-1])}
+        if any(f" {part} " in f" {kept} " or f" {kept} " in f" {phrase} " for part in parts for kept in phrases):
+            continue
+        phrases.append(phrase)
+        if len(phrases) == limit:
+            break
+    return phrases
+
+
+def measured_profile(stats: StyleStats, common_words: int = 20, catchphrases: int = 10) -> Dict:
+    """
+    Derives the Verbal fields that can be measured instead of guessed.
+    Fields without enough evidence are left out, so the LLM still decides them.
+
+    Args:
+        stats (StyleStats): The statistics of the creator.
+        common_words (int): The number of common words to report.
+        catchphrases (int): The maximum number of catchphrases to report.
+
+    Returns:
+        Dict: The measured fields, keyed by section and field name like the Verbal model.
+    """
+    profile = {"lexicon": {}, "syntax": {}, "rhetoric_style": {}}
+    if not stats.total_words:
+        return profile
+
+    profile["lexicon"]["common_words"] = [word for word, _ in stats.word_counts.most_common(common_words)]
+    # A filler counts as a crutch word when it comes up at least once every 500 words, the common ones more often
+    profile["lexicon"]["crutch_words"] = [
+        word for word, count in stats.filler_counts.most_common()
+        if count >= stats.total_words / COMMON_FILLER_RATES.get(word, CRUTCH_WORD_RATE)
+    ]
+
+    sentences = int(stats.sentence_length_hist.sum())
+    if sentences >= 20:
+        cumulative = np.cumsum(stats.sentence_length_hist)
+        median = int(np.searchsorted(cumulative, sentences / 2))
+        profile["syntax"]["sentence_length"] = "short" if median < 12 else "medium" if median <= 22 else "long"
+        passive_ratio = stats.passive_sentences / sentences
+        profile["syntax"]["voice_preference"] = "active" if passive_ratio < 0.15 else "mixed" if passive_ratio < 0.4 else "passive"
+
+    phrases = _catchphrases(stats, catchphrases)
+    if phrases:
+        profile["rhetoric_style"]["phrases_catchphrases"] = phrases
+    return profile
+
+
+def describe_measurements(profile: Dict) -> str:
+    """
+    Renders the measured fields as an instruction for the LLM analysis step.
+    """
+    lines = [f"- {section}.{name}: {value}" for section, fields in profile.items() for name, value in fields.items()]
+    if not lines:
+        return ""
+    return ("\n\nThese fields were measured over the full transcript of every video. "
+            "Use them exactly as given and focus your analysis on the other fields:\n" + "\n".join(lines))
+
+
+def apply_measured_profile(verbal: Verbal, profile: Dict) -> Verbal:
+    """
+    Overwrites the fields of an LLM generated profile with the measured values.
+    """
+    data = verbal.model_dump()
+    for section, fields in profile.items():
+        data[section].update(fields)
+    return Verbal.model_validate(data)
@@ -1,4 +1,11 @@
-from tools.get_details import get_personality
 from tools.my_details import my_current_info
+from tools.creator_search import make_video_search_tool
 
-tools=[my_current_info]
\ No newline at end of file
+tools=[my_current_info]
+
+
+def get_tools(creator_id: str):
+    """
+    Returns the persona agent tools, with transcript search bound to the given creator.
+    """
+    return tools + [make_video_search_tool(creator_id)]
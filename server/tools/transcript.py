@@ -1,35 +1,164 @@
+import logging
+import os
+import threading
+import requests
+from contextlib import contextmanager
+from contextvars import ContextVar
 from langchain_core.tools import tool
-from youtube_transcript_api import YouTubeTranscriptApi
+from youtube_transcript_api import YouTubeTranscriptApi, CouldNotRetrieveTranscript, RequestBlocked, YouTubeRequestFailed
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_text_splitters import TokenTextSplitter
-from typing import List
+from typing import Any, Dict, List, Optional
+from services.metrics import TRANSCRIPT_FETCH_SECONDS
+from services.resilience import Upstream, is_transient
 
-texts=None
+logger = logging.getLogger(__name__)
 
-def get_transcript(video_id:list[str]):
-    content=[]
-    for id in video_id:
-        content.append(YouTubeTranscriptApi.get_transcript(id))
 
+class TranscriptError(RuntimeError):
+    """
+    Raised when the transcript of a video cannot be fetched.
+    """
+
+
+def _is_transient_transcript_error(error: BaseException) -> bool:
+    # Disabled or missing transcripts and unavailable videos will not change on a retry, blocked requests may
+    if isinstance(error, CouldNotRetrieveTranscript) and not isinstance(error, (RequestBlocked, YouTubeRequestFailed)):
+        return False
+    return is_transient(error)
+
+
+class TimeoutSession(requests.Session):
+    """
+    A requests session that applies a default timeout to every request, the transcript API sets none.
+    """
+
+    def __init__(self, timeout: float):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(*args, **kwargs)
+
+
+youtube_upstream = Upstream("youtube", timeout=float(os.getenv("YOUTUBE_TIMEOUT_SECONDS", "20")), max_concurrency=8,
+                            retry_if=_is_transient_transcript_error)
+
+_transcript_api = None
+_transcript_api_lock = threading.Lock()
+
+
+def fetch_transcript(video_id: str) -> List[Dict[str, Any]]:
+    """
+    Fetches the transcript of a video, with retries, a timeout and the YouTube circuit breaker.
+
+    Args:
+        video_id: The id of the video
+    Returns:
+        The transcript snippets, each a dict with the text, start and duration
+    """
+    global _transcript_api
+    if _transcript_api is None:
+        with _transcript_api_lock:
+            if _transcript_api is None:
+                _transcript_api = YouTubeTranscriptApi(http_client=TimeoutSession(youtube_upstream.timeout))
+    with TRANSCRIPT_FETCH_SECONDS.time():
+        return youtube_upstream.call(lambda: _transcript_api.fetch(video_id).to_raw_data())
+
+# Script chunks of the analysis running in the current thread or task.
+# Each personality run gets its own value, so concurrent runs never see each other's chunks.
+script_chunks: ContextVar[Optional[List[str]]] = ContextVar("script_chunks", default=None)
+
+def get_transcripts(video_id:list[str]) -> List[str]:
+    """
+    Get the transcript of each video, in the order of the ids
+    Args:
+        video_id: The ids of the videos
+    Returns:
+        One transcript string per video
+    """
     script=[]
-    for transcript in content:
-        curr=""
-        for i in transcript:
-            curr+=i['text']
-        script.append(curr)
-    return "\n".join(script)
+    for id in video_id:
+        script.append(transcript_text(fetch_transcript(id)))
+    return script
 
 
+def transcript_text(transcript: List[Dict[str, Any]]) -> str:
+    """
+    Joins the snippets of a fetched transcript into the script of the video, the same text for
+    the personality, the style profile and the indexed chunks
+    Args:
+        transcript: The snippets returned by fetch_transcript
+    Returns:
+        The transcript string, as get_transcripts returns it
+    """
+    return " ".join(i['text'] for i in transcript)
+
 
+def get_transcript(video_id:list[str]):
+    return "\n".join(get_transcripts(video_id))
 
 
 def split_text(script):
-    global texts
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     texts = text_splitter.split_text(script)
     return texts
 
 
+def sample_chunks(scripts: List[str], sample_size: int = 6) -> List[str]:
+    """
+    Pick a representative, deterministic sample of chunks spread evenly over every video
+    Args:
+        scripts: One transcript per video
+        sample_size: The number of chunks to pick
+    Returns:
+        The sampled chunks, without duplicates
+    """
+    seen=set()
+    per_video=[]
+    for script in scripts:
+        chunks=[]
+        for chunk in split_text(script):
+            key=" ".join(chunk.lower().split())
+            if key and key not in seen:
+                seen.add(key)
+                chunks.append(chunk)
+        if chunks:
+            per_video.append(chunks)
+    if not per_video:
+        return []
+
+    # Share the sample between the videos in proportion to their length, at least one chunk each
+    total=sum(len(chunks) for chunks in per_video)
+    quotas=[max(1, round(sample_size*len(chunks)/total)) for chunks in per_video]
+    while sum(quotas)>max(sample_size, len(per_video)):
+        quotas[quotas.index(max(quotas))]-=1
+
+    sample=[]
+    for chunks,quota in zip(per_video,quotas):
+        quota=min(quota,len(chunks))
+        # Evenly spaced positions, centred in each stretch of the video
+        step=len(chunks)/quota
+        sample.extend(chunks[int(step*i+step/2)] for i in range(quota))
+    return sample
+
+
+@contextmanager
+def use_script_chunks(texts: List[str]):
+    """
+    Makes the given chunks available to the get_script tool for the duration of an analysis run.
+
+    Args:
+        texts: The script chunks of the run
+    """
+    token = script_chunks.set(texts)
+    try:
+        yield texts
+    finally:
+        script_chunks.reset(token)
+
+
 @tool
 def get_script(index:int):
     """
@@ -39,26 +168,46 @@ def get_script(index:int):
     Returns:
         The script for the given index
     """
-    global texts
-    print(f"Getting script for index {index}")
+    texts = script_chunks.get()
+    if texts is None:
+        raise RuntimeError("get_script called outside of a personality analysis run.")
+    logger.debug("Getting script for index %s", index)
     return texts[index]
 
 
 
-def video_to_chunks(id: str = "iv-5mZ_9CPY") -> List[str]:
+def fetch_transcript_or_raise(id: str) -> List[Dict[str, Any]]:
+    """
+    Fetches the transcript of a video for indexing.
+
+    Args:
+        id: The id of the video
+    Returns:
+        The transcript snippets, as fetch_transcript returns them
+    Raises:
+        TranscriptError: The transcript could not be fetched, nothing should be indexed for the video.
+    """
     try:
-        trans = YouTubeTranscriptApi.get_transcript(id)
-        s = ""
-        for i in trans:
-            s += i['text']
-        text_splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=60)
-        texts = text_splitter.split_text(s)
-        return texts
+        return fetch_transcript(id)
     except Exception as e:
-        print(f"Error getting transcript for video {id}: {e}")
-        print("Using mock data for testing...")
-        # Return mock chunks for testing when API fails
-        mock_text = f"This is a mock transcript for video {id}. " * 10
-        text_splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=60)
-        texts = text_splitter.split_text(mock_text)
-        return texts
\ No newline at end of file
+        logger.error("Error getting transcript for video %s: %s", id, e)
+        raise TranscriptError(f"Could not get the transcript of video {id}: {e}") from e
+
+
+def video_to_chunks(id: str = "iv-5mZ_9CPY", trans: Optional[List[Dict[str, Any]]] = None) -> List[str]:
+    """
+    Fetches the transcript of a video and splits it into chunks for indexing.
+
+    Args:
+        id: The id of the video
+        trans: The transcript snippets if already fetched
+    Returns:
+        The chunks of the transcript
+    Raises:
+        TranscriptError: The transcript could not be fetched, nothing should be indexed for the video.
+    """
+    if trans is None:
+        trans = fetch_transcript_or_raise(id)
+    text_splitter = TokenTextSplitter(chunk_size=500, chunk_overlap=60)
+    texts = text_splitter.split_text(transcript_text(trans))
+    return texts